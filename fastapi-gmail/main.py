@@ -20,6 +20,8 @@ SCOPES = [
 
 BASE_DIR = pathlib.Path(__file__).resolve().parent
 GOOGLE_CLIENT_ID = BASE_DIR / "client_secret.json"
+# Read by src/gmail_sync.py (GMAIL_TOKEN_FILE there)
+TOKEN_FILE = pathlib.Path(os.getenv("GMAIL_TOKEN_FILE", BASE_DIR / "token.pickle"))
 
 @app.get("/", response_class=HTMLResponse)
 async def root():
@@ -33,7 +35,8 @@ async def authorize():
         redirect_uri="http://localhost:8000/oauth2callback"
     )
     
-    authorization_url, _ = flow.authorization_url(prompt='consent')
+    # Offline access adds a refresh token, so gmail_sync keeps working after the access token expires
+    authorization_url, _ = flow.authorization_url(prompt='consent', access_type='offline')
     
     return RedirectResponse(url=authorization_url)
             
@@ -47,6 +50,9 @@ async def oauth2callback(request: Request):
     flow.fetch_token(authorization_response=request.url)
     
     credentials = flow.credentials
-    access_token = credentials.token
+    with open(TOKEN_FILE, "wb") as f:
+        pickle.dump(credentials, f)
+    os.chmod(TOKEN_FILE, 0o600)
     
-    return HTMLResponse(f"<h3>Access Token:</h3><pre>{access_token}</pre>")
\ No newline at end of file
+    return HTMLResponse(f"<h3>Authorized.</h3><p>Credentials stored in {TOKEN_FILE}. "
+                        "Run <code>python gmail_sync.py</code> from the src directory to sync.</p>")
\ No newline at end of file
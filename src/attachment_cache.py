@@ -0,0 +1,72 @@
+import hashlib
+import os
+import sqlite3
+import time
+import zlib
+
+"""
+    Content-addressed cache of extracted attachment text
+    - Key: sha256 of the extractor, its limits and the attachment bytes, so a forwarded attachment
+      is only extracted once and changing a limit never returns text cut to the old one
+    - Value: zlib-compressed text in SQLite
+    - Eviction: least recently used entries once the stored text exceeds `max_bytes`
+
+    Every process opens its own connection (see mbox_util.get_attachment_cache), extraction
+    workers share the file through SQLite's locking.
+"""
+
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+_EVICT_FRACTION = 0.1
+
+
+def attachment_key(extractor: str, payload: bytes, limits: tuple = ()) -> bytes:
+    header = "\0".join([extractor] + [str(limit) for limit in limits]).encode()
+    return hashlib.sha256(header + b"\0" + payload).digest()
+
+
+class AttachmentTextCache:
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(os.path.join(cache_dir, "text.sqlite3"), timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, text BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.db.commit()
+
+    def get(self, key: bytes):
+        row = self.db.execute("SELECT text FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        return zlib.decompress(row[0]).decode("utf-8", errors="replace")
+
+    def put(self, key: bytes, text: str):
+        compressed = zlib.compress(text.encode("utf-8", errors="replace"))
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries (key, text, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, compressed, len(compressed), time.time())
+        )
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total > self.max_bytes:
+            self._evict(total - int(self.max_bytes * (1 - _EVICT_FRACTION)))
+        self.db.commit()
+
+    def _evict(self, n_bytes: int):
+        """
+            Drop least recently used entries until at least `n_bytes` are freed.
+        """
+        freed, keys = 0, []
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if freed >= n_bytes:
+                break
+            keys.append((key,))
+            freed += size
+        self.db.executemany("DELETE FROM entries WHERE key = ?", keys)
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+
+import metrics
+
+"""
+    Background writer for upsert batches
+    - Batches are written in submission order by one daemon thread
+    - The queue is bounded, so embedding blocks only when `max_pending` batches are already waiting
+    - A batch that still fails after retries is kept in `failed` and re-raised to the producer,
+      so no points are silently dropped
+"""
+
+WRITE_RETRIES = 3
+RETRY_BACKOFF = 1.0
+
+
+class BatchWriteError(Exception):
+    def __init__(self, failed: list):
+        self.failed = failed
+        batch, error = failed[0]
+        super().__init__(f"{len(failed)} batch(es) failed to write, first error: {error}")
+
+
+class BatchWriter:
+    def __init__(self, write_fn, max_pending: int = 2, retries: int = WRITE_RETRIES, backoff: float = RETRY_BACKOFF):
+        self.write_fn = write_fn
+        self.retries = retries
+        self.backoff = backoff
+        self.failed = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+
+    def submit(self, batch):
+        """
+            Queue a batch for writing, blocking while the queue is full.
+            Raises BatchWriteError if an earlier batch could not be written.
+        """
+        self._raise_failures()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="batch-writer", daemon=True)
+            self._thread.start()
+        self._queue.put(batch)
+
+    def pending(self) -> int:
+        """
+            Batches waiting in the queue (not counting the one being written).
+        """
+        return self._queue.qsize()
+
+    def join(self):
+        """
+            Wait until every submitted batch has been written (or has failed).
+        """
+        self._queue.join()
+        self._raise_failures()
+
+    def retry_failed(self):
+        """
+            Write failed batches again on the calling thread, in their original order.
+        """
+        failed, self.failed = self.failed, []
+        for n, (batch, _) in enumerate(failed):
+            self._write(batch)
+            if self.failed:
+                self.failed += failed[n + 1:]
+                break
+        self._raise_failures()
+
+    def _raise_failures(self):
+        if self.failed:
+            raise BatchWriteError(self.failed)
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                # Once one batch has failed, later ones are held back too so progress stays a prefix
+                if self.failed:
+                    self.failed.append((batch, "not attempted after an earlier failure"))
+                else:
+                    self._write(batch)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                self.write_fn(batch)
+                return
+            except Exception as e:
+                metrics.count("write_retries_total" if attempt < self.retries else "write_failures_total")
+                if attempt == self.retries:
+                    print(f"Batch write failed after {attempt + 1} attempts: {e}")
+                    self.failed.append((batch, e))
+                    return
+                time.sleep(self.backoff * (2 ** attempt))
@@ -0,0 +1,188 @@
+import argparse
+import random
+import time
+from email.message import EmailMessage
+
+import mbox_util
+import text_cleaning
+
+"""
+    Benchmark and output-equivalence check of message text cleaning
+    - legacy: the original get_message_text, every message (plain text included) goes through a
+      BeautifulSoup parse at the end, HTML parts are parsed twice
+    - current: mbox_util.get_message_text, only HTML parts are parsed (lxml when available)
+
+    Outputs are compared per message. The only accepted difference is the one the legacy second parse
+    causes in text that merely looks like HTML (e.g. "<bob@example.com>" or "&amp;" in a plain text part):
+    those messages must satisfy legacy == clean_html_soup(current). Anything else is reported as a mismatch.
+
+    Run from the src directory:  python benchmark_cleaning.py [--sample 500] [--synthetic]
+"""
+
+
+def legacy_message_text(email_obj):
+    message = ''
+    if email_obj.is_multipart():
+        for part in email_obj.walk():
+            if part.get_content_disposition() == 'attachment':
+                message += "[" + str(part.get_content_type()) + str(part.get_filename()) + "]\n"
+            ct = part.get_content_type()
+            if ct == 'text/plain':
+                message += part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', errors='replace') + '\n'
+            elif ct == 'text/html':
+                html_payload = part.get_payload(decode=True)
+                if html_payload:
+                    message += text_cleaning.clean_html_soup(html_payload.decode(part.get_content_charset() or 'utf-8', errors='replace') + '\n')
+            elif ct == 'application/pdf':
+                message += mbox_util.extract_attachment_text(mbox_util.extract_text_from_pdf_bytes, part.get_payload(decode=True)) + '\n'
+            elif ct == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+                message += mbox_util.extract_attachment_text(mbox_util.extract_text_from_docx_bytes, part.get_payload(decode=True)) + '\n'
+    else:
+        payload = email_obj.get_payload(decode=True)
+        ct = email_obj.get_content_type()
+        if payload is None:
+            return message
+        elif ct == 'text/plain':
+            message = payload.decode(email_obj.get_content_charset() or 'utf-8', errors='replace')
+        elif ct == 'text/html':
+            message = payload.decode(email_obj.get_content_charset() or 'utf-8', errors='replace')
+    return str(text_cleaning.clean_html_soup(message))
+
+
+# -----
+# Corpus
+# -----
+
+_NEWSLETTER = """<!DOCTYPE html><html><head><title>Weekly digest</title><style>td {{ padding: 4px; }}</style>
+<script>track('{n}');</script></head><body><!-- preheader -->
+<table>{rows}</table><p>Prices from &pound;{n}.99 &amp; free&nbsp;shipping.</p>
+<p>Questions? Write to <a href="mailto:help@shop.example">help@shop.example</a><br>or call us.</p>
+<div style="display:none">hidden preview text</div><p>Unsubscribe <a href="https://x.example/u">here</a></p></body></html>"""
+
+
+def _message(subject: str) -> EmailMessage:
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = 'Sender <sender@example.com>'
+    message['Date'] = 'Mon, 01 Jan 2024 10:00:00 +0000'
+    return message
+
+
+def synthetic_corpus(n: int = 200, seed: int = 0) -> list:
+    """
+        Message shapes found in a typical mailbox: plain text, quoted replies, HTML-only newsletters,
+        multipart/alternative, malformed HTML, plain text that contains markup-like text, and HTML with
+        content after </html> (mailing-list footers, concatenated documents).
+    """
+    rng = random.Random(seed)
+    messages = []
+    for i in range(n):
+        shape = i % 8
+        rows = "".join(f"<tr><td>Item {j}</td><td><b>{rng.randint(1, 99)}</b> EUR</td></tr>" for j in range(rng.randint(5, 40)))
+        body = "\n".join(f"Line {j} of the message about order {1000 + i}." for j in range(rng.randint(3, 30)))
+        message = _message(f"Message {i}")
+        if shape == 0:
+            message.set_content(body)
+        elif shape == 1:
+            message.set_content(body + "\n\nOn Mon, Jan 1, 2024 Bob <bob@example.com> wrote:\n> " + body.replace("\n", "\n> "))
+        elif shape == 2:
+            message.set_content(_NEWSLETTER.format(n=i, rows=rows), subtype='html')
+        elif shape == 3:
+            message.set_content(body)
+            message.add_alternative(_NEWSLETTER.format(n=i, rows=rows), subtype='html')
+        elif shape == 4:
+            message.set_content("<div><p>Unclosed paragraph<p>another <b>bold <i>both</b> text" + rows + "<td>stray cell", subtype='html')
+        elif shape == 5:
+            message.set_content(body + "\nTom & Jerry <tom@example.com> said 3 < 4 and x > y &amp; more")
+        elif shape == 6:
+            footer = f"\n<div>Footer appended by list server {i}</div><p>Unsubscribe: list-{i}@lists.example</p>"
+            message.set_content(_NEWSLETTER.format(n=i, rows=rows) + footer, subtype='html')
+        else:
+            message.set_content(f"<p>First part {i}</p></html><p>more</p>" + _NEWSLETTER.format(n=i, rows=rows), subtype='html')
+        messages.append(message)
+    return messages
+
+
+def mailbox_corpus(sample_size: int, seed: int = 0) -> list:
+    count = mbox_util.get_mbox_count()
+    indices = random.Random(seed).sample(range(count), min(sample_size, count))
+    return [mbox_util.mbox[idx] for idx in sorted(indices)]
+
+
+# -----
+# Checks
+# -----
+
+def check_equivalence(messages: list) -> dict:
+    identical, expected, mismatches = 0, 0, []
+    for n, message in enumerate(messages):
+        legacy = legacy_message_text(message)
+        current = mbox_util.get_message_text(message)
+        if legacy == current:
+            identical += 1
+        elif legacy == text_cleaning.clean_html_soup(current):
+            expected += 1
+        else:
+            mismatches.append(n)
+    return {"messages": len(messages), "identical": identical, "legacy_reparse_only": expected, "mismatches": mismatches}
+
+
+def check_html_parts(messages: list) -> dict:
+    """
+        clean_html (lxml) against clean_html_soup on every HTML part on its own.
+    """
+    parts, mismatches = 0, []
+    for n, message in enumerate(messages):
+        for part in message.walk():
+            if part.get_content_type() != 'text/html' or not part.get_payload(decode=True):
+                continue
+            html = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', errors='replace')
+            parts += 1
+            if text_cleaning.clean_html(html) != text_cleaning.clean_html_soup(html):
+                mismatches.append(n)
+    return {"html_parts": parts, "mismatches": mismatches}
+
+
+def benchmark(messages: list, repeat: int = 3) -> dict:
+    results = {}
+    for name, fn in (("legacy", legacy_message_text), ("current", mbox_util.get_message_text)):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for message in messages:
+                fn(message)
+            best = min(best, time.perf_counter() - start)
+        results[name] = best
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark and output-equivalence check of message text cleaning")
+    arg_parser.add_argument("--sample", type=int, default=500, help="messages sampled from the mbox")
+    arg_parser.add_argument("--synthetic", action="store_true", help="use generated messages instead of the mbox")
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    if args.synthetic or mbox_util.get_mbox_count() == 0:
+        messages = synthetic_corpus(args.sample)
+        print(f"Synthetic corpus: {len(messages)} messages")
+    else:
+        messages = mailbox_corpus(args.sample)
+        print(f"Mailbox sample: {len(messages)} messages")
+    print(f"HTML engine: {'lxml' if text_cleaning.lxml_html is not None else 'BeautifulSoup (lxml not installed)'}")
+
+    equivalence = check_equivalence(messages)
+    html_parts = check_html_parts(messages)
+    print(f"Identical output:            {equivalence['identical']}/{equivalence['messages']}")
+    print(f"Differs by legacy re-parse:  {equivalence['legacy_reparse_only']}")
+    print(f"Mismatches:                  {len(equivalence['mismatches'])} {equivalence['mismatches'][:10]}")
+    print(f"HTML parts lxml == soup:     {html_parts['html_parts'] - len(html_parts['mismatches'])}/{html_parts['html_parts']}")
+
+    timings = benchmark(messages, args.repeat)
+    for name, seconds in timings.items():
+        print(f"{name:8} {seconds * 1000:9.1f} ms  {seconds / len(messages) * 1e6:8.1f} us/message")
+    print(f"Speedup: {timings['legacy'] / timings['current']:.2f}x")
+
+    if equivalence["mismatches"] or html_parts["mismatches"]:
+        raise SystemExit(f"Cleaning output changed: {len(equivalence['mismatches'])} message mismatches, "
+                         f"{len(html_parts['mismatches'])} HTML part mismatches")
@@ -0,0 +1,303 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+
+import numpy as np
+
+import csv_logging_repository
+import ingest_journal
+import mbox_util
+import triage
+import vector_db_repository
+from local_vector_store import LocalVectorClient
+from mbox_index import INDEX_SUFFIX, IndexedMbox, parse_message
+from synthetic_mbox import SyntheticMboxConfig, add_config_arguments, config_from_args, generate_mbox
+from vector_db_repository import VectorDBRepository, embed_header
+
+"""
+    End-to-end ingest and search benchmark
+    - Generates a synthetic mbox (see synthetic_mbox) in a scratch workspace (cache/benchmark) and points
+      the pipeline at it; the journal, caches and vector store all live in the workspace
+    - Times every stage on its own: index, read, parse, triage, get_message (body), metadata, embed,
+      flush (write to the vector store), a full populate_collection, context / hybrid / thread search,
+      rehydrating the top hits (against re-parsing them from the mbox, the old path) and one
+      context_search_batch over as many queries
+    - The vector store is the embedded LocalVectorClient (or an in-memory QdrantClient), so no server is needed
+    - Results are written as JSON (cache/benchmark_results.json unless --output is given); --compare prints
+      the change against an earlier results file
+
+    Run from the src directory:
+        python benchmark_suite.py --messages 2000 --output results.json
+        python benchmark_suite.py --messages 2000 --output new.json --compare results.json
+"""
+
+SCHEMA_VERSION = 1
+REGRESSION_THRESHOLD = 0.10
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+        self.items = {}
+
+    @contextlib.contextmanager
+    def time(self, stage: str, items: int = 1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+            self.items[stage] = self.items.get(stage, 0) + items
+
+    def summary(self) -> dict:
+        stages = {}
+        for stage, samples in self.samples.items():
+            ms = np.asarray(samples) * 1000
+            total = float(np.sum(samples))
+            stages[stage] = {
+                "calls": len(samples),
+                "items": self.items[stage],
+                "total_s": total,
+                "mean_ms": float(ms.mean()),
+                "p50_ms": float(np.percentile(ms, 50)),
+                "p95_ms": float(np.percentile(ms, 95)),
+                "max_ms": float(ms.max()),
+                "items_per_s": self.items[stage] / total if total else None,
+            }
+        return stages
+
+
+# -----
+# Workspace
+# -----
+
+def use_workspace(workspace: str, mbox_path: str):
+    """
+        Point the mbox, the ingest journal (and the legacy CSV log it imports) and every cache at the workspace.
+    """
+    mbox_util.mbox_file = mbox_path
+    mbox_util.mbox = IndexedMbox(mbox_path)
+    mbox_util.ATTACHMENT_CACHE_DIR = os.path.join(workspace, "cache", "attachments")
+    mbox_util._attachment_cache = None
+    ingest_journal.BASE_DIR = workspace
+    csv_logging_repository.CSV_FILE = os.path.join(workspace, "process_log.csv")
+    vector_db_repository.EMBEDDING_CACHE_DIR = os.path.join(workspace, "cache", "embeddings")
+    vector_db_repository.LEXICAL_INDEX_DIR = os.path.join(workspace, "cache", "lexical")
+    vector_db_repository.NEAR_DUPLICATE_DIR = os.path.join(workspace, "cache", "near_duplicates")
+    vector_db_repository.THREAD_INDEX_DIR = os.path.join(workspace, "cache", "threads")
+    vector_db_repository.TEXT_STORE_DIR = os.path.join(workspace, "cache", "texts")
+
+
+def hash_embeddings(texts: list, batch_size: int = None, parallel: int = None) -> np.ndarray:
+    """
+        Deterministic stand-in for the model: a unit vector seeded by the text hash.
+        Measures everything around the model without downloading or running it.
+    """
+    vectors = np.empty((len(texts), mbox_util.EMBEDDING_DIM), dtype=np.float32)
+    for i, text in enumerate(texts):
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8", errors="replace"), digest_size=4).digest(), "little")
+        vector = np.random.default_rng(seed).standard_normal(mbox_util.EMBEDDING_DIM)
+        vectors[i] = vector / np.linalg.norm(vector)
+    return vectors
+
+
+def install_hash_embedder():
+    mbox_util.create_vector_embeddings = hash_embeddings
+    mbox_util.create_vector_embedding = lambda data=None: hash_embeddings([data])[0].tolist()
+
+
+def create_client(backend: str, path: str):
+    if backend == "local":
+        return LocalVectorClient(path)
+    if backend == "memory":
+        from qdrant_client import QdrantClient
+        return QdrantClient(":memory:")
+    raise ValueError(f"Unknown benchmark backend: {backend}")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# -----
+# Suite
+# -----
+
+def run_suite(config: SyntheticMboxConfig, workspace: str, backend: str = "local", embedder: str = "model",
+              queries: int = 50, batch_size: int = 500, embed_batch_size: int = mbox_util.EMBED_BATCH_SIZE) -> dict:
+    shutil.rmtree(workspace, ignore_errors=True)
+    os.makedirs(workspace)
+    if embedder == "hash":
+        install_hash_embedder()
+    timer = StageTimer()
+
+    mbox_path = os.path.join(workspace, "mbox")
+    with timer.time("generate", config.messages):
+        generate_mbox(mbox_path, config)
+
+    os.remove(mbox_path + INDEX_SUFFIX) if os.path.exists(mbox_path + INDEX_SUFFIX) else None
+    with timer.time("index", config.messages):
+        use_workspace(workspace, mbox_path)
+
+    # Per-message stages, each measured on its own
+    rules = triage.TriageRules(list_mail=triage.HEADERS)
+    records = []
+    raw_records = mbox_util.read_raw_messages(0, config.messages)
+    while True:
+        with timer.time("read"):
+            record = next(raw_records, None)
+        if record is None:
+            break
+        idx, raw = record
+        with timer.time("triage"):
+            rules.decide(triage.parse_headers(raw), len(raw))
+        with timer.time("parse"):
+            message = parse_message(raw)
+        with timer.time("get_message"):
+            data = mbox_util.get_message_text(message)
+        if not data:
+            continue
+        with timer.time("metadata"):
+            metadata = mbox_util.build_metadata(message, data)
+        records.append((idx, metadata, data))
+    # The last next() that found the end is not a message
+    timer.samples["read"].pop()
+    timer.items["read"] -= 1
+
+    texts = [embed_header(metadata) + data for _, metadata, data in records]
+    vectors = []
+    for start in range(0, len(texts), embed_batch_size):
+        batch = texts[start:start + embed_batch_size]
+        with timer.time("embed", len(batch)):
+            vectors.append(mbox_util.create_vector_embeddings(batch, batch_size=embed_batch_size))
+    vectors = np.concatenate(vectors) if vectors else np.empty((0, mbox_util.EMBEDDING_DIM), dtype=np.float32)
+
+    client = create_client(backend, os.path.join(workspace, "vectors"))
+    repository = VectorDBRepository("benchmark_flush", batch_size=len(records) + 1, async_flush=False,
+                                    use_embedding_cache=False, client=client)
+    repository.create_collection()
+    for start in range(0, len(records), batch_size):
+        for (idx, metadata, data), vector, text in zip(records[start:start + batch_size], vectors[start:start + batch_size], texts[start:start + batch_size]):
+            repository.add_document(document_id=idx, vector=vector, payload=dict(metadata), text=text)
+        with timer.time("flush", min(batch_size, len(records) - start)):
+            repository.flush()
+
+    # End to end, on a fresh collection
+    repository = VectorDBRepository("benchmark", batch_size=batch_size, embed_batch_size=embed_batch_size,
+                                    use_embedding_cache=False, client=client)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        with timer.time("populate", config.messages):
+            repository.populate_collection()
+    # populate_collection reports its errors on stdout and returns, so a failed run is told from the journal
+    stats = repository.journal.stats()
+    if stats["pending"] or stats["committed"] + stats["skipped"] < config.messages:
+        raise RuntimeError(f"populate_collection did not store every message ({stats}):\n{output.getvalue()}")
+    stored = repository.count()
+
+    rng = random.Random(config.seed)
+    subjects = [metadata["subject"] for _, metadata, _ in records] or ["empty"]
+    for n in range(queries):
+        query = rng.choice(subjects) if n % 2 else " ".join(rng.choice(subjects).split()[:2]) + f" {n}"
+        for stage, search in (("context_search", repository.context_search), ("hybrid_search", repository.hybrid_search)):
+            repository._result_cache.clear()
+            repository._query_embedding_cache.clear()
+            with timer.time(stage):
+                search(text=query, limit=10)
+        repository._query_embedding_cache.clear()
+        with timer.time("thread_search"):
+            repository.thread_search(text=query, limit=10)
+        hits = repository.context_search(text=query, limit=10)
+        with timer.time("rehydrate", len(hits)):
+            repository.rehydrate(hits)
+        with timer.time("rehydrate_reparse", len(hits)):
+            [mbox_util.get_message(hit.id) for hit in hits]
+
+    # The same number of queries again, embedded and searched as one batch
+    batch_queries = [f"{rng.choice(subjects)} {n}" for n in range(queries)]
+    repository._result_cache.clear()
+    with timer.time("context_search_batch", len(batch_queries)):
+        repository.context_search_batch(batch_queries, limit=10)
+
+    return {
+        "schema": SCHEMA_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": _git_commit(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "options": {"backend": backend, "embedder": embedder, "queries": queries, "batch_size": batch_size,
+                    "embed_batch_size": embed_batch_size},
+        "config": asdict(config),
+        "result": {"mbox_bytes": os.path.getsize(mbox_path), "messages_with_body": len(records), "points_stored": stored},
+        "stages": timer.summary(),
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> list:
+    """
+        Per-stage change of the median time against a baseline run. Returns the regressed stage names.
+    """
+    regressions = []
+    for key in ("config", "options"):
+        if current.get(key) != baseline.get(key):
+            print(f"Warning: the baseline was run with a different {key}, timings are not directly comparable")
+    print(f"\n{'stage':22} {'baseline p50':>14} {'current p50':>14} {'change':>9}")
+    for stage, stats in current["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before is None or not before["p50_ms"]:
+            continue
+        change = stats["p50_ms"] / before["p50_ms"] - 1
+        flag = "  REGRESSION" if change > threshold else ""
+        print(f"{stage:22} {before['p50_ms']:12.3f}ms {stats['p50_ms']:12.3f}ms {change:+8.1%}{flag}")
+        if flag:
+            regressions.append(stage)
+    return regressions
+
+
+def print_summary(results: dict):
+    print(f"\n{'stage':22} {'items':>7} {'total s':>9} {'p50 ms':>10} {'p95 ms':>10} {'items/s':>11}")
+    for stage, stats in results["stages"].items():
+        rate = f"{stats['items_per_s']:11.1f}" if stats["items_per_s"] else f"{'-':>11}"
+        print(f"{stage:22} {stats['items']:7} {stats['total_s']:9.3f} {stats['p50_ms']:10.3f} {stats['p95_ms']:10.3f} {rate}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="End-to-end ingest and search benchmark")
+    arg_parser.add_argument("--workspace", default=os.path.join(mbox_util.BASE_DIR, "cache", "benchmark"))
+    arg_parser.add_argument("--backend", choices=["local", "memory"], default="local")
+    arg_parser.add_argument("--embedder", choices=["model", "hash"], default="model",
+                            help="'hash' replaces the model with deterministic vectors")
+    arg_parser.add_argument("--queries", type=int, default=50)
+    arg_parser.add_argument("--batch-size", type=int, default=500)
+    arg_parser.add_argument("--embed-batch-size", type=int, default=mbox_util.EMBED_BATCH_SIZE)
+    arg_parser.add_argument("--output", default=os.path.join(mbox_util.BASE_DIR, "cache", "benchmark_results.json"))
+    arg_parser.add_argument("--compare", help="earlier results file to compare against")
+    add_config_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    results = run_suite(config_from_args(args), args.workspace, backend=args.backend, embedder=args.embedder,
+                        queries=args.queries, batch_size=args.batch_size, embed_batch_size=args.embed_batch_size)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_summary(results)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        if regressions:
+            raise SystemExit(f"Regressed stages: {', '.join(regressions)}")
@@ -0,0 +1,53 @@
+import re
+
+"""
+    Split cleaned email text into overlapping, token-bounded passages.
+
+    BAAI/bge-small-en truncates input at 512 word-piece tokens, so anything past that in a long
+    thread or attachment is never embedded. Tokens are approximated by words and punctuation
+    marks, which undercounts word pieces, so the default passage size leaves headroom for that
+    and for the From/Subject/Date header that is prepended to every passage.
+"""
+
+PASSAGE_MAX_TOKENS = 256
+PASSAGE_OVERLAP = 32
+MAX_PASSAGES = 64
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    return sum(1 for _ in _TOKEN_RE.finditer(text))
+
+
+def split_passages(text: str, max_tokens: int = PASSAGE_MAX_TOKENS, overlap: int = PASSAGE_OVERLAP,
+                   max_passages: int = MAX_PASSAGES) -> list:
+    """
+        Return up to `max_passages` passages of at most `max_tokens` tokens, each sharing
+        `overlap` tokens with the previous one. Passages are slices of the original text.
+    """
+    return split_passages_with_truncation(text, max_tokens, overlap, max_passages)[0]
+
+
+def split_passages_with_truncation(text: str, max_tokens: int = PASSAGE_MAX_TOKENS, overlap: int = PASSAGE_OVERLAP,
+                                   max_passages: int = MAX_PASSAGES) -> tuple:
+    """
+        split_passages, and whether text past the last passage was left out because of `max_passages`.
+    """
+    if overlap >= max_tokens:
+        raise ValueError("overlap must be smaller than max_tokens")
+
+    spans = [m.span() for m in _TOKEN_RE.finditer(text)]
+    if not spans:
+        return [], False
+
+    passages = []
+    step = max_tokens - overlap
+    for start in range(0, len(spans), step):
+        end = min(start + max_tokens, len(spans))
+        passages.append(text[spans[start][0]:spans[end - 1][1]])
+        if end == len(spans):
+            return passages, False
+        if len(passages) == max_passages:
+            return passages, True
+    return passages, False
@@ -0,0 +1,166 @@
+import random
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from qdrant_client import models
+
+"""
+    Collection storage profiles
+    - How vectors are stored (RAM / on disk), quantized (none / scalar int8 / binary) and indexed (HNSW m, ef_construct)
+    - The search-time parameters that go with it (hnsw_ef, rescoring with oversampling)
+    - evaluate_profile: recall@k and latency of a profile against exact search on the collection's own vectors,
+      with each query's own point left out of both rankings
+"""
+
+
+@dataclass(frozen=True)
+class CollectionProfile:
+    name: str
+    on_disk: bool = False
+    quantization: str = None        # None, "scalar" or "binary"
+    hnsw_m: int = 16
+    hnsw_ef_construct: int = 100
+    hnsw_on_disk: bool = False
+    search_ef: int = None           # None = server default
+    rescore: bool = True
+    oversampling: float = None
+
+    def vectors_config(self, dim: int) -> models.VectorParams:
+        return models.VectorParams(size=dim, distance=models.Distance.COSINE, on_disk=self.on_disk)
+
+    def hnsw_config(self) -> models.HnswConfigDiff:
+        return models.HnswConfigDiff(m=self.hnsw_m, ef_construct=self.hnsw_ef_construct, on_disk=self.hnsw_on_disk)
+
+    def quantization_config(self):
+        if self.quantization == "scalar":
+            return models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+            )
+        if self.quantization == "binary":
+            return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+        return None
+
+    def search_params(self, hnsw_ef: int = None) -> models.SearchParams:
+        quantization = None
+        if self.quantization:
+            quantization = models.QuantizationSearchParams(rescore=self.rescore, oversampling=self.oversampling)
+        return models.SearchParams(hnsw_ef=hnsw_ef or self.search_ef, quantization=quantization)
+
+    def estimate_memory(self, n_vectors: int, dim: int) -> dict:
+        """
+            Rough resident bytes for the vectors and HNSW links of `n_vectors` points.
+            Original vectors stored on disk are only read to rescore, so they are counted as disk.
+        """
+        original = n_vectors * dim * 4
+        quantized = {"scalar": n_vectors * dim, "binary": n_vectors * dim // 8}.get(self.quantization, 0)
+        links = n_vectors * self.hnsw_m * 2 * 4
+        return {
+            "ram_bytes": quantized + (0 if self.on_disk else original) + (0 if self.hnsw_on_disk else links),
+            "disk_bytes": original + links,
+        }
+
+
+PROFILES = {
+    # Plain float32 vectors in RAM, same as the original collection
+    "default": CollectionProfile("default"),
+    # int8 copies in RAM (4x smaller), float32 originals on disk for rescoring
+    "int8": CollectionProfile("int8", on_disk=True, quantization="scalar", oversampling=1.5),
+    # 1 bit per dimension in RAM (32x smaller), needs more oversampling to keep recall
+    "binary": CollectionProfile("binary", on_disk=True, quantization="binary", oversampling=3.0),
+    # Everything on disk, smallest RAM footprint, slowest queries
+    "on_disk": CollectionProfile("on_disk", on_disk=True, hnsw_on_disk=True),
+    # Denser graph for higher recall at the same ef
+    "high_recall": CollectionProfile("high_recall", hnsw_m=32, hnsw_ef_construct=256, search_ef=256),
+}
+
+
+def get_profile(profile) -> CollectionProfile:
+    if isinstance(profile, CollectionProfile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"Unknown collection profile: {profile}. Choose from {', '.join(PROFILES)}")
+
+
+# -----
+# Evaluation
+# -----
+
+EXACT_SEARCH = models.SearchParams(exact=True, quantization=models.QuantizationSearchParams(ignore=True))
+
+
+def sample_query_vectors(client, collection_name: str, max_id: int, sample_size: int = 100, seed: int = 0) -> list:
+    """
+        Use stored vectors as queries, so the evaluation runs on the mailbox's own data.
+        Returns (point id, vector) pairs; evaluate_profile leaves the point itself out of the results.
+    """
+    rng = random.Random(seed)
+    ids = rng.sample(range(max_id), min(max_id, sample_size * 2))
+    records = client.retrieve(collection_name=collection_name, ids=ids, with_vectors=True, with_payload=False)
+    return [(record.id, record.vector) for record in records[:sample_size]]
+
+
+def _search_ids(client, collection_name: str, vector, limit: int, params, exclude) -> tuple:
+    """
+        Ids of the top `limit` hits other than `exclude`, and the search latency in milliseconds.
+    """
+    start = time.perf_counter()
+    hits = client.search(collection_name=collection_name, query_vector=vector, limit=limit + (exclude is not None),
+                         search_params=params)
+    latency = (time.perf_counter() - start) * 1000
+    return [hit.id for hit in hits if hit.id != exclude][:limit], latency
+
+
+def evaluate_profile(client, collection_name: str, profile, queries: list, limit: int = 10,
+                     ef_values: list = None) -> list:
+    """
+        Measure recall@limit against exact search, and per-query latency, for each search-time ef.
+        `queries` are (point id, vector) pairs from sample_query_vectors, or (None, vector) for vectors that
+        are not in the collection. A query's own point is its trivial nearest neighbour, so it is left out
+        of both rankings; counting it would inflate recall, most of all for quantized profiles.
+        Returns one dict per ef value with recall and p50/p95 latency in milliseconds.
+    """
+    profile = get_profile(profile)
+    truth = []
+    for query_id, vector in queries:
+        ids, _ = _search_ids(client, collection_name, vector, limit, EXACT_SEARCH, query_id)
+        truth.append(set(ids))
+
+    results = []
+    for ef in ef_values or [profile.search_ef]:
+        params = profile.search_params(hnsw_ef=ef)
+        recalls, latencies = [], []
+        for (query_id, vector), expected in zip(queries, truth):
+            ids, latency = _search_ids(client, collection_name, vector, limit, params, query_id)
+            latencies.append(latency)
+            recalls.append(len(expected & set(ids)) / max(1, len(expected)))
+        results.append({
+            "profile": profile.name,
+            "hnsw_ef": ef,
+            "limit": limit,
+            "queries": len(queries),
+            "recall": float(np.mean(recalls)) if recalls else 0.0,
+            "p50_ms": float(np.percentile(latencies, 50)) if latencies else 0.0,
+            "p95_ms": float(np.percentile(latencies, 95)) if latencies else 0.0,
+        })
+    return results
+
+
+if __name__ == "__main__":
+    import mbox_util
+    from vector_db_repository import VectorDBRepository
+
+    name = input(f"Profile ({', '.join(PROFILES)}): ") or "default"
+    vdb = VectorDBRepository("emails", use_embedding_cache=False, profile=name)
+    count = vdb.count()
+    print(f"Collection has {count} documents")
+    for profile_name, profile in PROFILES.items():
+        memory = profile.estimate_memory(count, mbox_util.EMBEDDING_DIM)
+        print(f"{profile_name:12} RAM {memory['ram_bytes'] / 1024 ** 2:10.1f} MiB   disk {memory['disk_bytes'] / 1024 ** 2:10.1f} MiB")
+
+    queries = sample_query_vectors(vdb.client, vdb.collection_name, mbox_util.get_mbox_count())
+    print(f"\nEvaluating '{name}' with {len(queries)} sampled queries")
+    for row in evaluate_profile(vdb.client, vdb.collection_name, name, queries, ef_values=[16, 32, 64, 128, 256]):
+        print(f"ef={row['hnsw_ef']:4}  recall@{row['limit']}={row['recall']:.3f}  p50={row['p50_ms']:.2f}ms  p95={row['p95_ms']:.2f}ms")
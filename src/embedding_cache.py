@@ -0,0 +1,157 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+"""
+    Content-addressed embedding cache
+    - Key: sha256 of the model name and the exact text sent to the model
+    - Index: SQLite table mapping key -> row slot in the vector matrix
+    - Vectors: memory-mapped float32 matrix, grown on demand
+    - Eviction: least recently used entries once the matrix would exceed `max_bytes`
+
+    The cache lives outside Qdrant and the CSV log, so deleting and rebuilding the collection
+    only re-runs the model for text it has never seen before.
+"""
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+_INITIAL_CAPACITY = 4096
+_EVICT_FRACTION = 0.1
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str, model_name: str, dim: int, max_bytes: int = DEFAULT_MAX_BYTES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.model_name = model_name
+        self.dim = dim
+        self.max_entries = max(1, max_bytes // (dim * 4))
+        self.matrix_path = os.path.join(cache_dir, "vectors.f32")
+
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite3"))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, slot INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS free_slots (slot INTEGER PRIMARY KEY)")
+        self.db.commit()
+
+        self._matrix = None
+        self._open_matrix(min(_INITIAL_CAPACITY, self.max_entries))
+
+    # -----
+    # Storage
+    # -----
+
+    def _open_matrix(self, min_capacity: int):
+        rows = os.path.getsize(self.matrix_path) // (self.dim * 4) if os.path.exists(self.matrix_path) else 0
+        capacity = max(rows, min_capacity)
+        if capacity > rows or self._matrix is None:
+            if self._matrix is not None:
+                self._matrix.flush()
+                del self._matrix
+            mode = "r+" if os.path.exists(self.matrix_path) else "w+"
+            if mode == "r+" and capacity > rows:
+                with open(self.matrix_path, "r+b") as f:
+                    f.truncate(capacity * self.dim * 4)
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.sha256(self.model_name.encode() + b"\0" + text.encode("utf-8", errors="surrogatepass")).digest()
+
+    def _allocate_slots(self, n: int) -> list:
+        count = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count + n > self.max_entries:
+            self._evict(count + n - self.max_entries)
+
+        slots = [row[0] for row in self.db.execute("SELECT slot FROM free_slots ORDER BY slot LIMIT ?", (n,))]
+        self.db.executemany("DELETE FROM free_slots WHERE slot = ?", [(s,) for s in slots])
+
+        needed = n - len(slots)
+        if needed:
+            # Every free slot has been taken, so everything below the highest used slot is occupied
+            next_slot = self.db.execute("SELECT COALESCE(MAX(slot) + 1, 0) FROM entries").fetchone()[0]
+            next_slot = max([next_slot] + [s + 1 for s in slots])
+            slots += list(range(next_slot, next_slot + needed))
+            if slots[-1] >= len(self._matrix):
+                self._open_matrix(max(slots[-1] + 1, min(2 * len(self._matrix), self.max_entries)))
+        return slots
+
+    def _evict(self, n: int):
+        """
+            Drop at least `n` least recently used entries, in chunks so eviction is not paid on every insert.
+        """
+        n = max(n, int(self.max_entries * _EVICT_FRACTION))
+        rows = self.db.execute("SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (n,)).fetchall()
+        self.db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in rows])
+        self.db.executemany("INSERT OR IGNORE INTO free_slots (slot) VALUES (?)", [(slot,) for _, slot in rows])
+
+    # -----
+    # Lookup
+    # -----
+
+    def get_many(self, texts: list) -> tuple:
+        """
+            Look up cached vectors. Returns (vectors, missing) where `missing` lists the positions
+            in `texts` that were not cached; their rows in `vectors` are zero.
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        missing = []
+        now = time.time()
+        hits = []
+        for i, text in enumerate(texts):
+            key = self._key(text)
+            row = self.db.execute("SELECT slot FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                missing.append(i)
+            else:
+                vectors[i] = self._matrix[row[0]]
+                hits.append((now, key))
+        if hits:
+            self.db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", hits)
+            self.db.commit()
+        return vectors, missing
+
+    def put_many(self, texts: list, vectors):
+        """
+            Store vectors for texts. Texts already in the cache are skipped.
+        """
+        unique = {}
+        for text, vector in zip(texts, vectors):
+            key = self._key(text)
+            if key not in unique and self.db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is None:
+                unique[key] = vector
+        if not unique:
+            return
+
+        slots = self._allocate_slots(len(unique))
+        now = time.time()
+        for slot, vector in zip(slots, unique.values()):
+            self._matrix[slot] = vector
+        self._matrix.flush()
+
+        self.db.executemany(
+            "INSERT OR REPLACE INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+            [(key, slot, now) for key, slot in zip(unique.keys(), slots)]
+        )
+        self.db.commit()
+
+    def embed(self, texts: list, embed_fn) -> np.ndarray:
+        """
+            Return vectors for all texts, calling `embed_fn(list_of_texts) -> np.ndarray` only for cache misses.
+        """
+        vectors, missing = self.get_many(texts)
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            new_vectors = np.asarray(embed_fn(missing_texts), dtype=np.float32)
+            vectors[missing] = new_vectors
+            self.put_many(missing_texts, new_vectors)
+        return vectors
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        if self._matrix is not None:
+            self._matrix.flush()
+        self.db.close()
@@ -0,0 +1,86 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+"""
+    Multi-process extraction stage
+    - Runs a CPU heavy function (HTML/PDF/DOCX parsing) over a stream of items in worker processes
+    - At most `max_pending` items are in flight, so a slow consumer pushes back on the reader
+    - Results come back in input order, so the mbox index of every record stays resumable
+    - A running task cannot be cancelled, so on a timeout the pool is replaced: its workers are killed
+      and the items that were still in flight are submitted to the new one
+"""
+
+DEFAULT_PENDING_PER_WORKER = 4
+
+
+def default_workers() -> int:
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def imap_ordered(fn, items, workers: int = None, max_pending: int = None, timeout: float = None,
+                 initializer=None, initargs: tuple = (), on_timeout=None):
+    """
+        Apply `fn` to every item in worker processes and yield the results in input order.
+        - workers: number of worker processes (None = one less than the number of cores)
+        - max_pending: bound on submitted-but-not-yielded items (None = DEFAULT_PENDING_PER_WORKER per worker)
+        - timeout: seconds to wait for any single result once it is at the head of the queue
+        - on_timeout: called with the item that timed out, its return value is yielded in its place
+    """
+    workers = workers or default_workers()
+    max_pending = max_pending or workers * DEFAULT_PENDING_PER_WORKER
+
+    # fork keeps already imported modules (and the mbox index) in the children for free
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+
+    def start():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initializer, initargs=initargs)
+
+    executor = start()
+    pending = deque()
+
+    def next_result():
+        nonlocal executor
+        item, future = pending.popleft()
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            executor = _recycle(executor, start, fn, pending)
+            if on_timeout is None:
+                raise
+            return on_timeout(item)
+
+    try:
+        for item in items:
+            pending.append((item, executor.submit(fn, item)))
+            if len(pending) >= max_pending:
+                yield next_result()
+
+        while pending:
+            yield next_result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _recycle(executor, start, fn, pending: deque):
+    """
+        Kill the workers of `executor` (one of them is stuck) and return a new pool. Pending items that had
+        not finished are submitted again, in place, so the results keep their order.
+    """
+    finished = {id(future) for _, future in pending if future.done()}
+    # ProcessPoolExecutor has no public way to stop a running task
+    processes = list((executor._processes or {}).values())
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    executor = start()
+    for n, (item, future) in enumerate(pending):
+        if id(future) not in finished:
+            pending[n] = (item, executor.submit(fn, item))
+    return executor
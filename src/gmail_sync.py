@@ -0,0 +1,437 @@
+import argparse
+import base64
+import json
+import os
+import pickle
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import chunking
+import metrics
+import mbox_util
+
+"""
+    Incremental Gmail sync into the ingest pipeline
+    - First run: every message id from messages.list. The profile's historyId is read before listing,
+      so mail that arrives while listing is picked up by the next run
+    - Later runs: only the messages added since the stored historyId (history.list). A historyId Gmail
+      no longer keeps (404) falls back to a full listing; messages already in the journal are not fetched again.
+      So does a collection whose journal has no Gmail messages, e.g. after delete_collection
+    - Raw messages are fetched through the batch endpoint, GMAIL_BATCH_SIZE gets per HTTP request and
+      GMAIL_FETCH_WORKERS requests in flight over one pooled session
+    - 429s, 5xx responses, rate-limit 403s and connection errors are retried with exponential backoff
+      (Retry-After when the server sends one), for whole requests and for single parts of a batch
+    - Messages go through mbox_util.stream_raw_records, so triage, cleaning, metadata, dedupe,
+      threading and embedding are the same as for the mbox
+    - GMAIL_API_URL points the client at another server, e.g. mock_gmail
+
+    The token is the one fastapi-gmail stores after the OAuth callback (GMAIL_TOKEN_FILE),
+    or GMAIL_ACCESS_TOKEN for a plain bearer token.
+
+    Run from the src directory:  python gmail_sync.py [--collection emails] [--full]
+"""
+
+GMAIL_API_URL = os.getenv("GMAIL_API_URL", "https://gmail.googleapis.com")
+GMAIL_TOKEN_FILE = os.getenv("GMAIL_TOKEN_FILE", os.path.join(mbox_util.BASE_DIR, "fastapi-gmail", "token.pickle"))
+GMAIL_SYNC_STATE_DIR = os.path.join(mbox_util.BASE_DIR, "cache", "gmail")
+# Gmail accepts 100 calls per batch but recommends at most 50 to stay under the per-user rate limit
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", 50))
+GMAIL_FETCH_WORKERS = int(os.getenv("GMAIL_FETCH_WORKERS", 4))
+GMAIL_MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", 6))
+GMAIL_BACKOFF = float(os.getenv("GMAIL_BACKOFF", 1.0))
+GMAIL_TIMEOUT = float(os.getenv("GMAIL_TIMEOUT", 60))
+
+LIST_PAGE_SIZE = 500
+EXCLUDED_LABELS = frozenset({"SPAM", "TRASH", "DRAFT"})
+RATE_LIMIT_REASONS = frozenset({"rateLimitExceeded", "userRateLimitExceeded"})
+# Gmail ids are 64-bit hex. Point ids keep their low bits under a high marker bit, so they are far above any
+# mbox index, and passage ids (point id * MAX_PASSAGES + passage) still fit a signed SQLite integer
+POINT_ID_BITS = 63 - (chunking.MAX_PASSAGES - 1).bit_length()
+POINT_ID_BASE = 1 << (POINT_ID_BITS - 1)
+POINT_ID_MASK = POINT_ID_BASE - 1
+
+
+class GmailError(Exception):
+    def __init__(self, status: int, message: str):
+        self.status = status
+        super().__init__(f"Gmail API error {status}: {message}")
+
+
+class HistoryExpired(GmailError):
+    pass
+
+
+def gmail_point_id(message_id: str) -> int:
+    return POINT_ID_BASE | (int(message_id, 16) & POINT_ID_MASK)
+
+
+def assign_point_ids(journal, message_ids: list) -> dict:
+    """
+        {point id: message id} for the messages, from the gmail_ids of the collection's ingest journal.
+        New messages get gmail_point_id, or the next free id when two Gmail ids share their low bits.
+    """
+    known = journal.gmail_ids()
+    taken = set(known.values())
+    point_ids, new = {}, []
+    for message_id in dict.fromkeys(message_ids):
+        point_id = known.get(message_id)
+        if point_id is None:
+            point_id = gmail_point_id(message_id)
+            while point_id in taken:
+                point_id = POINT_ID_BASE | ((point_id + 1) & POINT_ID_MASK)
+            taken.add(point_id)
+            new.append((point_id, message_id))
+        point_ids[point_id] = message_id
+    journal.add_gmail_ids(new)
+    return point_ids
+
+
+def decode_raw(raw: str) -> bytes:
+    return base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4))
+
+
+def to_mbox_bytes(raw: bytes) -> bytes:
+    """
+        RFC 822 bytes as an mbox stores them: a From_ line first and LF line endings.
+    """
+    return b"From gmail-sync " + time.asctime(time.gmtime()).encode() + b"\n" + raw.replace(b"\r\n", b"\n")
+
+
+def load_credentials(path: str = GMAIL_TOKEN_FILE):
+    """
+        GMAIL_ACCESS_TOKEN when set, otherwise the google.oauth2 credentials pickled by fastapi-gmail.
+    """
+    token = os.getenv("GMAIL_ACCESS_TOKEN")
+    if token:
+        return token
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _error_reason(body: dict) -> str:
+    errors = (body.get("error") or {}).get("errors") or [{}]
+    return errors[0].get("reason", "")
+
+
+def _retry_delay(status: int, headers, body: dict, attempt: int, backoff: float):
+    """
+        Seconds to wait before retrying a response, or None when it should not be retried.
+    """
+    if not (status == 429 or status >= 500 or (status == 403 and _error_reason(body) in RATE_LIMIT_REASONS)):
+        return None
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return backoff * (2 ** attempt) + random.uniform(0, backoff)
+
+
+def _json(content: bytes) -> dict:
+    try:
+        return json.loads(content or b"{}")
+    except ValueError:
+        return {}
+
+
+# -----
+# Batch requests
+# -----
+
+def build_batch_body(paths: list, boundary: str) -> bytes:
+    parts = [
+        f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <item{n}>\r\n\r\nGET {path}\r\n\r\n"
+        for n, path in enumerate(paths)
+    ]
+    return ("".join(parts) + f"--{boundary}--\r\n").encode()
+
+
+def parse_batch_response(content_type: str, body: bytes) -> dict:
+    """
+        {part number: (status, headers, body bytes)} from a multipart/mixed batch response.
+    """
+    message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    responses = {}
+    for part in message.get_payload():
+        content_id = re.search(r"item(\d+)", part.get("Content-ID", ""))
+        if content_id is None:
+            continue
+        # An embedded HTTP response: status line, headers, blank line, body (JSON, so no literal line breaks)
+        http = (part.get_payload(decode=True) or b"").replace(b"\r\n", b"\n")
+        head, _, content = http.partition(b"\n\n")
+        status_line, *header_lines = head.decode("latin-1").splitlines()
+        headers = {name.strip(): value.strip() for name, _, value in (line.partition(":") for line in header_lines)}
+        responses[int(content_id.group(1))] = (int(status_line.split()[1]), headers, content)
+    return responses
+
+
+# -----
+# Client
+# -----
+
+class GmailClient:
+    def __init__(self, credentials, base_url: str = GMAIL_API_URL, user: str = "me", workers: int = GMAIL_FETCH_WORKERS,
+                 batch_size: int = GMAIL_BATCH_SIZE, max_retries: int = GMAIL_MAX_RETRIES, backoff: float = GMAIL_BACKOFF,
+                 timeout: float = GMAIL_TIMEOUT):
+        self.credentials = credentials
+        self.base_url = base_url.rstrip("/")
+        self.user = user
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._token_lock = threading.Lock()
+        # One connection per fetch worker, reused for every request
+        self.session = requests.Session()
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1)))
+
+    def _access_token(self, refresh: bool = False) -> str:
+        if isinstance(self.credentials, str):
+            return self.credentials
+        with self._token_lock:
+            if refresh or not self.credentials.valid:
+                from google.auth.transport.requests import Request
+                self.credentials.refresh(Request())
+            return self.credentials.token
+
+    def _request(self, method: str, path: str, headers: dict = None, **kwargs) -> requests.Response:
+        refreshed = False
+        for attempt in range(self.max_retries + 1):
+            request_headers = {**(headers or {}), "Authorization": f"Bearer {self._access_token()}"}
+            try:
+                response = self.session.request(method, self.base_url + path, headers=request_headers,
+                                                timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                metrics.count("gmail_retries_total", reason=type(e).__name__)
+                time.sleep(self.backoff * (2 ** attempt))
+                continue
+            metrics.count("gmail_requests_total", status=response.status_code)
+            if response.ok:
+                return response
+            body = _json(response.content)
+            if response.status_code == 401 and not refreshed and not isinstance(self.credentials, str):
+                self._access_token(refresh=True)
+                refreshed = True
+                continue
+            delay = _retry_delay(response.status_code, response.headers, body, attempt, self.backoff)
+            if delay is None or attempt == self.max_retries:
+                message = (body.get("error") or {}).get("message", response.reason)
+                error = HistoryExpired if response.status_code == 404 and path.endswith("/history") else GmailError
+                raise error(response.status_code, message)
+            metrics.count("gmail_retries_total", reason=str(response.status_code))
+            time.sleep(delay)
+
+    def _get(self, path: str, params: dict = None) -> dict:
+        return self._request("GET", f"/gmail/v1/users/{self.user}{path}", params=params).json()
+
+    def profile(self) -> dict:
+        return self._get("/profile")
+
+    def list_message_ids(self, query: str = None) -> list:
+        """
+            Every message id (newest first, as Gmail lists them), spam and trash excluded.
+        """
+        ids, page_token = [], None
+        while True:
+            params = {"maxResults": LIST_PAGE_SIZE, "pageToken": page_token, "q": query}
+            page = self._get("/messages", {k: v for k, v in params.items() if v is not None})
+            ids.extend(message["id"] for message in page.get("messages", []))
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return ids
+
+    def history(self, start_history_id: str) -> tuple:
+        """
+            (ids of messages added since `start_history_id`, latest historyId).
+            Raises HistoryExpired when Gmail no longer has history that old.
+        """
+        ids, seen, page_token, history_id = [], set(), None, start_history_id
+        while True:
+            params = {"startHistoryId": start_history_id, "historyTypes": "messageAdded", "maxResults": LIST_PAGE_SIZE}
+            if page_token:
+                params["pageToken"] = page_token
+            page = self._get("/history", params)
+            for record in page.get("history", []):
+                for added in record.get("messagesAdded", []):
+                    message = added["message"]
+                    if message["id"] not in seen and not EXCLUDED_LABELS.intersection(message.get("labelIds", [])):
+                        seen.add(message["id"])
+                        ids.append(message["id"])
+            history_id = page.get("historyId", history_id)
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return ids, history_id
+
+    @metrics.timed("gmail_batch")
+    def _fetch_batch(self, message_ids: list) -> list:
+        """
+            (id, raw RFC 822 bytes) for one batch, in the given order. Parts that were rate limited are
+            sent again in a smaller batch; messages deleted since they were listed (404) are left out.
+        """
+        raws, remaining = {}, list(message_ids)
+        for attempt in range(self.max_retries + 1):
+            boundary = f"batch_{uuid.uuid4().hex}"
+            paths = [f"/gmail/v1/users/{self.user}/messages/{message_id}?format=raw" for message_id in remaining]
+            response = self._request("POST", "/batch/gmail/v1", data=build_batch_body(paths, boundary),
+                                     headers={"Content-Type": f"multipart/mixed; boundary={boundary}"})
+            parts = parse_batch_response(response.headers["Content-Type"], response.content)
+            retry, delay = [], 0.0
+            for n, message_id in enumerate(remaining):
+                status, headers, content = parts.get(n, (500, {}, b""))
+                body = _json(content)
+                if status == 200:
+                    raws[message_id] = decode_raw(body["raw"])
+                    continue
+                part_delay = _retry_delay(status, headers, body, attempt, self.backoff)
+                if part_delay is not None:
+                    retry.append(message_id)
+                    delay = max(delay, part_delay)
+                elif status != 404:
+                    raise GmailError(status, (body.get("error") or {}).get("message", f"fetching message {message_id}"))
+            if not retry:
+                break
+            if attempt == self.max_retries:
+                raise GmailError(429, f"{len(retry)} messages still rate limited after {attempt + 1} attempts")
+            metrics.count("gmail_retries_total", len(retry), reason="batch part")
+            remaining = retry
+            time.sleep(delay)
+        metrics.count("gmail_messages_fetched_total", len(raws))
+        metrics.count("gmail_bytes_fetched_total", sum(len(raw) for raw in raws.values()))
+        return [(message_id, raws[message_id]) for message_id in message_ids if message_id in raws]
+
+    def fetch_raw(self, message_ids: list):
+        """
+            Yield (id, raw bytes) for the ids in order, with up to two batches per worker in flight.
+        """
+        batches = [message_ids[n:n + self.batch_size] for n in range(0, len(message_ids), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1), thread_name_prefix="gmail-fetch") as executor:
+            in_flight = deque()
+            for batch in batches:
+                in_flight.append(executor.submit(self._fetch_batch, batch))
+                if len(in_flight) >= 2 * max(self.workers, 1):
+                    yield from in_flight.popleft().result()
+            while in_flight:
+                yield from in_flight.popleft().result()
+
+    def close(self):
+        self.session.close()
+
+
+# -----
+# Sync
+# -----
+
+class SyncState:
+    """
+        The historyId the next incremental sync starts from, per collection.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.data = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+
+    @property
+    def history_id(self):
+        return self.data.get("history_id")
+
+    def save(self, history_id: str, **info):
+        self.data = {**self.data, **info, "history_id": history_id, "synced_at": time.time()}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        self.data = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def state_path(collection_name: str) -> str:
+    return os.path.join(GMAIL_SYNC_STATE_DIR, f"{collection_name}.json")
+
+
+def sync(repository, client: GmailClient, state: SyncState, full: bool = False) -> dict:
+    """
+        Fetch and ingest the messages added since the last sync (all of them on the first run) and
+        store the new historyId once they are written. An interrupted sync starts from the old historyId
+        again; messages it already stored are skipped without being fetched. A message that cannot be
+        extracted or ingested is journaled as skipped, so it is not fetched again on every sync.
+    """
+    repository.create_collection()
+    message_ids, history_id = None, None
+    if state.history_id is not None and not full and not repository.journal.gmail_ids():
+        # The collection was deleted or rebuilt since the last sync: the history after it is not enough
+        print("No Gmail messages in the collection's journal, listing every message instead.")
+        # Dropped now, so a listing that is interrupted is not followed by an incremental sync
+        state.clear()
+    elif state.history_id is not None and not full:
+        try:
+            message_ids, history_id = client.history(state.history_id)
+        except HistoryExpired:
+            print(f"History from {state.history_id} is no longer available, listing every message instead.")
+    if message_ids is None:
+        # Read before listing: anything that arrives meanwhile is in the next incremental sync
+        profile = client.profile()
+        history_id = profile["historyId"]
+        message_ids = client.list_message_ids()
+
+    point_ids = assign_point_ids(repository.journal, message_ids)
+    done = repository.journal.done_indices(min(point_ids)) if point_ids else set()
+    # Ascending Gmail ids are roughly oldest first, so replies usually arrive after what they reply to
+    todo = sorted((message_id for point_id, message_id in point_ids.items() if point_id not in done),
+                  key=lambda message_id: int(message_id, 16))
+
+    fetched = 0
+    message_point_ids = {message_id: point_id for point_id, message_id in point_ids.items()}
+
+    def raw_records():
+        nonlocal fetched
+        for message_id, raw in client.fetch_raw(todo):
+            fetched += 1
+            yield message_point_ids[message_id], to_mbox_bytes(raw)
+
+    repository.ingest_raw_messages(raw_records(), done=done)
+    state.save(history_id, collection=repository.collection_name)
+    return {"listed": len(message_ids), "already_ingested": len(point_ids) - len(todo), "fetched": fetched,
+            "history_id": history_id}
+
+
+if __name__ == "__main__":
+    from vector_db_repository import VectorDBRepository
+
+    arg_parser = argparse.ArgumentParser(description="Incremental Gmail sync into a collection")
+    arg_parser.add_argument("--collection", default="emails")
+    arg_parser.add_argument("--full", action="store_true", help="list every message instead of the history since the last sync")
+    arg_parser.add_argument("--base-url", default=GMAIL_API_URL)
+    arg_parser.add_argument("--workers", type=int, default=GMAIL_FETCH_WORKERS)
+    arg_parser.add_argument("--batch-size", type=int, default=GMAIL_BATCH_SIZE)
+    arg_parser.add_argument("--token-file", default=GMAIL_TOKEN_FILE)
+    args = arg_parser.parse_args()
+
+    client = GmailClient(load_credentials(args.token_file), base_url=args.base_url, workers=args.workers,
+                         batch_size=args.batch_size)
+    repository = VectorDBRepository(args.collection)
+    start = time.perf_counter()
+    try:
+        result = sync(repository, client, SyncState(state_path(args.collection)), full=args.full)
+    finally:
+        client.close()
+    print(f"Listed {result['listed']}, already ingested {result['already_ingested']}, fetched {result['fetched']} "
+          f"in {time.perf_counter() - start:.1f}s. Next sync starts from historyId {result['history_id']}.")
@@ -0,0 +1,199 @@
+import os, pathlib
+import sqlite3
+import threading
+import time
+
+import csv_logging_repository
+
+"""
+    Append-only ingest journal (SQLite in WAL mode)
+    - messages: one row per mbox index with its status (pending / committed / skipped), skip reason,
+      content hash and the batch it was written in
+    - batches: one row per flushed batch, `committed_at` is set once its upsert has succeeded
+    - meta: the resume watermark, every index below it is committed or skipped, and the generation,
+      bumped whenever points are written or the collection is reset, so other processes (search_service)
+      can tell that their cached results are stale
+    - gmail_ids: the point id each Gmail message was given (see gmail_sync), cleared with the collection
+
+    Recording a batch touches only that batch's rows, and resume starts from the first index that
+    is not done, so a failed or interrupted upsert is simply re-processed on the next run.
+"""
+
+BASE_DIR = pathlib.Path(__file__).resolve().parent
+
+PENDING = "pending"
+COMMITTED = "committed"
+SKIPPED = "skipped"
+
+
+def journal_path(collection_name: str) -> str:
+    return os.path.join(BASE_DIR, f"{collection_name}_journal.sqlite3")
+
+
+class IngestJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                idx INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                reason TEXT,
+                content_hash TEXT,
+                batch_id INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS batches (
+                batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                committed_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS gmail_ids (
+                point_id INTEGER PRIMARY KEY,
+                message_id TEXT NOT NULL UNIQUE
+            );
+        """)
+        self.db.commit()
+        self._import_legacy_csv()
+
+    def _import_legacy_csv(self):
+        """
+            Carry over the resume point from process_log.csv the first time the journal is opened
+        """
+        if self._get_meta("watermark") is not None:
+            return
+        watermark = 0
+        try:
+            processed, skipped = csv_logging_repository.read_stats()
+            watermark = int(processed) + int(skipped)
+        except (OSError, KeyError, ValueError, IndexError):
+            pass
+        with self._lock:
+            self._set_meta("watermark", watermark)
+            self.db.commit()
+
+    def _get_meta(self, key: str):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: int):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _bump_generation(self):
+        self._set_meta("generation", (self._get_meta("generation") or 0) + 1)
+
+    def generation(self) -> int:
+        with self._lock:
+            return self._get_meta("generation") or 0
+
+    # -----
+    # Recording
+    # -----
+
+    def record_skipped(self, idx: int, reason: str):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO messages (idx, status, reason) VALUES (?, ?, ?)",
+                (idx, SKIPPED, reason)
+            )
+            self._advance_watermark()
+            self.db.commit()
+
+    def begin_batch(self, records: list) -> int:
+        """
+            Record a batch of (idx, content_hash) as pending and return its batch id.
+        """
+        with self._lock:
+            cursor = self.db.execute(
+                "INSERT INTO batches (size, created_at) VALUES (?, ?)",
+                (len(records), time.time())
+            )
+            batch_id = cursor.lastrowid
+            self.db.executemany(
+                "INSERT OR REPLACE INTO messages (idx, status, content_hash, batch_id) VALUES (?, ?, ?, ?)",
+                [(idx, PENDING, content_hash, batch_id) for idx, content_hash in records]
+            )
+            self.db.commit()
+            return batch_id
+
+    def commit_batch(self, batch_id: int):
+        with self._lock:
+            self.db.execute("UPDATE batches SET committed_at = ? WHERE batch_id = ?", (time.time(), batch_id))
+            self.db.execute("UPDATE messages SET status = ? WHERE batch_id = ?", (COMMITTED, batch_id))
+            self._advance_watermark()
+            self._bump_generation()
+            self.db.commit()
+
+    def _advance_watermark(self):
+        watermark = self._get_meta("watermark") or 0
+        rows = self.db.execute(
+            "SELECT idx FROM messages WHERE idx >= ? AND status != ? ORDER BY idx",
+            (watermark, PENDING)
+        )
+        for (idx,) in rows:
+            if idx != watermark:
+                break
+            watermark += 1
+        self._set_meta("watermark", watermark)
+
+    def reset(self):
+        with self._lock:
+            self.db.executescript("DELETE FROM messages; DELETE FROM batches; DELETE FROM gmail_ids;")
+            self._set_meta("watermark", 0)
+            self._bump_generation()
+            self.db.commit()
+
+    # -----
+    # Resume
+    # -----
+
+    def resume_point(self) -> int:
+        """
+            First mbox index that is neither committed nor skipped.
+        """
+        return self._get_meta("watermark") or 0
+
+    def done_indices(self, start: int) -> set:
+        """
+            Indices at or after `start` that are already committed or skipped, e.g. after a failed batch.
+        """
+        rows = self.db.execute("SELECT idx FROM messages WHERE idx >= ? AND status != ?", (start, PENDING))
+        return {idx for (idx,) in rows}
+
+    def stats(self) -> dict:
+        counts = dict(self.db.execute("SELECT status, COUNT(*) FROM messages GROUP BY status").fetchall())
+        return {
+            "watermark": self.resume_point(),
+            COMMITTED: counts.get(COMMITTED, 0),
+            SKIPPED: counts.get(SKIPPED, 0),
+            PENDING: counts.get(PENDING, 0),
+        }
+
+    # -----
+    # Gmail ids
+    # -----
+
+    def gmail_ids(self) -> dict:
+        """
+            {Gmail message id: point id} for every Gmail message given a point id since the last reset.
+        """
+        with self._lock:
+            return dict(self.db.execute("SELECT message_id, point_id FROM gmail_ids"))
+
+    def add_gmail_ids(self, point_ids: list):
+        """
+            Store (point id, Gmail message id) pairs for messages that have none yet.
+        """
+        with self._lock:
+            self.db.executemany("INSERT INTO gmail_ids (point_id, message_id) VALUES (?, ?)", point_ids)
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
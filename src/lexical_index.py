@@ -0,0 +1,153 @@
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+
+"""
+    BM25 inverted index in SQLite
+    - terms: term -> (term_id, document frequency)
+    - postings: (term_id, doc_id) -> term frequency, clustered by term so a query reads one range per term
+    - docs: doc_id -> document length
+    Documents can be added or replaced one batch at a time, so the index grows alongside the vectors.
+"""
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"[\w@.\-+]+")
+_STRIP = ".-+"
+
+
+def tokenize(text: str) -> list:
+    """
+        Lowercased words, numbers and email addresses; trailing punctuation is stripped so
+        "order 1234." and "bob@example.com," match their exact forms.
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        token = match.group().strip(_STRIP)
+        if token:
+            tokens.append(token)
+    return tokens
+
+
+class LexicalIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS terms (
+                term TEXT PRIMARY KEY,
+                term_id INTEGER UNIQUE NOT NULL,
+                df INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term_id INTEGER NOT NULL,
+                doc_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term_id, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id INTEGER PRIMARY KEY,
+                length INTEGER NOT NULL
+            );
+        """)
+        self.db.commit()
+
+    # -----
+    # Indexing
+    # -----
+
+    def add_documents(self, documents: list):
+        """
+            Add or replace (doc_id, text) documents in one transaction.
+        """
+        with self._lock:
+            for doc_id, text in documents:
+                self._remove(doc_id)
+                counts = Counter(tokenize(text))
+                self.db.execute("INSERT INTO docs (doc_id, length) VALUES (?, ?)", (doc_id, sum(counts.values())))
+                postings = []
+                for term, tf in counts.items():
+                    postings.append((self._term_id(term), doc_id, tf))
+                self.db.executemany("INSERT INTO postings (term_id, doc_id, tf) VALUES (?, ?, ?)", postings)
+                self.db.executemany("UPDATE terms SET df = df + 1 WHERE term_id = ?", [(p[0],) for p in postings])
+            self.db.commit()
+
+    def _term_id(self, term: str) -> int:
+        row = self.db.execute("SELECT term_id FROM terms WHERE term = ?", (term,)).fetchone()
+        if row:
+            return row[0]
+        term_id = self.db.execute("SELECT COALESCE(MAX(term_id) + 1, 0) FROM terms").fetchone()[0]
+        self.db.execute("INSERT INTO terms (term, term_id, df) VALUES (?, ?, 0)", (term, term_id))
+        return term_id
+
+    def _remove(self, doc_id: int):
+        if self.db.execute("SELECT 1 FROM docs WHERE doc_id = ?", (doc_id,)).fetchone() is None:
+            return
+        self.db.execute(
+            "UPDATE terms SET df = df - 1 WHERE term_id IN (SELECT term_id FROM postings WHERE doc_id = ?)",
+            (doc_id,)
+        )
+        self.db.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+        self.db.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+
+    def reset(self):
+        with self._lock:
+            self.db.executescript("DELETE FROM postings; DELETE FROM terms; DELETE FROM docs;")
+            self.db.commit()
+
+    # -----
+    # Search
+    # -----
+
+    def search(self, query: str, limit: int = 10) -> list:
+        """
+            Return [(doc_id, bm25 score)] for the best `limit` documents, best first.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        n_docs, total_length = self.db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+        if n_docs == 0:
+            return []
+        avg_length = total_length / n_docs
+
+        scores = {}
+        for term in terms:
+            row = self.db.execute("SELECT term_id, df FROM terms WHERE term = ?", (term,)).fetchone()
+            if row is None or row[1] == 0:
+                continue
+            term_id, df = row
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            postings = self.db.execute(
+                "SELECT p.doc_id, p.tf, d.length FROM postings p JOIN docs d ON d.doc_id = p.doc_id WHERE p.term_id = ?",
+                (term_id,)
+            )
+            for doc_id, tf, length in postings:
+                norm = tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * norm
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """
+        Fuse several ranked id lists into [(id, score)], best first. score = sum of 1 / (k + rank).
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,452 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+
+import numpy as np
+from qdrant_client.models import Batch, CountResult, GroupsResult, PointGroup, Record, ScoredPoint
+
+from search_filters import filter_key, matches_filter
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+"""
+    Embedded vector backend
+    - Implements the subset of the QdrantClient API that VectorDBRepository uses, so it can be passed
+      in place of a client and nothing else changes
+    - One directory per collection: a memory-mapped float32 or int8 vector matrix, meta.json,
+      and a SQLite table with point ids and payloads
+    - Search is a vectorized NumPy dot product over the matrix (vectors are normalized at insert,
+      so this is cosine similarity); with `hnsw=True` and hnswlib installed an in-memory HNSW graph
+      is used for unfiltered searches instead
+    - search_batch scores every query of a batch in the same pass over the matrix (one matrix product
+      per chunk of rows instead of one per query)
+
+    Meant for tests, benchmarks and small/medium mailboxes on a laptop, where a search never leaves the process.
+"""
+
+SCORE_CHUNK_ROWS = 65536
+# Queries scored together in search_batch; bounds the (rows x queries) score block
+BATCH_QUERY_CHUNK = 256
+_INITIAL_CAPACITY = 1024
+_INT8_SCALE = 127.0
+
+
+class LocalVectorClient:
+    def __init__(self, path: str, dtype: str = "float32", hnsw: bool = False, hnsw_m: int = 16,
+                 hnsw_ef_construct: int = 100, hnsw_ef: int = 64):
+        if dtype not in ("float32", "int8"):
+            raise ValueError("dtype must be 'float32' or 'int8'")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = dtype
+        self.hnsw = hnsw and hnswlib is not None
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construct = hnsw_ef_construct
+        self.hnsw_ef = hnsw_ef
+        self._collections = {}
+        self._lock = threading.RLock()
+
+    # -----
+    # Collection Management
+    # -----
+
+    def _collection_path(self, collection_name: str) -> str:
+        return os.path.join(self.path, collection_name)
+
+    def collection_exists(self, collection_name: str) -> bool:
+        return os.path.exists(os.path.join(self._collection_path(collection_name), "meta.json"))
+
+    def create_collection(self, collection_name: str, vectors_config, **kwargs) -> bool:
+        """
+            Qdrant-only options (quantization, HNSW, on-disk, ...) are accepted and ignored.
+        """
+        size = _config_value(vectors_config, "size")
+        distance = str(_config_value(vectors_config, "distance")).split(".")[-1].capitalize()
+        if distance not in ("Cosine", "Dot"):
+            raise ValueError(f"Unsupported distance for the local backend: {distance}")
+
+        if self.collection_exists(collection_name):
+            raise ValueError(f"Collection {collection_name} already exists")
+
+        with self._lock:
+            path = self._collection_path(collection_name)
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, "meta.json"), "w") as f:
+                json.dump({"size": size, "distance": distance, "dtype": self.dtype, "count": 0}, f)
+            self._collections.pop(collection_name, None)
+        return True
+
+    def delete_collection(self, collection_name: str) -> bool:
+        with self._lock:
+            collection = self._collections.pop(collection_name, None)
+            if collection is not None:
+                collection.close()
+            shutil.rmtree(self._collection_path(collection_name), ignore_errors=True)
+        return True
+
+    def create_payload_index(self, collection_name: str, field_name: str, field_schema=None, **kwargs):
+        # Filters are evaluated with a full payload scan, there is nothing to build
+        return None
+
+    def _get(self, collection_name: str) -> "_LocalCollection":
+        with self._lock:
+            collection = self._collections.get(collection_name)
+            if collection is None:
+                if not self.collection_exists(collection_name):
+                    raise ValueError(f"Collection {collection_name} not found")
+                collection = _LocalCollection(self._collection_path(collection_name), self)
+                self._collections[collection_name] = collection
+            return collection
+
+    def count(self, collection_name: str, **kwargs) -> CountResult:
+        return CountResult(count=len(self._get(collection_name)))
+
+    # -----
+    # Points
+    # -----
+
+    def upsert(self, collection_name: str, points, wait: bool = True, **kwargs):
+        if isinstance(points, Batch):
+            ids, vectors, payloads = points.ids, points.vectors, points.payloads or [None] * len(points.ids)
+        else:
+            ids = [_point_value(p, "id") for p in points]
+            vectors = [_point_value(p, "vector") for p in points]
+            payloads = [_point_value(p, "payload") for p in points]
+        self._get(collection_name).upsert(ids, np.asarray(vectors, dtype=np.float32), payloads)
+
+    def retrieve(self, collection_name: str, ids: list, with_payload: bool = True, with_vectors: bool = False, **kwargs) -> list:
+        collection = self._get(collection_name)
+        records = []
+        for point_id in ids:
+            row = collection.rows.get(point_id)
+            if row is None:
+                continue
+            records.append(Record(
+                id=point_id,
+                payload=collection.payloads[row] if with_payload else None,
+                vector=collection.vector(row).tolist() if with_vectors else None,
+            ))
+        return records
+
+    def set_payload(self, collection_name: str, payload: dict, points, wait: bool = True, **kwargs):
+        """
+            Merge `payload` into the payload of the selected points (ids or a Filter).
+        """
+        collection = self._get(collection_name)
+        collection.set_payload(collection.select_rows(points), payload)
+
+    def delete(self, collection_name: str, points_selector, wait: bool = True, **kwargs):
+        collection = self._get(collection_name)
+        collection.delete(collection.select_rows(points_selector))
+
+    # -----
+    # Search
+    # -----
+
+    def search(self, collection_name: str, query_vector, limit: int = 10, query_filter=None,
+               with_payload: bool = True, with_vectors: bool = False, **kwargs) -> list:
+        collection = self._get(collection_name)
+        rows, scores = collection.search(np.asarray(query_vector, dtype=np.float32), limit, query_filter)
+        return [collection.scored_point(row, score, with_payload, with_vectors) for row, score in zip(rows, scores)]
+
+    def search_batch(self, collection_name: str, requests: list, **kwargs) -> list:
+        """
+            One result list per qdrant_client.models.SearchRequest (vector, filter, limit, offset,
+            with_payload, with_vector, score_threshold), in request order.
+        """
+        collection = self._get(collection_name)
+        if not requests:
+            return []
+        queries = np.asarray([request.vector for request in requests], dtype=np.float32)
+        limits = [request.limit + (request.offset or 0) for request in requests]
+        results = []
+        for request, (rows, scores) in zip(requests, collection.search_many(queries, limits, [r.filter for r in requests])):
+            points = []
+            for row, score in list(zip(rows, scores))[request.offset or 0:]:
+                if request.score_threshold is not None and score < request.score_threshold:
+                    break
+                points.append(collection.scored_point(row, score, bool(request.with_payload), bool(request.with_vector)))
+            results.append(points)
+        return results
+
+    def search_groups(self, collection_name: str, query_vector, group_by: str, limit: int = 10, group_size: int = 1,
+                      query_filter=None, with_payload: bool = True, **kwargs) -> GroupsResult:
+        collection = self._get(collection_name)
+        rows, scores = collection.search(np.asarray(query_vector, dtype=np.float32), len(collection), query_filter)
+
+        groups = {}
+        for row, score in zip(rows, scores):
+            key = (collection.payloads[row] or {}).get(group_by)
+            if key is None:
+                continue
+            hits = groups.get(key)
+            if hits is None:
+                if len(groups) == limit:
+                    continue
+                hits = groups[key] = []
+            if len(hits) < group_size:
+                hits.append(collection.scored_point(row, score, with_payload, False))
+            if len(groups) == limit and all(len(h) == group_size for h in groups.values()):
+                break
+        return GroupsResult(groups=[PointGroup(id=key, hits=hits) for key, hits in groups.items()])
+
+
+class _LocalCollection:
+    def __init__(self, path: str, client: LocalVectorClient):
+        self.path = path
+        self.client = client
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.dim = self.meta["size"]
+        self.np_dtype = np.int8 if self.meta["dtype"] == "int8" else np.float32
+        self.normalize = self.meta["distance"] == "Cosine"
+        self.count = self.meta["count"]
+
+        self.db = sqlite3.connect(os.path.join(path, "points.sqlite3"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS points (row INTEGER PRIMARY KEY, id TEXT UNIQUE, payload TEXT)")
+        self.db.commit()
+
+        # Deleted points keep their row (with a NULL id) so row numbers stay dense; they are never returned
+        self.ids, self.payloads, self.rows, self.deleted = [], [], {}, set()
+        for row, point_id, payload in self.db.execute("SELECT row, id, payload FROM points ORDER BY row"):
+            point_id = json.loads(point_id) if point_id is not None else None
+            self.ids.append(point_id)
+            self.payloads.append(json.loads(payload) if payload else None)
+            if point_id is None:
+                self.deleted.add(row)
+            else:
+                self.rows[point_id] = row
+
+        self.matrix = None
+        self._open_matrix(max(_INITIAL_CAPACITY, self.count))
+        self.index = None
+
+    def __len__(self) -> int:
+        return self.count - len(self.deleted)
+
+    def _open_matrix(self, capacity: int):
+        matrix_path = os.path.join(self.path, "vectors.bin")
+        itemsize = np.dtype(self.np_dtype).itemsize
+        current = os.path.getsize(matrix_path) // (self.dim * itemsize) if os.path.exists(matrix_path) else 0
+        capacity = max(capacity, current)
+        if self.matrix is not None:
+            self.matrix.flush()
+            del self.matrix
+        with open(matrix_path, "ab") as f:
+            f.truncate(capacity * self.dim * itemsize)
+        self.matrix = np.memmap(matrix_path, dtype=self.np_dtype, mode="r+", shape=(capacity, self.dim))
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.normalize:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+        if self.np_dtype == np.int8:
+            return np.clip(np.rint(vectors * _INT8_SCALE), -127, 127).astype(np.int8)
+        return vectors
+
+    def vector(self, row: int) -> np.ndarray:
+        vector = self.matrix[row].astype(np.float32)
+        return vector / _INT8_SCALE if self.np_dtype == np.int8 else vector
+
+    def upsert(self, ids: list, vectors: np.ndarray, payloads: list):
+        with self.client._lock:
+            encoded = self._encode(vectors)
+            rows = []
+            for point_id, payload in zip(ids, payloads):
+                row = self.rows.get(point_id)
+                if row is None:
+                    row = self.count
+                    self.count += 1
+                    self.rows[point_id] = row
+                    self.ids.append(point_id)
+                    self.payloads.append(payload)
+                else:
+                    self.payloads[row] = payload
+                rows.append(row)
+
+            if self.count > len(self.matrix):
+                self._open_matrix(max(self.count, 2 * len(self.matrix)))
+            self.matrix[rows] = encoded
+            self.matrix.flush()
+
+            self.db.executemany(
+                "INSERT OR REPLACE INTO points (row, id, payload) VALUES (?, ?, ?)",
+                [(row, json.dumps(point_id), json.dumps(payload) if payload is not None else None)
+                 for row, point_id, payload in zip(rows, ids, payloads)]
+            )
+            self.db.commit()
+            self.meta["count"] = self.count
+            with open(os.path.join(self.path, "meta.json"), "w") as f:
+                json.dump(self.meta, f)
+
+            if self.index is not None:
+                self._add_to_index(rows)
+
+    def select_rows(self, selector) -> list:
+        """
+            Rows of the live points picked by a list of ids, a PointIdsList, a Filter or a FilterSelector.
+        """
+        selector = getattr(selector, "filter", None) or selector
+        if hasattr(selector, "must"):
+            mask = self.filter_mask(selector)
+            return [row for row in np.flatnonzero(mask).tolist() if row not in self.deleted]
+        ids = getattr(selector, "points", selector)
+        return [self.rows[point_id] for point_id in ids if point_id in self.rows]
+
+    def set_payload(self, rows: list, payload: dict):
+        with self.client._lock:
+            for row in rows:
+                self.payloads[row] = {**(self.payloads[row] or {}), **payload}
+            self.db.executemany(
+                "UPDATE points SET payload = ? WHERE row = ?",
+                [(json.dumps(self.payloads[row]), row) for row in rows]
+            )
+            self.db.commit()
+
+    def delete(self, rows: list):
+        with self.client._lock:
+            for row in rows:
+                del self.rows[self.ids[row]]
+                self.ids[row] = None
+                self.payloads[row] = None
+                self.deleted.add(row)
+                if self.index is not None:
+                    self.index.mark_deleted(row)
+            self.db.executemany("UPDATE points SET id = NULL, payload = NULL WHERE row = ?", [(row,) for row in rows])
+            self.db.commit()
+
+    # -----
+    # Search
+    # -----
+
+    def search(self, query: np.ndarray, limit: int, query_filter=None) -> tuple:
+        """
+            Return (rows, scores) of the best `limit` points, best first.
+        """
+        if self.count == 0 or limit <= 0:
+            return [], []
+        if self.normalize:
+            query = query / (np.linalg.norm(query) or 1.0)
+
+        mask = self.filter_mask(query_filter) if query_filter is not None else None
+        if mask is None and self.client.hnsw and limit < len(self):
+            return self._search_index(query, limit)
+
+        # The query stays float32, int8 rows are rescaled through it instead of being decoded
+        if self.np_dtype == np.int8:
+            query = query / _INT8_SCALE
+
+        scores = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, SCORE_CHUNK_ROWS):
+            stop = min(start + SCORE_CHUNK_ROWS, self.count)
+            scores[start:stop] = self.matrix[start:stop].astype(np.float32, copy=False) @ query
+        if self.deleted:
+            dead = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+            scores[dead] = -np.inf
+            if mask is not None:
+                mask[dead] = False
+        if mask is not None:
+            scores[~mask] = -np.inf
+            limit = min(limit, int(mask.sum()))
+        limit = min(limit, len(self))
+        if limit == 0:
+            return [], []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return top.tolist(), scores[top].tolist()
+
+    def search_many(self, queries: np.ndarray, limits: list, query_filters: list) -> list:
+        """
+            search() for a (n, dim) block of queries: [(rows, scores)] in query order.
+            The matrix is read once per BATCH_QUERY_CHUNK queries, and each distinct filter is evaluated once.
+        """
+        if self.count == 0:
+            return [([], []) for _ in limits]
+        if self.normalize:
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        if self.client.hnsw:
+            # The HNSW graph answers one query at a time; filtered queries still go through the matrix
+            return [self.search(query, limit, query_filter) for query, limit, query_filter in zip(queries, limits, query_filters)]
+
+        masks = {}
+        alive = len(self)
+        dead = np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted)) if self.deleted else None
+        results = []
+        for begin in range(0, len(queries), BATCH_QUERY_CHUNK):
+            block = queries[begin:begin + BATCH_QUERY_CHUNK]
+            if self.np_dtype == np.int8:
+                block = block / _INT8_SCALE
+            scores = np.empty((self.count, len(block)), dtype=np.float32)
+            for start in range(0, self.count, SCORE_CHUNK_ROWS):
+                stop = min(start + SCORE_CHUNK_ROWS, self.count)
+                scores[start:stop] = self.matrix[start:stop].astype(np.float32, copy=False) @ block.T
+            if dead is not None:
+                scores[dead] = -np.inf
+            for column, (limit, query_filter) in enumerate(zip(limits[begin:begin + len(block)], query_filters[begin:begin + len(block)])):
+                column_scores = scores[:, column]
+                limit = min(limit, alive)
+                if query_filter is not None:
+                    key = filter_key(query_filter)
+                    if key not in masks:
+                        mask = self.filter_mask(query_filter)
+                        if dead is not None:
+                            mask[dead] = False
+                        masks[key] = (mask, int(mask.sum()))
+                    mask, n_matching = masks[key]
+                    column_scores[~mask] = -np.inf
+                    limit = min(limit, n_matching)
+                if limit <= 0:
+                    results.append(([], []))
+                    continue
+                top = np.argpartition(-column_scores, limit - 1)[:limit]
+                top = top[np.argsort(-column_scores[top])]
+                results.append((top.tolist(), column_scores[top].tolist()))
+        return results
+
+    def filter_mask(self, query_filter) -> np.ndarray:
+        return np.fromiter((matches_filter(p or {}, query_filter) for p in self.payloads[:self.count]), dtype=bool, count=self.count)
+
+    def _search_index(self, query: np.ndarray, limit: int) -> tuple:
+        if self.index is None:
+            self.index = hnswlib.Index(space="ip", dim=self.dim)
+            self.index.init_index(max_elements=max(self.count, _INITIAL_CAPACITY), M=self.client.hnsw_m,
+                                  ef_construction=self.client.hnsw_ef_construct)
+            self._add_to_index([row for row in range(self.count) if row not in self.deleted])
+        self.index.set_ef(max(self.client.hnsw_ef, limit))
+        labels, distances = self.index.knn_query(query, k=limit)
+        # hnswlib's "ip" distance is 1 - dot product
+        return labels[0].tolist(), (1.0 - distances[0]).tolist()
+
+    def _add_to_index(self, rows: list):
+        if not rows:
+            return
+        if self.index.get_max_elements() < self.count:
+            self.index.resize_index(max(self.count, 2 * self.index.get_max_elements()))
+        self.index.add_items(np.stack([self.vector(row) for row in rows]), rows)
+
+    def scored_point(self, row: int, score: float, with_payload: bool, with_vectors: bool) -> ScoredPoint:
+        return ScoredPoint(
+            id=self.ids[row],
+            version=0,
+            score=float(score),
+            payload=self.payloads[row] if with_payload else None,
+            vector=self.vector(row).tolist() if with_vectors else None,
+        )
+
+    def close(self):
+        if self.matrix is not None:
+            self.matrix.flush()
+        self.db.close()
+
+
+def _config_value(config, key: str):
+    return config[key] if isinstance(config, dict) else getattr(config, key)
+
+
+def _point_value(point, key: str):
+    return point[key] if isinstance(point, dict) else getattr(point, key)
@@ -0,0 +1,221 @@
+import mailbox
+import os
+import struct
+import sys
+from array import array
+
+"""
+    Persistent byte-offset index for an mbox file.
+
+    The stdlib `mailbox.mbox` scans the whole file to build its table of contents
+    every time it is opened. This keeps the (offset, length) of each message in a
+    sidecar file next to the mbox, validated against the mbox size and mtime, and
+    only rescans the bytes that were appended since the index was last written.
+"""
+
+INDEX_SUFFIX = '.idx'
+
+_MAGIC = b'MBXIDX01'
+_HEADER = struct.Struct('<8sQQQ')  # magic, mbox size, mbox mtime_ns, message count
+_LINESEP = os.linesep.encode()
+
+
+class IndexedMbox:
+    def __init__(self, path: str, index_path: str = None):
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        self._offsets = array('Q')
+        self._lengths = array('Q')
+        self._size = 0
+        self._mtime_ns = 0
+        self._file = None
+        self._load_index()
+        self.refresh()
+
+    # -----
+    # Index Management
+    # -----
+
+    def refresh(self) -> int:
+        """
+            Bring the index up to date with the mbox file and return the number of new messages.
+            - Unchanged file: nothing is scanned
+            - Appended file: only the last indexed message and the bytes after it are scanned
+            - Truncated or rewritten file: the index is rebuilt from scratch
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            had = len(self._offsets)
+            self._reset()
+            return -had
+
+        if stat.st_size == self._size and stat.st_mtime_ns == self._mtime_ns:
+            return 0
+
+        before = len(self._offsets)
+        if self._offsets and stat.st_size >= self._size and self._starts_with_from(self._offsets[-1]):
+            # The last message may have grown, so rescan it along with anything appended after it
+            scan_from = self._offsets.pop()
+            self._lengths.pop()
+        else:
+            self._reset()
+            scan_from = 0
+
+        self._scan(scan_from)
+        self._size = stat.st_size
+        self._mtime_ns = stat.st_mtime_ns
+        self._close()
+        self._save_index()
+        return len(self._offsets) - before
+
+    def _reset(self):
+        self._offsets = array('Q')
+        self._lengths = array('Q')
+        self._size = 0
+        self._mtime_ns = 0
+
+    def _starts_with_from(self, offset: int) -> bool:
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(5) == b'From '
+
+    def _scan(self, pos: int):
+        """
+            Same start/stop rules as `mailbox.mbox._generate_toc`, starting at `pos`.
+        """
+        start = None
+        last_was_empty = False
+        with open(self.path, 'rb') as f:
+            f.seek(pos)
+            while True:
+                line_pos = f.tell()
+                line = f.readline()
+                if line.startswith(b'From '):
+                    if start is not None:
+                        stop = line_pos - len(_LINESEP) if last_was_empty else line_pos
+                        self._offsets.append(start)
+                        self._lengths.append(stop - start)
+                    start = line_pos
+                    last_was_empty = False
+                elif not line:
+                    if start is not None:
+                        stop = line_pos - len(_LINESEP) if last_was_empty else line_pos
+                        self._offsets.append(start)
+                        self._lengths.append(stop - start)
+                    break
+                elif line == _LINESEP:
+                    last_was_empty = True
+                else:
+                    last_was_empty = False
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                magic, size, mtime_ns, count = _HEADER.unpack(f.read(_HEADER.size))
+                if magic != _MAGIC:
+                    return
+                offsets, lengths = array('Q'), array('Q')
+                offsets.fromfile(f, count)
+                lengths.fromfile(f, count)
+        except (OSError, EOFError, struct.error):
+            return
+
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+            lengths.byteswap()
+        self._offsets, self._lengths = offsets, lengths
+        self._size, self._mtime_ns = size, mtime_ns
+
+    def _save_index(self):
+        offsets, lengths = self._offsets, self._lengths
+        if sys.byteorder != 'little':
+            offsets, lengths = array('Q', offsets), array('Q', lengths)
+            offsets.byteswap()
+            lengths.byteswap()
+
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, self._size, self._mtime_ns, len(offsets)))
+                offsets.tofile(f)
+                lengths.tofile(f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            # A read-only mailbox directory still works, the index just lives in memory
+            print(f"Could not write mbox index {self.index_path}: {e}")
+
+    # -----
+    # Message Access
+    # -----
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def get_offset(self, idx: int) -> tuple:
+        """
+            Return the (byte offset, byte length) of a message in the mbox file.
+        """
+        try:
+            return self._offsets[idx], self._lengths[idx]
+        except IndexError:
+            raise KeyError(f"No message with key: {idx}")
+
+    def get_bytes(self, idx: int, from_: bool = False) -> bytes:
+        """
+            Return the raw bytes of a message with a single seek and read.
+        """
+        offset, length = self.get_offset(idx)
+        f = self._open()
+        f.seek(offset)
+        data = f.read(length)
+        if not from_:
+            data = data[data.find(b'\n') + 1:]
+        return data.replace(_LINESEP, b'\n')
+
+    def get_message(self, idx: int) -> mailbox.mboxMessage:
+        """
+            Return a `mailbox.mboxMessage`, the same object `mailbox.mbox[idx]` returns.
+        """
+        return parse_message(self.get_bytes(idx, from_=True))
+
+    __getitem__ = get_message
+
+    def iter_bytes(self, start: int = 0, stop: int = None):
+        """
+            Yield (idx, raw bytes incl. the From_ line) for messages in file order.
+            The file is read front to back with one handle, so this is sequential I/O.
+        """
+        stop = len(self._offsets) if stop is None else min(stop, len(self._offsets))
+        if start >= stop:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._offsets[start])
+            for idx in range(start, stop):
+                offset = self._offsets[idx]
+                if f.tell() != offset:
+                    f.seek(offset)
+                yield idx, f.read(self._lengths[idx]).replace(_LINESEP, b'\n')
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        return self._file
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self._close()
+
+
+def parse_message(data: bytes) -> mailbox.mboxMessage:
+    """
+        Build a `mailbox.mboxMessage` from raw message bytes that start with the From_ line.
+    """
+    from_line, _, body = data.partition(b'\n')
+    msg = mailbox.mboxMessage(body)
+    msg.set_from(from_line[5:].decode('ascii', errors='replace'))
+    return msg
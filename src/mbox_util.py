@@ -1,30 +1,71 @@
 import hashlib
 import os, pathlib
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timezone
 from dateutil import parser
-import mailbox
 import re
+import signal
+import threading
+from collections import deque
 from fastembed import TextEmbedding
-from bs4 import BeautifulSoup
 import fitz
 from docx import Document
 from io import BytesIO
+from email.utils import parseaddr
+import numpy as np
 
+from mbox_index import IndexedMbox, parse_message
+from attachment_cache import AttachmentTextCache, attachment_key
+import extraction_pool
+import metrics
+import triage
+import text_cleaning
+import thread_index
+
+# Before any setting below is read, so values from .env apply to them too
+load_dotenv()
 
 # Path to your mbox file
 BASE_DIR = pathlib.Path(__file__).resolve().parent.parent
 mbox_file = os.path.join(BASE_DIR, 'INBOX.mbox/mbox') 
-mbox = mailbox.mbox(mbox_file)
+mbox = IndexedMbox(mbox_file)
 
-embedding_model = TextEmbedding(model_name="BAAI/bge-small-en", cache_dir="./cache")
+EMBEDDING_MODEL_NAME = "BAAI/bge-small-en"
+EMBEDDING_DIM = 384
+EMBED_BATCH_SIZE = 256
+_embedding_model = None
+
+# Seconds allowed for extracting text from a single PDF/DOCX attachment (0 = no limit)
+ATTACHMENT_TIMEOUT = float(os.getenv('ATTACHMENT_TIMEOUT', 30))
+# Per-attachment limits (0 = no limit): larger attachments are not opened, only the first pages
+# are read and the extracted text is cut to a maximum number of characters
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', 25 * 1024 ** 2))
+ATTACHMENT_MAX_PAGES = int(os.getenv('ATTACHMENT_MAX_PAGES', 50))
+ATTACHMENT_MAX_CHARS = int(os.getenv('ATTACHMENT_MAX_CHARS', 200_000))
+# Extraction processes used by ingest (0 = extract in the ingest process itself)
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', 0))
+# Seconds one message may take in an extraction process before it is skipped and the process replaced (0 = no limit)
+MESSAGE_TIMEOUT = float(os.getenv('MESSAGE_TIMEOUT', 300))
+# Extracted text is cached by attachment content, so forwarded copies are only extracted once
+ATTACHMENT_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'attachments')
+USE_ATTACHMENT_CACHE = os.getenv('ATTACHMENT_CACHE', 'true').lower() == 'true'
+_attachment_cache = None
+_attachment_cache_pid = None
 
-load_dotenv()
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
 def get_mbox_count():
     return len(mbox)
 
+def get_embedding_model():
+    """
+        Load the embedding model on first use, so extraction-only processes never pay for it
+    """
+    global _embedding_model
+    if _embedding_model is None:
+        _embedding_model = TextEmbedding(model_name=EMBEDDING_MODEL_NAME, cache_dir="./cache")
+    return _embedding_model
+
 """
     Prepare Email for insertion into the vector database
     - Extract metadata
@@ -33,73 +74,147 @@ def get_mbox_count():
 """
 
 
+@metrics.timed('clean_html')
 def clean_html(html):
-    soup = BeautifulSoup(html, "html.parser")
-    
-    for tag in soup(["script", "style"]):
-        tag.decompose()
-    
-    text = soup.get_text(separator="\n")
-    clean_text = "\n".join(line.strip() for line in text.splitlines() if line.strip())
-
-    return clean_text
+    return text_cleaning.clean_html(html)
 
 def extract_text_from_pdf_bytes(pdf_bytes):
-    text = ''
+    parts, size = [], 0
     with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-        for page in doc:
-            text += page.get_text()
-    return text.strip()
+        for page_number, page in enumerate(doc):
+            if ATTACHMENT_MAX_PAGES and page_number >= ATTACHMENT_MAX_PAGES:
+                parts.append(f"\n[{doc.page_count - page_number} more pages not extracted]")
+                break
+            if ATTACHMENT_MAX_CHARS and size >= ATTACHMENT_MAX_CHARS:
+                break
+            text = page.get_text()
+            parts.append(text)
+            size += len(text)
+    return _limit_chars("".join(parts).strip())
 
 def extract_text_from_docx_bytes(docx_bytes):
-    text = ''
+    parts, size = [], 0
     doc = Document(BytesIO(docx_bytes))
     for para in doc.paragraphs:
-        text += para.text + '\n'
-    return text.strip()
+        if ATTACHMENT_MAX_CHARS and size >= ATTACHMENT_MAX_CHARS:
+            break
+        parts.append(para.text)
+        size += len(para.text) + 1
+    return _limit_chars("\n".join(parts).strip())
+
+def _limit_chars(text):
+    return text[:ATTACHMENT_MAX_CHARS] if ATTACHMENT_MAX_CHARS else text
+
+def get_attachment_cache():
+    """
+        The attachment text cache of this process (None when disabled).
+        SQLite connections do not survive a fork, so extraction workers open their own.
+    """
+    global _attachment_cache, _attachment_cache_pid
+    if not USE_ATTACHMENT_CACHE:
+        return None
+    if _attachment_cache is None or _attachment_cache_pid != os.getpid():
+        _attachment_cache = AttachmentTextCache(ATTACHMENT_CACHE_DIR)
+        _attachment_cache_pid = os.getpid()
+    return _attachment_cache
+
+class AttachmentTimeout(Exception):
+    pass
+
+def _raise_attachment_timeout(signum, frame):
+    raise AttachmentTimeout()
+
+@metrics.timed('attachment')
+def extract_attachment_text(extract_fn, payload, timeout = None):
+    """
+        Run an attachment extractor with the per-attachment limits, reusing cached text for attachments
+        that were extracted before. The wall-clock limit (default ATTACHMENT_TIMEOUT) uses SIGALRM,
+        so it only applies on the main thread of a process (the ingest loop or a pool worker).
+    """
+    if not payload:
+        return ''
+    metrics.count('attachment_bytes_total', len(payload), extractor=extract_fn.__name__)
+    if ATTACHMENT_MAX_BYTES and len(payload) > ATTACHMENT_MAX_BYTES:
+        metrics.count('attachments_total', result='oversized')
+        return f"[attachment not extracted: {len(payload)} bytes]"
+
+    cache = get_attachment_cache()
+    key = attachment_key(extract_fn.__name__, payload, (ATTACHMENT_MAX_PAGES, ATTACHMENT_MAX_CHARS))
+    if cache is not None:
+        text = cache.get(key)
+        if text is not None:
+            metrics.count('attachments_total', result='cached')
+            return text
+
+    if timeout is None:
+        timeout = ATTACHMENT_TIMEOUT
+    if not timeout or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        text = extract_fn(payload)
+    else:
+        previous = signal.signal(signal.SIGALRM, _raise_attachment_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            text = extract_fn(payload)
+        except AttachmentTimeout:
+            # Not cached, a later run with a longer timeout may get the text
+            print(f"Attachment extraction timed out after {timeout}s ({extract_fn.__name__})")
+            metrics.count('attachments_total', result='timeout')
+            return "[attachment extraction timed out]"
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    metrics.count('attachments_total', result='extracted')
+    if cache is not None:
+        cache.put(key, text)
+    return text
 
 def get_message(idx = int):
-    message = ''
-    email_obj = mbox[idx]
+    return get_message_text(mbox[idx])
+
+@metrics.timed('get_message_text')
+def get_message_text(email_obj):
+    """
+        Clean message body of an already parsed email.
+        Only HTML parts are parsed as HTML; the assembled text is whitespace-normalized once at the end.
+    """
+    parts = []
     
     if email_obj.is_multipart():
         for part in email_obj.walk():
             if part.get_content_disposition() == 'attachment':
                 content_type = part.get_content_type()
                 filename = part.get_filename()
-                message += "[" + str(content_type) + str(filename) + "]\n"
+                parts.append("[" + str(content_type) + str(filename) + "]\n")
             
             ct = part.get_content_type()
             if ct == 'text/plain':
-                message += part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', errors='replace') + '\n'
+                parts.append(part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', errors='replace') + '\n')
             elif ct == 'text/html':
                 html_payload = part.get_payload(decode=True)
 
                 if html_payload:
                     html_str = html_payload.decode(part.get_content_charset() or 'utf-8', errors='replace') + '\n'
-                    message += clean_html(html_str)
+                    parts.append(clean_html(html_str))
             elif ct == 'application/pdf':
                 pdf_payload = part.get_payload(decode=True)
-                message += extract_text_from_pdf_bytes(pdf_payload) + '\n'
+                parts.append(extract_attachment_text(extract_text_from_pdf_bytes, pdf_payload) + '\n')
             elif ct == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
                 docx_payload = part.get_payload(decode=True)
-                message += extract_text_from_docx_bytes(docx_payload) + '\n'
+                parts.append(extract_attachment_text(extract_text_from_docx_bytes, docx_payload) + '\n')
             
     else:
         payload = email_obj.get_payload(decode=True)
         ct = email_obj.get_content_type()
         
         if payload is None:
-            return message
+            return ''
         elif ct == 'text/plain':
-            message = payload.decode(email_obj.get_content_charset() or 'utf-8', errors='replace')
+            parts.append(payload.decode(email_obj.get_content_charset() or 'utf-8', errors='replace'))
         elif ct == 'text/html':
-            html_payload = payload
-            if html_payload:
-                message = html_payload.decode(email_obj.get_content_charset() or 'utf-8', errors='replace')
-
+            parts.append(clean_html(payload.decode(email_obj.get_content_charset() or 'utf-8', errors='replace')))
 
-    return str(clean_html(message))
+    return text_cleaning.normalize_lines("".join(parts))
 
 def clean_addr(addr = str):
     if not addr:
@@ -107,32 +222,193 @@ def clean_addr(addr = str):
     return [a.strip() for a in addr.split(',')]
 
 def extract_metadata(idx = int):
-    message = mbox[idx]
-    data = get_message(idx)
+    return extract_metadata_from_message(mbox[idx])
+
+def extract_metadata_from_message(message):
+    """
+        Extract metadata and cleaned body from an already parsed email
+    """
+    data = get_message_text(message)
     if not data:
         return None, None   
     
-    date_obj = str(message.get('Date'))
-    dt = parser.parse(date_obj)
-    date = dt.isoformat()
+    return build_metadata(message, data), data
+
+def extract_header_record(headers):
+    """
+        Metadata and text for a message indexed from its headers only (see triage.HEADERS)
+    """
+    data = str(headers.get('Subject', '(No Subject)'))
+    metadata = build_metadata(headers, data)
+    metadata["headers_only"] = True
+    return metadata, data
 
-    subject = message.get('Subject', '(No Subject)')
-    thread_id = re.sub(r'^(re|fw|fwd):\s*', '', subject.strip(), flags=re.IGNORECASE)
+@metrics.timed('metadata')
+def build_metadata(message, data):
+    """
+        Payload for a message from its headers and cleaned body
+    """
+    date, timestamp = parse_date(message.get('Date'))
+
+    subject = str(message.get('Subject', '(No Subject)'))
+    # Fallback thread id when no thread index is used (see thread_index): nested "Re: Fwd:" prefixes are stripped
+    thread_id = re.sub(r'^((re|fw|fwd|aw)\s*:\s*)+', '', subject.strip(), flags=re.IGNORECASE)
     thread_id = hashlib.md5(thread_id.encode()).hexdigest()
+    message_ids = thread_index.parse_message_ids(message.get('Message-ID'))
+    references = thread_index.parse_message_ids(message.get('References')) + thread_index.parse_message_ids(message.get('In-Reply-To'))
     
     metadata = {
         "subject": subject,
         "from": message.get('From'),
+        "from_address": parseaddr(str(message.get('From', '')))[1].lower() or None,
         "to": ", ".join(clean_addr(message.get('To'))),
         "cc": ", ".join(clean_addr(message.get('Cc'))),
         "date": date,
+        "timestamp": timestamp,
         "thread_id": thread_id,
+        "message_id": message_ids[0] if message_ids else None,
+        # References then In-Reply-To, oldest first; consumed by the thread index at ingest
+        "references": references,
         "is_reply": subject.lower().startswith(('re:', 'fw:', 'fwd:')),
         "has_link": 'http' in data.lower(),
         "n_tokens": len(data.split()),
         "attachments": bool(message.get_content_maintype() != 'text')
     }
-    return metadata, data
+    return metadata
+
+def parse_date(value):
+    """
+        (ISO date, timestamp) of a Date header, (None, None) when it is missing or not a date.
+        A date without a timezone is taken as UTC for the timestamp.
+    """
+    if value is None:
+        return None, None
+    try:
+        dt = parser.parse(str(value))
+        timestamp = int(dt.timestamp()) if dt.tzinfo else int(dt.replace(tzinfo=timezone.utc).timestamp())
+    except (ValueError, OverflowError):
+        return None, None
+    return dt.isoformat(), timestamp
+
+
+"""
+    Streaming ingest pipeline
+    - Read the mbox once, front to back
+    - Parse each message exactly once
+    - Yield (idx, metadata, data) records for the embedding stage
+"""
+def read_raw_messages(start: int = 0, stop: int = None):
+    for idx, raw in mbox.iter_bytes(start, stop):
+        metrics.count('messages_read_total')
+        metrics.count('mbox_bytes_read_total', len(raw))
+        yield idx, raw
+
+@metrics.timed('parse')
+def _parse(raw):
+    return parse_message(raw)
+
+def parse_messages(raw_records):
+    for idx, raw in raw_records:
+        yield idx, _parse(raw)
+
+def extract_records(messages):
+    for idx, message in messages:
+        metadata, data = _extract_safely(extract_metadata_from_message, idx, message)
+        yield idx, metadata, data
+
+def _extract_safely(extract, idx, message):
+    # A message that cannot be extracted is yielded like one without a body, so it never stops the stream
+    try:
+        return extract(message)
+    except Exception as e:
+        print(f"Error extracting message {idx}: {e}")
+        metrics.count('errors_total', stage='extract', error=type(e).__name__)
+        return None, None
+
+def extract_raw_record(raw_record):
+    """
+        Parse and extract a single (idx, raw bytes) record. Runs inside extraction pool workers.
+    """
+    idx, raw = raw_record
+    metadata, data = _extract_safely(extract_metadata_from_message, idx, _parse(raw))
+    return idx, metadata, data
+
+def _init_extraction_worker(attachment_timeout):
+    global ATTACHMENT_TIMEOUT
+    ATTACHMENT_TIMEOUT = attachment_timeout
+    # Ctrl+C is handled by the ingest process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _skip_timed_out_record(raw_record):
+    idx, _ = raw_record
+    print(f"Extraction of message {idx} timed out.")
+    metrics.count('errors_total', stage='extract', error='timeout')
+    return idx, None, None
+
+def extract_records_parallel(raw_records, workers: int = None, max_pending: int = None,
+                             message_timeout: float = MESSAGE_TIMEOUT, attachment_timeout: float = ATTACHMENT_TIMEOUT):
+    """
+        Multi-process version of parse_messages + extract_records, results are still yielded in mbox order.
+        A message that takes longer than `message_timeout` seconds (0 or None = no limit) is yielded as
+        (idx, None, None), and the worker that was stuck on it is replaced.
+    """
+    return extraction_pool.imap_ordered(
+        extract_raw_record,
+        raw_records,
+        workers=workers,
+        max_pending=max_pending,
+        timeout=message_timeout or None,
+        initializer=_init_extraction_worker,
+        initargs=(attachment_timeout,),
+        on_timeout=_skip_timed_out_record
+    )
+
+def stream_messages(start: int = 0, stop: int = None, workers: int = 0, triage_rules = None, on_skip = None,
+                    **pool_options):
+    """
+        Records for every message from `start`, in mbox order. Messages without a body, or whose extraction
+        failed, yield (idx, None, None).
+        - workers: 0 extracts inline, otherwise the number of extraction processes (see extract_records_parallel)
+        - triage_rules: triage.TriageRules applied to the headers first. Skipped messages are reported to
+          on_skip(idx, reason) and not yielded, header-only messages never reach the body pipeline.
+    """
+    return stream_raw_records(read_raw_messages(start, stop), workers, triage_rules, on_skip, **pool_options)
+
+def stream_raw_records(raw_records, workers: int = 0, triage_rules = None, on_skip = None, **pool_options):
+    """
+        stream_messages for (idx, raw bytes) records from any source, e.g. messages fetched by gmail_sync.
+        The raw bytes start with a From_ line, as in an mbox.
+    """
+    if triage_rules is None or not triage_rules.active:
+        return _extract(raw_records, workers, pool_options)
+    return _stream_triaged(raw_records, workers, triage_rules, on_skip, pool_options)
+
+def _extract(raw_records, workers, pool_options):
+    if workers:
+        return extract_records_parallel(raw_records, workers=workers, **pool_options)
+    return extract_records(parse_messages(raw_records))
+
+def _stream_triaged(raw_records, workers, rules, on_skip, pool_options):
+    # Header-only records are ready right away; they are yielded between the extracted ones
+    ready = deque()
+    
+    def full_records():
+        for idx, raw in raw_records:
+            headers = triage.parse_headers(raw)
+            action, reason = rules.decide(headers, len(raw))
+            metrics.count('triage_total', action=action)
+            if action == triage.INDEX:
+                yield idx, raw
+            elif action == triage.HEADERS:
+                ready.append((idx, *_extract_safely(extract_header_record, idx, headers)))
+            elif on_skip is not None:
+                on_skip(idx, reason)
+    
+    for record in _extract(full_records(), workers, pool_options):
+        while ready and ready[0][0] < record[0]:
+            yield ready.popleft()
+        yield record
+    yield from ready
 
 
 """
@@ -142,7 +418,7 @@ def create_vector_embedding_from_idx(idx = int):
     # start_time = datetime.now()
     message = get_message(idx)
     
-    embedding_generator = embedding_model.embed(message)
+    embedding_generator = get_embedding_model().embed(message)
     embedding = list(embedding_generator)
     vector = embedding[0]
     
@@ -151,10 +427,11 @@ def create_vector_embedding_from_idx(idx = int):
     # print(f"Elapsed time: {elapsed_time.total_seconds()}s")
     return vector.tolist()
 
+@metrics.timed('embed_query')
 def create_vector_embedding(data = str):
     # start_time = datetime.now()
 
-    embedding_generator = embedding_model.embed(data)
+    embedding_generator = get_embedding_model().embed(data)
     embedding = list(embedding_generator)
     vector = embedding[0]
     
@@ -163,6 +440,21 @@ def create_vector_embedding(data = str):
     # print(f"Elapsed time: {elapsed_time.total_seconds()}s")
     return vector.tolist()
 
+@metrics.timed('embed')
+def create_vector_embeddings(texts: list, batch_size: int = EMBED_BATCH_SIZE, parallel: int = None):
+    """
+        Embed many texts with as few model runs as possible.
+        - batch_size: number of texts per ONNX run
+        - parallel: fastembed data-parallel workers (0 = one per core, None = in-process)
+        Returns a float32 NumPy array of shape (len(texts), EMBEDDING_DIM)
+    """
+    if not texts:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+    metrics.count('texts_embedded_total', len(texts))
+    embeddings = get_embedding_model().embed(texts, batch_size=batch_size, parallel=parallel)
+    return np.asarray(list(embeddings), dtype=np.float32)
+
 
 if __name__ == "__main__":
     while True:
@@ -0,0 +1,271 @@
+import bisect
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+from dotenv import load_dotenv
+
+"""
+    Ingest and search instrumentation
+    - Histograms: latency per stage (stage_seconds{stage=...}), fixed log-spaced buckets so recording is O(log n)
+    - Counters: messages, bytes, documents written, skips by reason, errors by stage and exception type
+    - Gauges: callables read when a snapshot is taken (queue depths, buffer sizes) plus process memory and CPU
+    - Off unless METRICS=true (or enable()): every hook is then a single flag check and nothing is stored
+    - Exposed as Prometheus text (search_service /metrics) and as a JSON snapshot file that
+      start_snapshots() rewrites every METRICS_SNAPSHOT_INTERVAL seconds
+
+    Extraction pool workers are separate processes: stages timed inside them (get_message_text, attachments)
+    stay in the worker, the ingest process only records the records it receives.
+"""
+
+# Imported before the modules that call load_dotenv(), so it loads .env itself
+load_dotenv()
+
+METRICS_ENABLED = os.getenv("METRICS", "false").lower() == "true"
+METRICS_SNAPSHOT_FILE = os.getenv("METRICS_SNAPSHOT_FILE")
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", 10))
+
+# Upper bounds in seconds, from sub-millisecond parsing to minute-long upserts
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """
+            Upper bound of the bucket holding the q-quantile (the max for the overflow bucket).
+        """
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for n, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(BUCKETS[n], self.max) if n < len(BUCKETS) else self.max
+        return self.max
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def _labels_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def process_stats() -> dict:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = {
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_bytes": usage.ru_maxrss * 1024,
+        "cpu_user_seconds": usage.ru_utime,
+        "cpu_system_seconds": usage.ru_stime,
+        "threads": threading.active_count(),
+    }
+    try:
+        with open("/proc/self/statm") as f:
+            stats["rss_bytes"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    return stats
+
+
+class Registry:
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name: str, read, **labels):
+        """
+            Register a gauge; `read` is called whenever a snapshot is taken. Re-registering replaces it.
+        """
+        with self._lock:
+            self.gauges[_key(name, labels)] = read
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def _read_gauges(self) -> dict:
+        values = {}
+        for key, read in list(self.gauges.items()):
+            try:
+                values[key] = float(read())
+            except Exception:
+                # e.g. the object behind the gauge is gone or closed
+                continue
+        return values
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (h.count, h.sum, h.max, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+                          for key, h in self.histograms.items()}
+        uptime = time.time() - self.started
+        return {
+            "timestamp": time.time(),
+            "uptime_seconds": uptime,
+            "enabled": self.enabled,
+            "process": process_stats(),
+            "counters": [{"name": name, "labels": dict(labels), "value": value,
+                          "per_second": value / uptime if uptime else None}
+                         for (name, labels), value in sorted(counters.items())],
+            "histograms": [{"name": name, "labels": dict(labels), "count": count, "sum_seconds": total,
+                            "mean_ms": total / count * 1000 if count else 0.0, "p50_ms": p50 * 1000,
+                            "p95_ms": p95 * 1000, "p99_ms": p99 * 1000, "max_ms": maximum * 1000}
+                           for (name, labels), (count, total, maximum, p50, p95, p99) in sorted(histograms.items())],
+            "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                       for (name, labels), value in sorted(self._read_gauges().items())],
+        }
+
+    def prometheus_text(self) -> str:
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h.counts), h.count, h.sum) for key, h in self.histograms.items()}
+        lines = []
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"mbox_{name}{_labels_text(labels)} {value}")
+        for (name, labels), (counts, count, total) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"mbox_{name}_bucket{_labels_text(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"mbox_{name}_count{_labels_text(labels)} {count}")
+            lines.append(f"mbox_{name}_sum{_labels_text(labels)} {total}")
+        for (name, labels), value in sorted(self._read_gauges().items()):
+            lines.append(f"mbox_{name}{_labels_text(labels)} {value}")
+        for name, value in process_stats().items():
+            lines.append(f"mbox_process_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(enabled=METRICS_ENABLED)
+
+
+# -----
+# Hooks
+# -----
+
+def enable(enabled: bool = True):
+    registry.enabled = enabled
+
+
+def enabled() -> bool:
+    return registry.enabled
+
+
+def count(name: str, value: float = 1, **labels):
+    if registry.enabled:
+        registry.count(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    if registry.enabled:
+        registry.observe(name, value, **labels)
+
+
+def gauge(name: str, read, **labels):
+    registry.gauge(name, read, **labels)
+
+
+def timed(stage: str):
+    """
+        Decorator: latency of every call in stage_seconds{stage=...} and raised exceptions in errors_total.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                registry.count("errors_total", stage=stage, error=type(e).__name__)
+                raise
+            finally:
+                registry.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+        return wrapper
+    return decorator
+
+
+# -----
+# Snapshots
+# -----
+
+def write_snapshot(path: str = None):
+    """
+        Write the current snapshot as JSON, atomically so a reader never sees a partial file.
+    """
+    path = path or METRICS_SNAPSHOT_FILE
+    if not path or not registry.enabled:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(registry.snapshot(), f, indent=2)
+    os.replace(tmp_path, path)
+
+
+_snapshot_thread = None
+
+
+def start_snapshots(path: str = None, interval: float = None):
+    """
+        Rewrite the snapshot file every `interval` seconds from a daemon thread.
+        Does nothing when metrics are disabled, no file is configured or the thread already runs.
+    """
+    global _snapshot_thread
+    path = path or METRICS_SNAPSHOT_FILE
+    interval = interval or METRICS_SNAPSHOT_INTERVAL
+    if not path or not registry.enabled or (_snapshot_thread is not None and _snapshot_thread.is_alive()):
+        return
+
+    def run():
+        while registry.enabled:
+            time.sleep(interval)
+            try:
+                write_snapshot(path)
+            except OSError as e:
+                print(f"Could not write metrics snapshot to {path}: {e}")
+
+    _snapshot_thread = threading.Thread(target=run, name="metrics-snapshot", daemon=True)
+    _snapshot_thread.start()
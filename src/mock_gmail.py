@@ -0,0 +1,228 @@
+import argparse
+import base64
+import contextlib
+import json
+import mailbox
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+"""
+    Local stand-in for the parts of the Gmail API that gmail_sync uses
+    - users.getProfile, users.messages.list, users.messages.get (format=raw), users.history.list
+      (messageAdded) and the /batch/gmail/v1 multipart endpoint
+    - Messages come from an mbox (or add_message) and every addition gets a new historyId, so
+      incremental syncs can be exercised by adding mail between runs
+    - Fault injection: every `rate_limit_every`-th call (batch parts included) answers 429, and
+      expire_history() makes older historyIds answer 404 like Gmail does after about a week
+
+    Run from the src directory:  python mock_gmail.py /tmp/bench/mbox --port 8090
+    then:  GMAIL_API_URL=http://127.0.0.1:8090 GMAIL_ACCESS_TOKEN=test python gmail_sync.py
+"""
+
+FIRST_HISTORY_ID = 1000
+FIRST_MESSAGE_ID = 0x18a0000000000000
+
+
+def _error(code: int, message: str, reason: str) -> dict:
+    return {"error": {"code": code, "message": message, "errors": [{"reason": reason, "message": message}]}}
+
+
+class MockGmailStore:
+    def __init__(self, token: str = None, email: str = "me@mock.example", rate_limit_every: int = 0, retry_after: float = 0):
+        self.token = token
+        self.email = email
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.messages = {}
+        self.history = []
+        self.history_id = FIRST_HISTORY_ID
+        self.oldest_history_id = FIRST_HISTORY_ID
+        self.calls = 0
+        self.http_requests = 0
+        self._lock = threading.Lock()
+
+    def add_message(self, raw: bytes, labels: tuple = ("INBOX",)) -> str:
+        """
+            Store RFC 822 bytes (CRLF line endings, as Gmail serves them) and return the new message id.
+        """
+        with self._lock:
+            message_id = f"{FIRST_MESSAGE_ID + len(self.messages):x}"
+            self.history_id += 1
+            self.messages[message_id] = {"raw": raw, "labelIds": list(labels), "historyId": str(self.history_id)}
+            self.history.append((self.history_id, message_id))
+            return message_id
+
+    def load_mbox(self, path: str) -> int:
+        box = mailbox.mbox(path, create=False)
+        try:
+            for message in box:
+                self.add_message(message.as_bytes().replace(b"\r\n", b"\n").replace(b"\n", b"\r\n"))
+        finally:
+            box.close()
+        return len(self.messages)
+
+    def expire_history(self):
+        """
+            Drop the history recorded so far: syncs from an older historyId get a 404.
+        """
+        with self._lock:
+            self.oldest_history_id = self.history_id + 1
+
+    def rate_limited(self) -> bool:
+        with self._lock:
+            self.calls += 1
+            return bool(self.rate_limit_every) and self.calls % self.rate_limit_every == 0
+
+    # -----
+    # API calls: (status, body)
+    # -----
+
+    def profile(self) -> tuple:
+        return 200, {"emailAddress": self.email, "messagesTotal": len(self.messages), "historyId": str(self.history_id)}
+
+    def list_messages(self, max_results: int, page_token: str = None, include_spam_trash: bool = False) -> tuple:
+        ids = [message_id for message_id, message in reversed(self.messages.items())
+               if include_spam_trash or not {"SPAM", "TRASH"}.intersection(message["labelIds"])]
+        start = int(page_token or 0)
+        page = {"messages": [{"id": message_id, "threadId": message_id} for message_id in ids[start:start + max_results]],
+                "resultSizeEstimate": len(ids)}
+        if start + max_results < len(ids):
+            page["nextPageToken"] = str(start + max_results)
+        return 200, page
+
+    def get_message(self, message_id: str) -> tuple:
+        message = self.messages.get(message_id)
+        if message is None:
+            return 404, _error(404, "Requested entity was not found.", "notFound")
+        return 200, {"id": message_id, "threadId": message_id, "labelIds": message["labelIds"],
+                     "historyId": message["historyId"], "sizeEstimate": len(message["raw"]),
+                     "raw": base64.urlsafe_b64encode(message["raw"]).decode()}
+
+    def list_history(self, start_history_id: int, max_results: int, page_token: str = None) -> tuple:
+        if start_history_id < self.oldest_history_id:
+            return 404, _error(404, "Requested entity was not found.", "notFound")
+        records = [(history_id, message_id) for history_id, message_id in self.history if history_id > start_history_id]
+        start = int(page_token or 0)
+        page = {
+            "history": [{"id": str(history_id), "messagesAdded": [{"message": {
+                "id": message_id, "threadId": message_id, "labelIds": self.messages[message_id]["labelIds"]}}]}
+                for history_id, message_id in records[start:start + max_results]],
+            "historyId": str(self.history_id),
+        }
+        if start + max_results < len(records):
+            page["nextPageToken"] = str(start + max_results)
+        return 200, page
+
+    def dispatch(self, method: str, path: str, params: dict) -> tuple:
+        """
+            Route a single call, the way the batch endpoint routes each of its parts.
+        """
+        if self.rate_limited():
+            return 429, _error(429, "Rate Limit Exceeded", "rateLimitExceeded")
+        match = re.fullmatch(r"/gmail/v1/users/[^/]+/(profile|messages|history|messages/([0-9a-f]+))", path)
+        if method != "GET" or match is None:
+            return 400, _error(400, f"Unsupported call {method} {path}", "badRequest")
+        max_results = int(params.get("maxResults", 100))
+        if match.group(1) == "profile":
+            return self.profile()
+        if match.group(1) == "messages":
+            return self.list_messages(max_results, params.get("pageToken"), params.get("includeSpamTrash") == "true")
+        if match.group(1) == "history":
+            return self.list_history(int(params["startHistoryId"]), max_results, params.get("pageToken"))
+        return self.get_message(match.group(2))
+
+
+def _parse_batch_request(content_type: str, body: bytes) -> list:
+    """
+        [(content id, method, path, params)] from a multipart/mixed batch request.
+    """
+    message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    calls = []
+    for part in message.get_payload():
+        request_line = (part.get_payload(decode=True) or b"").decode().strip().splitlines()[0]
+        method, url = request_line.split()[:2]
+        path, _, query = url.partition("?")
+        params = dict(pair.partition("=")[::2] for pair in query.split("&") if pair)
+        calls.append((part.get("Content-ID", "").strip("<>"), method, path, params))
+    return calls
+
+
+def create_app(store: MockGmailStore) -> FastAPI:
+    app = FastAPI()
+
+    def authorized(request: Request) -> bool:
+        return store.token is None or request.headers.get("Authorization") == f"Bearer {store.token}"
+
+    def respond(status: int, body: dict) -> JSONResponse:
+        headers = {"Retry-After": str(store.retry_after)} if status == 429 else None
+        return JSONResponse(body, status_code=status, headers=headers)
+
+    @app.get("/gmail/v1/users/{user}/{resource:path}")
+    async def call(user: str, resource: str, request: Request):
+        store.http_requests += 1
+        if not authorized(request):
+            return respond(401, _error(401, "Invalid Credentials", "authError"))
+        return respond(*store.dispatch("GET", f"/gmail/v1/users/{user}/{resource}", dict(request.query_params)))
+
+    @app.post("/batch/gmail/v1")
+    async def batch(request: Request):
+        store.http_requests += 1
+        if not authorized(request):
+            return respond(401, _error(401, "Invalid Credentials", "authError"))
+        calls = _parse_batch_request(request.headers["Content-Type"], await request.body())
+        if len(calls) > 100:
+            return respond(400, _error(400, "Too many requests in a batch", "badRequest"))
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for content_id, method, path, params in calls:
+            status, body = store.dispatch(method, path, params)
+            retry_after = f"Retry-After: {store.retry_after}\r\n" if status == 429 else ""
+            payload = json.dumps(body)
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n{retry_after}"
+                f"Content-Type: application/json; charset=UTF-8\r\n\r\n{payload}\r\n"
+            )
+        return Response(("".join(parts) + f"--{boundary}--\r\n").encode(),
+                        media_type=f"multipart/mixed; boundary={boundary}")
+
+    return app
+
+
+@contextlib.contextmanager
+def running(store: MockGmailStore, port: int = 8090):
+    """
+        Serve the store on 127.0.0.1:`port` from a background thread; yields the base URL.
+    """
+    server = uvicorn.Server(uvicorn.Config(create_app(store), host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="mock-gmail", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f"Mock Gmail server could not start on port {port}")
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Serve an mbox through a mock Gmail API")
+    arg_parser.add_argument("mbox")
+    arg_parser.add_argument("--port", type=int, default=8090)
+    arg_parser.add_argument("--token", help="bearer token to require")
+    arg_parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every n-th call with 429")
+    args = arg_parser.parse_args()
+
+    store = MockGmailStore(token=args.token, rate_limit_every=args.rate_limit_every)
+    print(f"Serving {store.load_mbox(args.mbox)} messages, historyId {store.history_id}")
+    uvicorn.run(create_app(store), host="127.0.0.1", port=args.port)
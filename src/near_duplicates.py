@@ -0,0 +1,208 @@
+import hashlib
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+"""
+    Near-duplicate detection for the ingest path
+    - strip_quoted_replies: drop quoted history ("> ..." lines and the reply tail after "On ... wrote:" or
+      "Original Message") so a reply is embedded by what it adds. Forwarded messages are kept whole:
+      the forwarded body is the content
+    - minhash: MinHash signature over distinct word 3-shingles; the share of equal slots between two
+      signatures estimates the Jaccard similarity of the texts
+    - NearDuplicateIndex: LSH index in SQLite, BANDS buckets of ROWS slots per document. Texts that are
+      SIMILARITY_THRESHOLD similar share a bucket with high probability, so a lookup only reads a few
+      buckets and verifies the candidates it finds. Canonical documents also keep their embedding, so a
+      near duplicate is stored with that vector instead of being embedded again
+"""
+
+NUM_PERM = 128
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SIMILARITY_THRESHOLD = 0.8
+SHINGLE_SIZE = 3
+# Texts with fewer distinct shingles are too short for a reliable signature (and cheap to embed anyway)
+MIN_SHINGLES = 8
+
+_REPLY_HEADER_RE = re.compile(r"^On .{0,200}wrote:\s*$", re.IGNORECASE)
+_ORIGINAL_MESSAGE_RE = re.compile(r"^-{2,}\s*Original Message\s*-{2,}\s*$", re.IGNORECASE)
+_HEADER_FIELD_RE = re.compile(r"^(From|Sent|Date|To|Subject):", re.IGNORECASE)
+_WORD_RE = re.compile(r"\w+")
+
+# Fixed seeds so signatures stay comparable across runs
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 2 ** 62, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_PERM_B = _rng.randint(0, 2 ** 62, size=NUM_PERM, dtype=np.uint64)
+
+
+def _is_reply_tail(header: str, rest: list) -> bool:
+    """
+        Whether the lines after a reply header are only the quoted message: all "> " quoted after
+        "On ... wrote:", an Outlook header block ("From: ...", "Sent: ...") after "Original Message".
+    """
+    lines = [line.strip() for line in rest if line.strip()]
+    if _REPLY_HEADER_RE.match(header):
+        return all(line.startswith(">") for line in lines)
+    return bool(lines) and _HEADER_FIELD_RE.match(lines[0]) is not None
+
+
+def strip_quoted_replies(text: str) -> str:
+    """
+        Remove quoted reply history. Returns the original text if nothing would be left.
+    """
+    lines = text.splitlines()
+    kept = []
+    for n, line in enumerate(lines):
+        stripped = line.strip()
+        if (_REPLY_HEADER_RE.match(stripped) or _ORIGINAL_MESSAGE_RE.match(stripped)) and _is_reply_tail(stripped, lines[n + 1:]):
+            break
+        if stripped.startswith(">"):
+            continue
+        kept.append(line)
+    result = "\n".join(kept).strip()
+    return result or text
+
+
+def shingles(text: str) -> set:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text: str):
+    """
+        MinHash signature (NUM_PERM uint32 values) of the text, or None when it is too short to compare.
+    """
+    features = shingles(text)
+    if len(features) < MIN_SHINGLES:
+        return None
+    hashes = np.frombuffer(
+        b"".join(hashlib.blake2b(f.encode(), digest_size=8).digest() for f in features),
+        dtype=np.uint64
+    )
+    # Multiply-shift hashing: the wrap-around of uint64 arithmetic is intended
+    with np.errstate(over="ignore"):
+        permuted = (hashes[:, None] * _PERM_A + _PERM_B) >> np.uint64(32)
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def similarity(a, b) -> float:
+    """
+        Estimated Jaccard similarity of two signatures.
+    """
+    return float(np.mean(a == b))
+
+
+def _buckets(signature) -> list:
+    buckets = []
+    for band in range(BANDS):
+        digest = hashlib.blake2b(signature[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).digest()
+        buckets.append((band, int.from_bytes(digest, "big", signed=True)))
+    return buckets
+
+
+class NearDuplicateIndex:
+    def __init__(self, path: str, threshold: float = SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id INTEGER PRIMARY KEY,
+                signature BLOB NOT NULL,
+                canonical_id INTEGER,
+                vector BLOB
+            );
+            CREATE INDEX IF NOT EXISTS docs_canonical ON docs (canonical_id);
+            CREATE TABLE IF NOT EXISTS buckets (
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                doc_id INTEGER NOT NULL,
+                PRIMARY KEY (band, bucket, doc_id)
+            ) WITHOUT ROWID;
+        """)
+        if "vector" not in {row[1] for row in self.db.execute("PRAGMA table_info(docs)")}:
+            # Indexes from before vectors were kept: their duplicates are embedded as usual
+            self.db.execute("ALTER TABLE docs ADD COLUMN vector BLOB")
+        self.db.commit()
+
+    def find(self, signature, exclude: int = None):
+        """
+            Return the canonical doc id of the most similar indexed near duplicate, or None.
+        """
+        candidates = {}
+        for band, bucket in _buckets(signature):
+            rows = self.db.execute(
+                "SELECT d.doc_id, d.signature, d.canonical_id FROM buckets b JOIN docs d ON d.doc_id = b.doc_id "
+                "WHERE b.band = ? AND b.bucket = ?",
+                (band, bucket)
+            )
+            for doc_id, other, canonical_id in rows:
+                candidates[doc_id] = (other, canonical_id)
+
+        best = None
+        for doc_id, (other, canonical_id) in candidates.items():
+            if doc_id == exclude:
+                continue
+            score = similarity(signature, np.frombuffer(other, dtype=np.uint32))
+            if score >= self.threshold and (best is None or score > best[0]):
+                best = (score, canonical_id if canonical_id is not None else doc_id)
+        return best[1] if best else None
+
+    def add(self, doc_id: int, signature, canonical_id: int = None):
+        """
+            Index a document. Only canonical documents are put into the LSH buckets,
+            duplicates are just linked to their canonical document.
+        """
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO docs (doc_id, signature, canonical_id) VALUES (?, ?, ?)",
+                (doc_id, np.asarray(signature, dtype=np.uint32).tobytes(), canonical_id)
+            )
+            if canonical_id is None:
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO buckets (band, bucket, doc_id) VALUES (?, ?, ?)",
+                    [(band, bucket, doc_id) for band, bucket in _buckets(signature)]
+                )
+            self.db.commit()
+
+    def set_vectors(self, vectors: list):
+        """
+            Keep the (doc id, vector) embeddings of indexed documents; ids that are not indexed are ignored.
+        """
+        with self._lock:
+            self.db.executemany(
+                "UPDATE docs SET vector = ? WHERE doc_id = ? AND canonical_id IS NULL",
+                [(np.asarray(vector, dtype=np.float32).tobytes(), doc_id) for doc_id, vector in vectors]
+            )
+            self.db.commit()
+
+    def vectors(self, doc_ids: list) -> dict:
+        """
+            {doc id: vector} for the given canonical documents whose embedding is known.
+        """
+        found = {}
+        for doc_id in set(doc_ids):
+            row = self.db.execute("SELECT vector FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is not None and row[0] is not None:
+                found[doc_id] = np.frombuffer(row[0], dtype=np.float32)
+        return found
+
+    def canonical_id(self, doc_id: int):
+        row = self.db.execute("SELECT canonical_id FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+        return row[0] if row else None
+
+    def duplicates_of(self, canonical_id: int) -> list:
+        return [row[0] for row in self.db.execute("SELECT doc_id FROM docs WHERE canonical_id = ?", (canonical_id,))]
+
+    def reset(self):
+        with self._lock:
+            self.db.executescript("DELETE FROM buckets; DELETE FROM docs;")
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
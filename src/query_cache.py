@@ -0,0 +1,50 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+    Small in-process caches for the query path
+    - TTLCache: LRU cache whose entries also expire after `ttl` seconds
+    - normalize_query: cache key for query text, so "Invoice  from Bob?" and "invoice from bob?" share an entry
+"""
+
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 15 * 60
+
+
+class TTLCache:
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.lower().split())
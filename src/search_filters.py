@@ -0,0 +1,122 @@
+from datetime import timezone
+
+from dateutil import parser
+from qdrant_client.models import FieldCondition, Filter, MatchAny, MatchValue, PayloadSchemaType, Range
+
+"""
+    Payload filters for search
+    - PAYLOAD_INDEXES: payload fields that get an index when a collection is created, so filtered
+      searches are resolved inside the HNSW traversal instead of by over-fetching
+    - build_filter: turn simple arguments ("from X since last month") into a qdrant Filter
+    - matches_filter: evaluate a Filter against a payload in-process (local backend, lexical hits)
+"""
+
+PAYLOAD_INDEXES = {
+    "from_address": PayloadSchemaType.KEYWORD,
+    "thread_id": PayloadSchemaType.KEYWORD,
+    "date": PayloadSchemaType.DATETIME,
+    "timestamp": PayloadSchemaType.INTEGER,
+    "is_reply": PayloadSchemaType.BOOL,
+    "has_link": PayloadSchemaType.BOOL,
+    "attachments": PayloadSchemaType.BOOL,
+    "duplicate_of": PayloadSchemaType.INTEGER,
+}
+
+
+def to_timestamp(value) -> int:
+    """
+        Seconds since the epoch for a datetime, a date string or a number. Naive datetimes are taken as UTC.
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = parser.parse(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def build_filter(sender: str = None, senders: list = None, date_from=None, date_to=None, thread_id: str = None,
+                 is_reply: bool = None, has_link: bool = None, attachments: bool = None) -> Filter:
+    """
+        Build a Filter where every given argument must match. Returns None when no argument is given.
+        - sender / senders: email address(es), matched case-insensitively against `from_address`
+        - date_from / date_to: inclusive bounds, as datetimes, date strings or timestamps
+    """
+    must = []
+    if sender:
+        must.append(FieldCondition(key="from_address", match=MatchValue(value=sender.strip().lower())))
+    if senders:
+        must.append(FieldCondition(key="from_address", match=MatchAny(any=[s.strip().lower() for s in senders])))
+    if date_from is not None or date_to is not None:
+        must.append(FieldCondition(key="timestamp", range=Range(
+            gte=to_timestamp(date_from) if date_from is not None else None,
+            lte=to_timestamp(date_to) if date_to is not None else None,
+        )))
+    if thread_id:
+        must.append(FieldCondition(key="thread_id", match=MatchValue(value=thread_id)))
+    for key, value in (("is_reply", is_reply), ("has_link", has_link), ("attachments", attachments)):
+        if value is not None:
+            must.append(FieldCondition(key=key, match=MatchValue(value=value)))
+    return Filter(must=must) if must else None
+
+
+def matches_filter(payload: dict, query_filter) -> bool:
+    """
+        Evaluate a qdrant_client Filter against a payload: must / should / must_not with
+        match (value, any, except) and range conditions, and nested filters.
+    """
+    must = _as_list(query_filter.must)
+    should = _as_list(query_filter.should)
+    must_not = _as_list(query_filter.must_not)
+    if not all(_matches_condition(payload, c) for c in must):
+        return False
+    if should and not any(_matches_condition(payload, c) for c in should):
+        return False
+    return not any(_matches_condition(payload, c) for c in must_not)
+
+
+def _matches_condition(payload: dict, condition) -> bool:
+    if hasattr(condition, "must"):
+        return matches_filter(payload, condition)
+
+    value = payload.get(condition.key)
+    values = value if isinstance(value, list) else [value]
+    if condition.match is not None:
+        match = condition.match
+        if hasattr(match, "value"):
+            return match.value in values
+        if hasattr(match, "any"):
+            return any(v in match.any for v in values)
+        if hasattr(match, "except_"):
+            return not any(v in match.except_ for v in values)
+        if hasattr(match, "text"):
+            return any(isinstance(v, str) and match.text in v for v in values)
+    if condition.range is not None:
+        return any(_in_range(v, condition.range) for v in values if v is not None)
+    raise ValueError(f"Unsupported filter condition: {condition}")
+
+
+def _in_range(value, bounds) -> bool:
+    if bounds.gt is not None and not value > bounds.gt:
+        return False
+    if bounds.gte is not None and not value >= bounds.gte:
+        return False
+    if bounds.lt is not None and not value < bounds.lt:
+        return False
+    if bounds.lte is not None and not value <= bounds.lte:
+        return False
+    return True
+
+
+def _as_list(conditions) -> list:
+    if conditions is None:
+        return []
+    return conditions if isinstance(conditions, list) else [conditions]
+
+
+def filter_key(query_filter: Filter):
+    """
+        Hashable cache key for a filter.
+    """
+    return query_filter.model_dump_json(exclude_none=True) if query_filter is not None else None
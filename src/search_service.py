@@ -0,0 +1,127 @@
+import os
+import time
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+import mbox_util
+import metrics
+from search_filters import build_filter
+from vector_db_repository import VectorDBRepository
+
+"""
+    Resident search service
+    - Loads the embedding model and the Qdrant client once, at startup
+    - Serves context_search over HTTP so each query only pays for embedding + search; all queries of a
+      request are embedded in one model call and searched with one batch request
+    - /metrics: per-stage latency histograms and counters (see metrics), Prometheus text or ?format=json.
+      Recording is on unless METRICS=false
+
+    Run with:  uvicorn search_service:app --port 8001   (from the src directory)
+"""
+
+load_dotenv()
+
+COLLECTION_NAME = os.getenv("SEARCH_COLLECTION", "emails")
+CHUNK_PASSAGES = os.getenv("SEARCH_CHUNK_PASSAGES", "false").lower() == "true"
+# A resident service is where live metrics are read, so they default to on here
+metrics.enable(os.getenv("METRICS", "true").lower() == "true")
+
+repository = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global repository
+    repository = VectorDBRepository(
+        collection_name=COLLECTION_NAME,
+        use_embedding_cache=False,
+        chunk_passages=CHUNK_PASSAGES,
+    )
+    # Warm the model so the first real query does not pay for loading it
+    mbox_util.create_vector_embedding(data="warm up")
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class SearchRequest(BaseModel):
+    queries: list[str]
+    limit: int = 5
+    # Optional per-query limits, aligned with `queries`; `limit` applies when absent
+    limits: list[int] | None = None
+    # Optional filters, applied to every query in the request
+    sender: str | None = None
+    date_from: str | None = None
+    date_to: str | None = None
+    thread_id: str | None = None
+
+
+class SearchHit(BaseModel):
+    id: int | str
+    score: float
+    payload: dict | None = None
+
+
+class QueryResult(BaseModel):
+    query: str
+    # Queries are searched together, so this is the time until the whole batch was answered
+    latency_ms: float
+    hits: list[SearchHit]
+
+
+class SearchResponse(BaseModel):
+    latency_ms: float
+    results: list[QueryResult]
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "collection": COLLECTION_NAME}
+
+
+@app.get("/metrics")
+async def get_metrics(format: str = "prometheus"):
+    if format == "json":
+        return metrics.registry.snapshot()
+    return PlainTextResponse(metrics.registry.prometheus_text())
+
+
+@app.post("/search", response_model=SearchResponse)
+def search(request: SearchRequest):
+    start = time.perf_counter()
+    query_filter = build_filter(
+        sender=request.sender,
+        date_from=request.date_from,
+        date_to=request.date_to,
+        thread_id=request.thread_id,
+    )
+    if request.limits is not None and len(request.limits) != len(request.queries):
+        raise HTTPException(status_code=422, detail="limits must have one entry per query")
+    batch_hits = repository.context_search_batch(
+        texts=request.queries,
+        limit=request.limits if request.limits is not None else request.limit,
+        query_filter=query_filter,
+    )
+    latency = time.perf_counter() - start
+    results = [
+        QueryResult(
+            query=query,
+            latency_ms=latency * 1000,
+            hits=[SearchHit(id=hit.id, score=hit.score, payload=hit.payload) for hit in hits],
+        )
+        for query, hits in zip(request.queries, batch_hits)
+    ]
+    metrics.observe("request_seconds", latency, endpoint="search")
+    metrics.count("queries_total", len(request.queries))
+    return SearchResponse(latency_ms=latency * 1000, results=results)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("SEARCH_PORT", "8001")))
@@ -0,0 +1,216 @@
+import argparse
+import itertools
+import mailbox
+import math
+import os
+import random
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+from io import BytesIO
+
+import fitz
+from docx import Document
+
+from mbox_index import INDEX_SUFFIX
+
+"""
+    Synthetic mbox generator
+    - Reproducible from a seed: the same config always writes the same messages
+    - Body lengths follow a log-normal distribution around `median_words`, words follow a Zipf-like
+      distribution over a generated vocabulary, so text and token counts look like real mail
+    - Configurable mix of plain text / HTML / multipart-alternative bodies, PDF and DOCX attachments
+      (drawn from a small pool, like files that get forwarded around), mailing-list mail and replies
+      with In-Reply-To / References and quoted history
+
+    Run from the src directory:  python synthetic_mbox.py /tmp/bench/mbox --messages 5000
+"""
+
+
+@dataclass
+class SyntheticMboxConfig:
+    messages: int = 1000
+    seed: int = 0
+    median_words: int = 150
+    size_sigma: float = 1.0         # log-normal spread of body lengths
+    html_ratio: float = 0.5         # messages with an HTML body
+    alternative_ratio: float = 0.6  # of the HTML messages, those that also have a text/plain alternative
+    pdf_ratio: float = 0.05
+    docx_ratio: float = 0.03
+    pdf_pages: int = 3
+    attachment_pool: int = 20       # distinct attachments, the rest are repeats
+    list_ratio: float = 0.78        # mailing-list mail (List-Unsubscribe), the share seen in a real mailbox
+    reply_ratio: float = 0.3        # of the personal (non-list) mail
+    senders: int = 50
+    vocabulary: int = 5000
+
+
+_SYLLABLES = ["ka", "lo", "mi", "ne", "ra", "to", "su", "vi", "pe", "do", "an", "el", "or", "un", "is", "ba", "ct", "st", "tr", "qu"]
+
+
+class _Writer:
+    def __init__(self, config: SyntheticMboxConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.words = self._vocabulary()
+        # Zipf-like weights: the n-th most common word is used about 1/n as often as the first
+        self.cum_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, len(self.words) + 1)))
+        self.senders = [f"{self._word()}.{self._word()}@{self._word()}.example" for _ in range(config.senders)]
+        self.lists = [(f"{self._word()}-news", f"news@{self._word()}.example") for _ in range(max(1, config.senders // 5))]
+        self.pdfs, self.docxs = {}, {}
+        self.sent = []
+
+    def _vocabulary(self) -> list:
+        words = set()
+        while len(words) < self.config.vocabulary:
+            words.add("".join(self.rng.choice(_SYLLABLES) for _ in range(self.rng.randint(1, 4))))
+        # Sorted first so the order (and so each word's frequency rank) only depends on the seed
+        words = sorted(words)
+        self.rng.shuffle(words)
+        return words
+
+    def _word(self) -> str:
+        return self.rng.choice(self.words)
+
+    def text(self, n_words: int) -> str:
+        words = self.rng.choices(self.words, cum_weights=self.cum_weights, k=n_words)
+        sentences, start = [], 0
+        while start < len(words):
+            end = start + self.rng.randint(6, 18)
+            sentences.append(" ".join(words[start:end]).capitalize() + ".")
+            start = end
+        lines, start = [], 0
+        while start < len(sentences):
+            end = start + self.rng.randint(1, 4)
+            lines.append(" ".join(sentences[start:end]))
+            start = end
+        return "\n\n".join(lines)
+
+    def body_words(self) -> int:
+        mu = math.log(self.config.median_words)
+        return max(5, int(self.rng.lognormvariate(mu, self.config.size_sigma)))
+
+    def html(self, text: str, newsletter: bool) -> str:
+        paragraphs = "".join(f"<p>{p}</p>" for p in text.split("\n\n"))
+        if newsletter:
+            rows = "".join(f"<tr><td><a href='https://shop.example/{i}'>{self._word()}</a></td><td>&euro;{self.rng.randint(1, 999)}</td></tr>" for i in range(self.rng.randint(3, 15)))
+            paragraphs += f"<table>{rows}</table><p style='font-size:10px'>Unsubscribe <a href='https://shop.example/u'>here</a></p>"
+        return f"<html><head><style>p {{ margin: 0 }}</style></head><body>{paragraphs}</body></html>"
+
+    def pdf(self) -> tuple:
+        key = self.rng.randrange(self.config.attachment_pool)
+        if key not in self.pdfs:
+            with fitz.open() as doc:
+                for _ in range(self.config.pdf_pages):
+                    page = doc.new_page()
+                    page.insert_textbox(fitz.Rect(50, 50, 550, 800), self.text(250), fontsize=9)
+                self.pdfs[key] = doc.tobytes()
+        return self.pdfs[key], f"report-{key}.pdf"
+
+    def docx(self) -> tuple:
+        key = self.rng.randrange(self.config.attachment_pool)
+        if key not in self.docxs:
+            document = Document()
+            for paragraph in self.text(300).split("\n\n"):
+                document.add_paragraph(paragraph)
+            buffer = BytesIO()
+            document.save(buffer)
+            self.docxs[key] = buffer.getvalue()
+        return self.docxs[key], f"notes-{key}.docx"
+
+    def message(self, n: int, date: datetime) -> EmailMessage:
+        rng, config = self.rng, self.config
+        message = EmailMessage()
+        message_id = f"<{n}.{rng.getrandbits(40):x}@synthetic.example>"
+        text = self.text(self.body_words())
+        is_list = rng.random() < config.list_ratio
+        subject = " ".join(self._word() for _ in range(rng.randint(2, 6))).capitalize()
+
+        if is_list:
+            list_name, list_address = rng.choice(self.lists)
+            message["From"] = f"{list_name} <{list_address}>"
+            message["List-Id"] = f"<{list_name}.lists.example>"
+            message["List-Unsubscribe"] = f"<mailto:unsubscribe@{list_address.split('@')[1]}>"
+            if rng.random() < 0.5:
+                message["Precedence"] = "bulk"
+        else:
+            message["From"] = rng.choice(self.senders)
+            if self.sent and rng.random() < config.reply_ratio:
+                parent_id, parent_subject, parent_text, parent_refs = rng.choice(self.sent[-200:])
+                subject = "Re: " + parent_subject.removeprefix("Re: ")
+                message["In-Reply-To"] = parent_id
+                message["References"] = " ".join(parent_refs + [parent_id])
+                quoted = "\n".join("> " + line for line in parent_text.splitlines()[:20])
+                text += f"\n\nOn {format_datetime(date)}, someone wrote:\n{quoted}"
+            self.sent.append((message_id, subject, text, message.get("References", "").split()))
+
+        message["To"] = "me@synthetic.example"
+        message["Subject"] = subject
+        message["Date"] = format_datetime(date)
+        message["Message-ID"] = message_id
+
+        if rng.random() < config.html_ratio:
+            if rng.random() < config.alternative_ratio:
+                message.set_content(text)
+                message.add_alternative(self.html(text, is_list), subtype="html")
+            else:
+                message.set_content(self.html(text, is_list), subtype="html")
+        else:
+            message.set_content(text)
+
+        if rng.random() < config.pdf_ratio:
+            data, filename = self.pdf()
+            message.add_attachment(data, maintype="application", subtype="pdf", filename=filename)
+        if rng.random() < config.docx_ratio:
+            data, filename = self.docx()
+            message.add_attachment(data, maintype="application",
+                                   subtype="vnd.openxmlformats-officedocument.wordprocessingml.document", filename=filename)
+        return message
+
+
+def generate_mbox(path: str, config: SyntheticMboxConfig = None) -> str:
+    """
+        Write a new mbox at `path` (replacing any existing one and its index) and return the path.
+    """
+    config = config or SyntheticMboxConfig()
+    for existing in (path, path + INDEX_SUFFIX):
+        if os.path.exists(existing):
+            os.remove(existing)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    writer = _Writer(config)
+    date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    box = mailbox.mbox(path)
+    try:
+        for n in range(config.messages):
+            date += timedelta(minutes=writer.rng.randint(1, 600))
+            box.add(writer.message(n, date))
+        box.flush()
+    finally:
+        box.close()
+    return path
+
+
+def add_config_arguments(arg_parser: argparse.ArgumentParser):
+    """
+        One --option per SyntheticMboxConfig field.
+    """
+    for field in fields(SyntheticMboxConfig):
+        arg_parser.add_argument(f"--{field.name.replace('_', '-')}", type=type(field.default), default=field.default)
+
+
+def config_from_args(args) -> SyntheticMboxConfig:
+    return SyntheticMboxConfig(**{field.name: getattr(args, field.name) for field in fields(SyntheticMboxConfig)})
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Write a synthetic mbox")
+    arg_parser.add_argument("path")
+    add_config_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    config = config_from_args(args)
+    generate_mbox(args.path, config)
+    print(f"Wrote {config.messages} messages ({os.path.getsize(args.path) / 1024 ** 2:.1f} MiB) to {args.path}")
+    print(asdict(config))
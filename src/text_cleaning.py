@@ -0,0 +1,62 @@
+import re
+
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:
+    lxml_html = None
+
+"""
+    Message text cleaning
+    - clean_html: visible text of an HTML document, one text node per line, blank lines dropped.
+      Uses lxml when it is installed and falls back to BeautifulSoup's html.parser otherwise
+      (or when lxml cannot parse the document, or would drop content after the first </html>)
+    - clean_html_soup: the original BeautifulSoup cleaner, kept as the reference implementation
+    - normalize_lines: the whitespace normalization both apply, for text that is not HTML
+"""
+
+# libxml2 stops at the first </html>: a list footer or a second document after it would be lost
+_HTML_END_RE = re.compile(r"</html\s*>", re.IGNORECASE)
+
+
+def normalize_lines(text: str) -> str:
+    """
+        Strip every line and drop the empty ones.
+    """
+    return "\n".join(filter(None, (line.strip() for line in text.splitlines())))
+
+
+def clean_html_soup(html: str) -> str:
+    soup = BeautifulSoup(html, "html.parser")
+
+    for tag in soup(["script", "style"]):
+        tag.decompose()
+
+    text = soup.get_text(separator="\n")
+    return normalize_lines(text)
+
+
+def clean_html_lxml(html: str) -> str:
+    if not html.strip():
+        return ""
+    document = lxml_html.document_fromstring(html)
+    for element in document.iter("script", "style"):
+        # clear() instead of drop_tree() so the text after the tag stays its own line, as with BeautifulSoup
+        element.clear(keep_tail=True)
+    return normalize_lines("\n".join(document.itertext()))
+
+
+def _has_content_after_end(html: str) -> bool:
+    end = _HTML_END_RE.search(html)
+    return end is not None and bool(html[end.end():].strip())
+
+
+def clean_html(html: str) -> str:
+    if lxml_html is not None and not _has_content_after_end(html):
+        try:
+            return clean_html_lxml(html)
+        except (etree.ParserError, ValueError):
+            # e.g. a str with an XML encoding declaration
+            pass
+    return clean_html_soup(html)
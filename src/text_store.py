@@ -0,0 +1,88 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+
+"""
+    Append-only store of cleaned message text
+    - Each text is zlib-compressed and appended to one file; its (offset, length) goes into the point
+      payload, so reading it back is a single pread with no lookup and no re-parsing of the message
+    - Appends happen before the points are upserted: a crash in between only leaves unreferenced bytes
+    - Index: SQLite table mapping the SHA-1 of each text to its location, so a text that is stored
+      already (a retried batch, a re-ingested message) is found without asking the vector store
+    - A re-ingested message whose text changed gets a new blob; the old one stays in the file until reset()
+"""
+
+COMPRESSION_LEVEL = 6
+_QUERY_CHUNK = 500
+
+
+class TextStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "ab")
+        self._fd = os.open(path, os.O_RDONLY)
+        self.db = sqlite3.connect(f"{path}.sqlite3", check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS texts (text_hash TEXT PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL)")
+        self.db.commit()
+
+    def find(self, text_hashes: list) -> dict:
+        """
+            {text hash: (offset, length)} for the hashes whose text is stored.
+        """
+        locations = {}
+        with self._lock:
+            # In chunks, under SQLite's limit on bound parameters
+            for start in range(0, len(text_hashes), _QUERY_CHUNK):
+                chunk = text_hashes[start:start + _QUERY_CHUNK]
+                rows = self.db.execute(
+                    f"SELECT text_hash, offset, length FROM texts WHERE text_hash IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                locations.update((text_hash, (offset, length)) for text_hash, offset, length in rows)
+        return locations
+
+    def append(self, texts: list) -> list:
+        """
+            Store texts and return their (offset, length) locations, in the same order.
+        """
+        blobs = [zlib.compress(text.encode("utf-8", errors="replace"), COMPRESSION_LEVEL) for text in texts]
+        with self._lock:
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(b"".join(blobs))
+            self._file.flush()
+            locations = []
+            for blob in blobs:
+                locations.append((offset, len(blob)))
+                offset += len(blob)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO texts (text_hash, offset, length) VALUES (?, ?, ?)",
+                [(text_hash(text), *location) for text, location in zip(texts, locations)]
+            )
+            self.db.commit()
+        return locations
+
+    def read(self, offset: int, length: int) -> str:
+        return zlib.decompress(os.pread(self._fd, length, offset)).decode("utf-8", errors="replace")
+
+    def size(self) -> int:
+        return os.fstat(self._fd).st_size
+
+    def reset(self):
+        with self._lock:
+            self._file.truncate(0)
+            self._file.flush()
+            self.db.execute("DELETE FROM texts")
+            self.db.commit()
+
+    def close(self):
+        self._file.close()
+        os.close(self._fd)
+        self.db.close()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8", errors="replace")).hexdigest()
@@ -0,0 +1,257 @@
+import hashlib
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+"""
+    Conversation threading from Message-ID / In-Reply-To / References (JWZ style)
+    - containers: one per message id seen, including ids only known from other messages' References,
+      linked to their parent so a thread is found even when some of its messages are missing
+    - every container carries the id of the thread it belongs to; when a new message links two
+      threads, the later one is merged into the earlier one. The merge is only logged (so stored
+      payloads and the thread point can be relabeled) when the absorbed thread has messages:
+      a reply joining its parent's thread absorbs nothing but its own empty thread
+    - threads: running sum of member vectors plus a few aggregates, kept per thread
+    Threads are never grouped by subject, so unrelated "Hello" messages stay apart.
+"""
+
+MAX_DEPTH = 1000
+
+_MESSAGE_ID_RE = re.compile(r"<[^<>\s]+>")
+
+
+def parse_message_ids(value) -> list:
+    """
+        Message ids ("<...>") in a Message-ID / In-Reply-To / References header value, in order.
+    """
+    return _MESSAGE_ID_RE.findall(str(value)) if value else []
+
+
+def make_thread_id(message_id: str) -> str:
+    # 60 bits, so the id also fits a signed 64-bit point id (see thread_point_id)
+    return hashlib.md5(message_id.encode()).hexdigest()[:15]
+
+
+def thread_point_id(thread_id: str) -> int:
+    return int(thread_id, 16)
+
+
+class ThreadIndex:
+    def __init__(self, path: str):
+        self._lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS containers (
+                message_id TEXT PRIMARY KEY,
+                parent TEXT,
+                thread_id TEXT NOT NULL,
+                doc_id INTEGER UNIQUE,
+                aggregated INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS containers_thread ON containers (thread_id);
+            CREATE TABLE IF NOT EXISTS threads (
+                thread_id TEXT PRIMARY KEY,
+                vector_sum BLOB NOT NULL,
+                n_messages INTEGER NOT NULL,
+                subject TEXT,
+                first_timestamp INTEGER,
+                last_timestamp INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS merges (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                old_thread_id TEXT NOT NULL,
+                new_thread_id TEXT NOT NULL
+            );
+        """)
+        self.db.commit()
+
+    # -----
+    # Linking
+    # -----
+
+    def add_message(self, doc_id: int, message_id: str, references: list) -> str:
+        """
+            Link a message into its thread and return the thread id.
+            `references` are the References ids followed by In-Reply-To, oldest first.
+            Re-adding a message that is already indexed is a no-op.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT thread_id FROM containers WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row:
+                return self.thread_of(doc_id)
+
+            if not message_id:
+                message_id = f"<doc-{doc_id}@local>"
+            elif self._container(message_id) and self._container(message_id)[2] is not None:
+                # Same Message-ID twice in the mailbox, keep them as separate messages
+                message_id = f"{message_id}#{doc_id}"
+
+            chain = []
+            for ref in references:
+                if ref != message_id and ref not in chain:
+                    chain.append(ref)
+            for mid in chain + [message_id]:
+                self._ensure(mid)
+
+            # References give the ancestry, oldest first; only fill in links that are missing
+            for parent, child in zip(chain, chain[1:]):
+                if self._container(child)[0] is None:
+                    self._link(parent, child)
+            # The message's own headers are authoritative for its parent
+            if chain:
+                self._link(chain[-1], message_id, replace=True)
+
+            self.db.execute("UPDATE containers SET doc_id = ? WHERE message_id = ?", (doc_id, message_id))
+            self.db.commit()
+            return self._container(message_id)[1]
+
+    def _container(self, message_id: str):
+        return self.db.execute(
+            "SELECT parent, thread_id, doc_id FROM containers WHERE message_id = ?", (message_id,)
+        ).fetchone()
+
+    def _ensure(self, message_id: str):
+        self.db.execute(
+            "INSERT OR IGNORE INTO containers (message_id, thread_id) VALUES (?, ?)",
+            (message_id, make_thread_id(message_id))
+        )
+
+    def _link(self, parent: str, child: str, replace: bool = False):
+        current = self._container(child)[0]
+        if current == parent or (current is not None and not replace) or self._is_ancestor(child, parent):
+            return
+        self.db.execute("UPDATE containers SET parent = ? WHERE message_id = ?", (parent, child))
+        self._merge(self._container(parent)[1], self._container(child)[1])
+
+    def _is_ancestor(self, ancestor: str, message_id: str) -> bool:
+        # Walking up from message_id reaches ancestor: linking ancestor under message_id would make a loop
+        for _ in range(MAX_DEPTH):
+            if message_id is None:
+                return False
+            if message_id == ancestor:
+                return True
+            row = self._container(message_id)
+            message_id = row[0] if row else None
+        return True
+
+    def _merge(self, keep: str, absorb: str):
+        if keep == absorb:
+            return
+        # Messages of the absorbed thread that were added before this one, stored or still on their way
+        has_messages = self.db.execute(
+            "SELECT 1 FROM containers WHERE thread_id = ? AND doc_id IS NOT NULL LIMIT 1", (absorb,)
+        ).fetchone() is not None
+        self.db.execute("UPDATE containers SET thread_id = ? WHERE thread_id = ?", (keep, absorb))
+        absorbed = self.db.execute("SELECT * FROM threads WHERE thread_id = ?", (absorb,)).fetchone()
+        if absorbed is not None:
+            self.db.execute("DELETE FROM threads WHERE thread_id = ?", (absorb,))
+            _, vector_sum, n_messages, subject, first_timestamp, last_timestamp = absorbed
+            self._accumulate(keep, np.frombuffer(vector_sum, dtype=np.float32), n_messages, subject,
+                             first_timestamp, last_timestamp)
+        if has_messages or absorbed is not None:
+            self.db.execute("INSERT INTO merges (old_thread_id, new_thread_id) VALUES (?, ?)", (absorb, keep))
+
+    # -----
+    # Aggregates
+    # -----
+
+    def add_vector(self, doc_id: int, vector, subject: str = None, timestamp: int = None) -> str:
+        """
+            Add a stored message's vector to its thread aggregate, once. Returns the thread id.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT thread_id, aggregated FROM containers WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is None:
+                return None
+            thread_id, aggregated = row
+            if not aggregated:
+                self._accumulate(thread_id, np.asarray(vector, dtype=np.float32), 1, subject, timestamp, timestamp)
+                self.db.execute("UPDATE containers SET aggregated = 1 WHERE doc_id = ?", (doc_id,))
+                self.db.commit()
+            return thread_id
+
+    def _accumulate(self, thread_id: str, vector_sum, n_messages: int, subject, first_timestamp, last_timestamp):
+        row = self.db.execute(
+            "SELECT vector_sum, n_messages, subject, first_timestamp, last_timestamp FROM threads WHERE thread_id = ?",
+            (thread_id,)
+        ).fetchone()
+        if row is not None:
+            vector_sum = np.frombuffer(row[0], dtype=np.float32) + vector_sum
+            n_messages += row[1]
+            # The subject of the earliest message names the thread
+            if row[2] is not None and (first_timestamp is None or (row[3] is not None and row[3] <= first_timestamp)):
+                subject = row[2]
+            first_timestamp = min((t for t in (row[3], first_timestamp) if t is not None), default=None)
+            last_timestamp = max((t for t in (row[4], last_timestamp) if t is not None), default=None)
+        self.db.execute(
+            "INSERT OR REPLACE INTO threads (thread_id, vector_sum, n_messages, subject, first_timestamp, last_timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (thread_id, np.asarray(vector_sum, dtype=np.float32).tobytes(), n_messages, subject, first_timestamp, last_timestamp)
+        )
+
+    def peek_merges(self) -> list:
+        """
+            The (seq, old thread id, new thread id) merges logged and not yet acknowledged, oldest first.
+        """
+        with self._lock:
+            return self.db.execute("SELECT seq, old_thread_id, new_thread_id FROM merges ORDER BY seq").fetchall()
+
+    def ack_merges(self, seqs: list):
+        """
+            Forget merges once the points of the old threads are relabeled.
+        """
+        if not seqs:
+            return
+        with self._lock:
+            self.db.executemany("DELETE FROM merges WHERE seq = ?", [(seq,) for seq in seqs])
+            self.db.commit()
+
+    # -----
+    # Lookups
+    # -----
+
+    def thread_of(self, doc_id: int) -> str:
+        row = self.db.execute("SELECT thread_id FROM containers WHERE doc_id = ?", (doc_id,)).fetchone()
+        return row[0] if row else None
+
+    def members(self, thread_id: str) -> list:
+        """
+            Ids of the stored messages in a thread.
+        """
+        return [row[0] for row in self.db.execute(
+            "SELECT doc_id FROM containers WHERE thread_id = ? AND aggregated = 1 ORDER BY doc_id", (thread_id,)
+        )]
+
+    def thread(self, thread_id: str) -> dict:
+        """
+            Aggregate of a thread: normalized mean vector and payload, or None if none of its messages are stored.
+        """
+        row = self.db.execute(
+            "SELECT vector_sum, n_messages, subject, first_timestamp, last_timestamp FROM threads WHERE thread_id = ?",
+            (thread_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        vector = np.frombuffer(row[0], dtype=np.float32)
+        return {
+            "vector": vector / (np.linalg.norm(vector) or 1.0),
+            "payload": {
+                "thread_id": thread_id,
+                "subject": row[2],
+                "n_messages": row[1],
+                "first_timestamp": row[3],
+                "last_timestamp": row[4],
+                "document_ids": self.members(thread_id),
+            },
+        }
+
+    def reset(self):
+        with self._lock:
+            self.db.executescript("DELETE FROM containers; DELETE FROM threads; DELETE FROM merges;")
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
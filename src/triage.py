@@ -0,0 +1,91 @@
+import os
+from dataclasses import dataclass, field
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr
+
+"""
+    Header-only triage
+    - parse_headers: parse only the header block of a raw message, the body is never decoded
+    - TriageRules: decide per message whether the body pipeline (decoding, HTML cleaning,
+      attachment extraction, embedding of the body) is worth running
+        index    full body pipeline
+        headers  low priority: indexed from its headers only (subject, sender, date)
+        skip     not indexed, the reason is recorded in the ingest journal
+"""
+
+INDEX = "index"
+HEADERS = "headers"
+SKIP = "skip"
+ACTIONS = (INDEX, HEADERS, SKIP)
+
+_BULK_PRECEDENCE = ("bulk", "list", "junk")
+_header_parser = BytesHeaderParser()
+
+
+def parse_headers(raw: bytes):
+    """
+        Parse the headers of raw message bytes (with or without the From_ line) into an email.message.Message.
+    """
+    if raw.startswith(b"From "):
+        raw = raw[raw.find(b"\n") + 1:]
+    end = raw.find(b"\n\n")
+    return _header_parser.parsebytes(raw if end == -1 else raw[:end + 1])
+
+
+def _sender_set(value: str) -> frozenset:
+    return frozenset(s.strip().lower() for s in (value or "").split(",") if s.strip())
+
+
+@dataclass(frozen=True)
+class TriageRules:
+    list_mail: str = INDEX          # mail with List-Unsubscribe / List-Id
+    bulk: str = INDEX               # Precedence: bulk / list / junk
+    max_bytes: int = None           # raw size above which `oversized` applies (None = no cap)
+    oversized: str = HEADERS
+    # Addresses ("bob@example.com") or domains ("@example.com"); deny wins over allow, allow wins over the rest
+    allow_senders: frozenset = field(default_factory=frozenset)
+    deny_senders: frozenset = field(default_factory=frozenset)
+
+    def __post_init__(self):
+        for name in ("list_mail", "bulk", "oversized"):
+            if getattr(self, name) not in ACTIONS:
+                raise ValueError(f"Unknown triage action for {name}: {getattr(self, name)}. Choose from {', '.join(ACTIONS)}")
+
+    @classmethod
+    def from_env(cls) -> "TriageRules":
+        """
+            Rules from TRIAGE_LIST_MAIL, TRIAGE_BULK, TRIAGE_MAX_BYTES, TRIAGE_OVERSIZED,
+            TRIAGE_ALLOW_SENDERS and TRIAGE_DENY_SENDERS (comma separated). Unset means index everything.
+        """
+        max_bytes = os.getenv("TRIAGE_MAX_BYTES")
+        return cls(
+            list_mail=os.getenv("TRIAGE_LIST_MAIL", INDEX),
+            bulk=os.getenv("TRIAGE_BULK", INDEX),
+            max_bytes=int(max_bytes) if max_bytes else None,
+            oversized=os.getenv("TRIAGE_OVERSIZED", HEADERS),
+            allow_senders=_sender_set(os.getenv("TRIAGE_ALLOW_SENDERS")),
+            deny_senders=_sender_set(os.getenv("TRIAGE_DENY_SENDERS")),
+        )
+
+    @property
+    def active(self) -> bool:
+        return (self.list_mail != INDEX or self.bulk != INDEX or self.max_bytes is not None
+                or bool(self.deny_senders))
+
+    def decide(self, headers, size: int) -> tuple:
+        """
+            Return (action, reason) for a message from its parsed headers and raw size in bytes.
+        """
+        sender = parseaddr(str(headers.get("From", "")))[1].lower()
+        domain = sender[sender.find("@"):] if "@" in sender else None
+        if sender in self.deny_senders or domain in self.deny_senders:
+            return SKIP, "denied sender"
+        if sender in self.allow_senders or domain in self.allow_senders:
+            return INDEX, "allowed sender"
+        if self.max_bytes is not None and size > self.max_bytes:
+            return self.oversized, "oversized"
+        if headers.get("List-Unsubscribe") or headers.get("List-Id"):
+            return self.list_mail, "mailing list"
+        if str(headers.get("Precedence", "")).strip().lower() in _BULK_PRECEDENCE:
+            return self.bulk, "bulk"
+        return INDEX, None
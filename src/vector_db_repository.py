@@ -1,23 +1,106 @@
 import os
+import re
+import time
 from datetime import datetime
 from tqdm import tqdm
 from qdrant_client import QdrantClient
-from qdrant_client.models import Filter, FieldCondition, MatchValue, Record
+from qdrant_client.models import Batch, Filter, FieldCondition, MatchValue, Record, ScoredPoint, SearchRequest
+import numpy as np
 from dotenv import load_dotenv
 
-import csv_logging_repository
+import hashlib
 import mbox_util
+import metrics
+import chunking
+from embedding_cache import EmbeddingCache
+from batch_writer import BatchWriter
+from ingest_journal import IngestJournal, journal_path
+from query_cache import TTLCache, normalize_query
+from local_vector_store import LocalVectorClient
+from collection_profiles import get_profile
+from search_filters import PAYLOAD_INDEXES, filter_key, matches_filter
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from near_duplicates import NearDuplicateIndex, minhash, strip_quoted_replies
+from triage import TriageRules
+from thread_index import ThreadIndex, thread_point_id
+from text_store import TextStore, text_hash
 
 load_dotenv()
 
 QDRANT_URL = "http://localhost:6333"
+EMBEDDING_CACHE_DIR = os.path.join(mbox_util.BASE_DIR, "cache", "embeddings")
+LEXICAL_INDEX_DIR = os.path.join(mbox_util.BASE_DIR, "cache", "lexical")
+NEAR_DUPLICATE_DIR = os.path.join(mbox_util.BASE_DIR, "cache", "near_duplicates")
+THREAD_INDEX_DIR = os.path.join(mbox_util.BASE_DIR, "cache", "threads")
+TEXT_STORE_DIR = os.path.join(mbox_util.BASE_DIR, "cache", "texts")
+# Default size of rehydrated context, in whitespace tokens (the n_tokens measure of the payload)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+# Longest wait between polls of follow_mailbox after repeated errors, in seconds
+FOLLOW_MAX_BACKOFF = float(os.getenv("FOLLOW_MAX_BACKOFF", 60))
+
+# "qdrant" talks to the server at QDRANT_URL, "local" uses the embedded store in LOCAL_VECTOR_PATH
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "qdrant")
+LOCAL_VECTOR_PATH = os.getenv("LOCAL_VECTOR_PATH", os.path.join(mbox_util.BASE_DIR, "local_vectors"))
+
+def create_client(backend: str = None):
+    """
+        Build the storage client for a backend name. Both expose the same QdrantClient-style API.
+    """
+    backend = backend or VECTOR_BACKEND
+    if backend == "local":
+        return LocalVectorClient(LOCAL_VECTOR_PATH)
+    if backend == "qdrant":
+        return QdrantClient(url=QDRANT_URL)
+    raise ValueError(f"Unknown vector backend: {backend}")
 
 class VectorDBRepository:
-    def __init__(self, collection_name: str, batch_size: int = 500):
-        self.client = QdrantClient(url=QDRANT_URL)
+    def __init__(self, collection_name: str, batch_size: int = 500, embed_batch_size: int = mbox_util.EMBED_BATCH_SIZE, embed_parallel: int = None, extract_workers: int = mbox_util.EXTRACT_WORKERS, message_timeout: float = mbox_util.MESSAGE_TIMEOUT, use_embedding_cache: bool = True, chunk_passages: bool = False, async_flush: bool = True, client = None, profile = "default", lexical: bool = True, dedupe: bool = True, triage_rules: TriageRules = None, threads: bool = True, store_text: bool = True):
+        self.client = client if client is not None else create_client()
         self.collection_name = collection_name
+        self.profile = get_profile(profile)
         self.batch_size = batch_size
+        self.embed_batch_size = embed_batch_size
+        self.embed_parallel = embed_parallel
+        self.extract_workers = extract_workers
+        self.message_timeout = message_timeout
+        self.embedding_cache = EmbeddingCache(EMBEDDING_CACHE_DIR, mbox_util.EMBEDDING_MODEL_NAME, mbox_util.EMBEDDING_DIM) if use_embedding_cache else None
+        self.chunk_passages = chunk_passages
+        self.passage_collection_name = f"{collection_name}_passages"
         self._buffer = []
+        self._passage_buffer = []
+        self._query_embedding_cache = TTLCache()
+        self._result_cache = TTLCache()
+        # Journal generation the cached results were computed at, see _cached_results
+        self._cache_generation = None
+        # Upserts run on a background thread so embedding continues while a batch is being written
+        self._writer = BatchWriter(self._write_batch) if async_flush else None
+        self.journal = IngestJournal(journal_path(collection_name))
+        self.lexical_index = None
+        if lexical:
+            os.makedirs(LEXICAL_INDEX_DIR, exist_ok=True)
+            self.lexical_index = LexicalIndex(os.path.join(LEXICAL_INDEX_DIR, f"{collection_name}.sqlite3"))
+        # Header-only triage decides which messages go through the body pipeline (see triage.TriageRules)
+        self.triage_rules = triage_rules if triage_rules is not None else TriageRules.from_env()
+        # Quoted history is stripped and near duplicates (newsletters, re-sent replies) are linked to the first copy
+        self.near_duplicates = None
+        if dedupe:
+            os.makedirs(NEAR_DUPLICATE_DIR, exist_ok=True)
+            self.near_duplicates = NearDuplicateIndex(os.path.join(NEAR_DUPLICATE_DIR, f"{collection_name}.sqlite3"))
+        # Conversations from Message-ID / References, with one aggregate vector per thread in their own collection
+        self.thread_collection_name = f"{collection_name}_threads"
+        self.thread_index = None
+        if threads:
+            os.makedirs(THREAD_INDEX_DIR, exist_ok=True)
+            self.thread_index = ThreadIndex(os.path.join(THREAD_INDEX_DIR, f"{collection_name}.sqlite3"))
+        # Cleaned text kept at ingest, so search hits can be turned into prompt context without re-parsing (see rehydrate)
+        self.text_store = None
+        if store_text:
+            os.makedirs(TEXT_STORE_DIR, exist_ok=True)
+            self.text_store = TextStore(os.path.join(TEXT_STORE_DIR, f"{collection_name}.texts"))
+        # Read when a metrics snapshot is taken
+        metrics.gauge("buffered_documents", lambda: len(self._buffer), collection=collection_name)
+        if self._writer is not None:
+            metrics.gauge("write_queue_depth", self._writer.pending, collection=collection_name)
         
     # -----
     # Collection Management
@@ -27,29 +110,63 @@ class VectorDBRepository:
         """
             Create a collection in the database if it does not already exist. 
         """
+        if self.chunk_passages and not self.client.collection_exists(collection_name=self.passage_collection_name):
+            self._create_profiled_collection(self.passage_collection_name)
+        if self.thread_index is not None and not self.client.collection_exists(collection_name=self.thread_collection_name):
+            self._create_profiled_collection(self.thread_collection_name)
+        
         if self.client.collection_exists(collection_name=self.collection_name):
             return False
         
+        self._create_profiled_collection(self.collection_name)
+        return True
+
+    def _create_profiled_collection(self, collection_name: str):
+        """
+            Vector storage, quantization and HNSW settings come from the repository's collection profile.
+        """
         self.client.create_collection(
-            collection_name=self.collection_name,
-            vectors_config={
-                "size": 384,
-                "distance": "Cosine"
-            }
+            collection_name=collection_name,
+            vectors_config=self.profile.vectors_config(384),
+            hnsw_config=self.profile.hnsw_config(),
+            quantization_config=self.profile.quantization_config()
         )
-        return True
+        self.create_payload_indexes(collection_name)
+
+    def create_payload_indexes(self, collection_name: str = None):
+        """
+            Index the payload fields used by search filters (see search_filters.PAYLOAD_INDEXES).
+            New collections get them automatically; call this once for collections created before filters existed.
+        """
+        for field_name, field_schema in PAYLOAD_INDEXES.items():
+            self.client.create_payload_index(
+                collection_name=collection_name or self.collection_name,
+                field_name=field_name,
+                field_schema=field_schema
+            )
 
     def delete_collection(self):
         """
             Delete the collection from the database.
         """
-        csv_logging_repository.update_csv(
-            processed_increment=0,
-            skipped_increment=0
-        )
+        self.journal.reset()
+        if self.lexical_index is not None:
+            self.lexical_index.reset()
+        if self.near_duplicates is not None:
+            self.near_duplicates.reset()
+        if self.thread_index is not None:
+            self.thread_index.reset()
+        if self.text_store is not None:
+            self.text_store.reset()
         self.client.delete_collection(
             collection_name=self.collection_name
         )
+        for collection_name in (self.passage_collection_name, self.thread_collection_name):
+            if self.client.collection_exists(collection_name=collection_name):
+                self.client.delete_collection(
+                    collection_name=collection_name
+                )
+        self._result_cache.clear()
         
     def collection_exists(self) -> bool:
         """
@@ -67,28 +184,22 @@ class VectorDBRepository:
         """
             Populate the collection with data. This method is a placeholder and should be implemented as needed.
         """
+        metrics.start_snapshots()
         try:
-            # Read previous processing stats from the CSV log
-            stats = csv_logging_repository.read_stats()
-            if stats:
-                processed, skipped = stats
-                processed = int(processed)
-                skipped = int(skipped)
-                print(f"Processed: {processed}, Skipped: {skipped}")
-            else:
-                processed, skipped = 0, 0
-                print("No Previous Uploads Logged")
+            # Read previous processing stats from the ingest journal
+            stats = self.journal.stats()
+            print(f"Processed: {stats['committed']}, Skipped: {stats['skipped']}, Pending: {stats['pending']}")
                 
-            # Determine the starting point for processing
-            start_point = int(processed) + int(skipped)
+            # Resume from the first message that is neither committed nor skipped
+            start_point = self.journal.resume_point()
+            done = self.journal.done_indices(start_point)
             print(f"Starting from message index: {start_point}")
             
             # Check if the collection exists and handle accordingly
             if self.collection_exists():
                 vdb_count = self.count()
                 print(f"Collection already exists with {vdb_count} documents.")
-            else:
-                self.create_collection()
+            self.create_collection()
             
             # Start processing and embedding emails
             start = datetime.now()
@@ -99,29 +210,28 @@ class VectorDBRepository:
                 print("No new messages to process. Start point is greater than or equal to the total message count.")
                 return
             
-            # Iterate through the emails and process them
-            for i in tqdm(range(start_point, mbox_count), desc="Embedding Email", unit="email"):
+            # Stream the emails in mbox order, each one is read and parsed once
+            records = mbox_util.stream_messages(start=start_point, stop=mbox_count, workers=self.extract_workers,
+                                                triage_rules=self.triage_rules, on_skip=self._record_triaged,
+                                                message_timeout=self.message_timeout)
+            pending = []
+            for i, metadata, data in tqdm(records, total=mbox_count - start_point, desc="Embedding Email", unit="email"):
                 try:
-                    metadata, data = mbox_util.extract_metadata(i)        
-                    if metadata is None or data is None:
-                        print(f"Skipping message {i} due to missing metadata or data.")
-                        skipped += 1
-                        continue
-                    
-                    #build embedding data
-                    embed_data = "From: " + metadata["from"] + "\nSubject: " + metadata["subject"] + "\nDate: " + metadata["date"] + "\n\n"
-                    embed_data += str(data)
-                    vector = mbox_util.create_vector_embedding(data=embed_data)
-                                
-                    self.add_document(document_id=i, vector=vector, payload=metadata, skipped_count=skipped)
-                    
+                    self._ingest_record(i, metadata, data, done, pending)
                 except Exception as e:
                     print(f"Error processing message {i}: {e}")
+                    metrics.count("errors_total", stage="ingest", error=type(e).__name__)
+                    self._finish_writes()
                     return
+            
+            # Embed whatever is left over from the last partial batch
+            if pending:
+                self._embed_pending(pending)
                 
-            # Flush any remaining documents in the buffer
+            # Flush any remaining documents in the buffer and wait for the writes to land
             if self._buffer:
-                self.flush(skipped)    
+                self.flush()    
+            self.wait_for_writes()
             
             # Calculate and display elapsed time
             end = datetime.now()
@@ -130,76 +240,680 @@ class VectorDBRepository:
         
         except KeyboardInterrupt:
             print("\nProcess interrupted by user.")
+            self._finish_writes()
         except TimeoutError:
             print("\nProcess timed out.")
+            self._finish_writes()
         except Exception as e:
             print(f"\nAn error occurred: {e}")
+            metrics.count("errors_total", stage="ingest", error=type(e).__name__)
+            self._finish_writes()
+        finally:
+            metrics.write_snapshot()
+    
+    def follow_mailbox(self, poll_interval: float = 2.0, micro_batch_size: int = 32):
+        """
+            Keep the collection in step with a mailbox that is being appended to.
+            Each poll extends the mbox index from the last indexed message (no full rescan), then embeds
+            and upserts the new messages in micro-batches and waits for them to be stored.
+            The last message is only ingested once the file has stopped growing for one poll,
+            so a message that is still being written is never indexed half-way.
+            A poll that fails is logged and retried from the journal's resume point, with exponential
+            backoff up to FOLLOW_MAX_BACKOFF seconds.
+        """
+        self.create_collection()
+        metrics.start_snapshots()
+        print(f"Following {mbox_util.mbox_file} (Ctrl+C to stop)")
+        last_size, failures = None, 0
+        try:
+            while True:
+                try:
+                    last_size = self._poll_mailbox(last_size, micro_batch_size)
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    print(f"Error while following mailbox ({failures} in a row), retrying: {e}")
+                    metrics.count("errors_total", stage="follow", error=type(e).__name__)
+                    self._discard_unwritten()
+                time.sleep(min(poll_interval * 2 ** failures, FOLLOW_MAX_BACKOFF))
+        except KeyboardInterrupt:
+            print("\nStopped following mailbox.")
+        finally:
+            self._finish_writes()
+    
+    def _poll_mailbox(self, last_size: int, micro_batch_size: int) -> int:
+        """
+            Ingest the messages appended since the last poll; returns the current mbox size.
+        """
+        mbox_util.mbox.refresh()
+        size = os.path.getsize(mbox_util.mbox_file) if os.path.exists(mbox_util.mbox_file) else 0
+        stop = mbox_util.get_mbox_count()
+        if size != last_size:
+            stop -= 1
+        
+        start_point = self.journal.resume_point()
+        if start_point < stop:
+            done = self.journal.done_indices(start_point)
+            pending = []
+            records = mbox_util.stream_messages(start=start_point, stop=stop, triage_rules=self.triage_rules,
+                                                on_skip=self._record_triaged)
+            for i, metadata, data in records:
+                self._ingest_record(i, metadata, data, done, pending, micro_batch_size)
+            if pending:
+                self._embed_pending(pending)
+            self.flush()
+            self.wait_for_writes()
+            print(f"Indexed up to message {stop - 1}")
+        return size
+    
+    def ingest_raw_messages(self, raw_records, done: set = frozenset(), micro_batch_size: int = None):
+        """
+            Ingest (id, raw bytes) records from outside the mbox (see gmail_sync) through the same triage,
+            extraction, dedupe, threading and embedding as populate_collection, and wait until they are stored.
+            Ids must not collide with mbox indices; ids in `done` are skipped.
+        """
+        pending = []
+        records = mbox_util.stream_raw_records(raw_records, workers=self.extract_workers, triage_rules=self.triage_rules,
+                                               on_skip=self._record_triaged, message_timeout=self.message_timeout)
+        try:
+            for i, metadata, data in records:
+                self._ingest_record(i, metadata, data, done, pending, micro_batch_size)
+            if pending:
+                self._embed_pending(pending)
+            self.flush()
+        except BaseException:
+            # Whatever was flushed is still written; the rest is fetched again on the next run
+            self._finish_writes()
+            raise
+        self.wait_for_writes()
+    
+    def _record_triaged(self, i: int, reason: str):
+        self._record_skipped(i, f"triage: {reason}", reason=f"triage: {reason}")
+    
+    def _record_skipped(self, i: int, message: str, reason: str):
+        # `reason` is the metrics label, so it must not contain per-message details
+        self.journal.record_skipped(i, message)
+        metrics.count("messages_skipped_total", reason=reason)
+    
+    def _ingest_record(self, i: int, metadata: dict, data: str, done: set, pending: list, embed_batch_size: int = None):
+        """
+            Journal a skipped or failing message, or queue it for embedding and embed the queue once it is full.
+            With dedupe, a near duplicate of an already ingested message is still stored, with the
+            canonical message in its `duplicate_of` payload (see canonical_id), but it is not embedded:
+            its point reuses the canonical message's vector.
+        """
+        if i in done:
+            return
+        
+        if metadata is None or data is None:
+            print(f"Skipping message {i} due to missing metadata or data.")
+            self._record_skipped(i, "no body", reason="no body")
+            return
+        
+        try:
+            pending.append(self._prepare_record(i, metadata, data))
+        except Exception as e:
+            # Skipped for good, so a message that always fails cannot hold back the ones after it
+            print(f"Error processing message {i}, skipping it: {e}")
+            metrics.count("errors_total", stage="ingest", error=type(e).__name__)
+            self._record_skipped(i, f"error: {e}", reason="error")
+            return
+        
+        if len(pending) >= (embed_batch_size or self.embed_batch_size):
+            self._embed_pending(pending)
+    
+    def _prepare_record(self, i: int, metadata: dict, data: str) -> tuple:
+        """
+            Thread, dedupe and hash a message: the (id, metadata, data, content_hash, body) record to embed.
+        """
+        references = metadata.pop("references", [])
+        if self.thread_index is not None:
+            metadata["thread_id"] = self.thread_index.add_message(i, metadata.get("message_id"), references)
+        
+        data = body = str(data)
+        if self.near_duplicates is not None:
+            data = strip_quoted_replies(data)
+            signature = minhash(data)
+            canonical_id = None
+            if signature is not None:
+                canonical_id = self.near_duplicates.find(signature, exclude=i)
+                self.near_duplicates.add(i, signature, canonical_id)
+            if canonical_id is not None:
+                # Kept as a point of its own, so its sender, date and thread stay searchable
+                metadata["duplicate_of"] = canonical_id
+                metrics.count("near_duplicates_total")
+        
+        content_hash = hashlib.sha1(data.encode("utf-8", errors="replace")).hexdigest()
+        # The unstripped body is what the text store keeps, quoted and forwarded text included
+        return i, metadata, data, content_hash, body
     
+    @metrics.timed("embed_batch")
+    def _embed_pending(self, pending: list):
+        """
+            Embed a batch of (id, metadata, data, content_hash, body) records in one model call and buffer them.
+            Near duplicates get the vector of their canonical message instead, once that one is embedded;
+            only those whose canonical vector is not known (e.g. indexed before vectors were kept) are embedded.
+        """
+        duplicates = [record for record in pending if record[1].get("duplicate_of") is not None]
+        originals = [record for record in pending if record[1].get("duplicate_of") is None]
+        embedded = self._embed_records(originals)
+        if self.near_duplicates is not None:
+            self.near_duplicates.set_vectors(embedded)
+            duplicates = self._add_duplicates(duplicates)
+        self._embed_records(duplicates)
+        pending.clear()
+
+    def _embed_records(self, records: list) -> list:
+        """
+            Embed and buffer records; returns their (id, message vector) pairs.
+        """
+        if not records:
+            return []
+        if self.chunk_passages:
+            return self._embed_records_passages(records)
+        
+        texts = [embed_header(metadata) + data for _, metadata, data, _, _ in records]
+        vectors = self._embed_cached(texts)
+        for (i, metadata, _, content_hash, body), vector, text in zip(records, vectors, texts):
+            self.add_document(document_id=i, vector=vector, payload=metadata, content_hash=content_hash, text=text,
+                              stored_text=embed_header(metadata) + body)
+        return [(record[0], vector) for record, vector in zip(records, vectors)]
+
+    def _embed_records_passages(self, records: list) -> list:
+        """
+            Embed every passage of every message in the batch in one model call.
+            Passages become child points of the passage collection, and the message point gets
+            the normalized mean of its passage vectors. Text past chunking.MAX_PASSAGES passages is not
+            embedded (it is still in the lexical index); the payloads record `n_passages` and `truncated`.
+        """
+        texts, owners = [], []
+        for n, (i, metadata, data, _, _) in enumerate(records):
+            header = embed_header(metadata)
+            passages, truncated = chunking.split_passages_with_truncation(data)
+            if truncated:
+                print(f"Message {i}: only the first {len(passages)} passages are embedded, the rest of its text is not.")
+                metrics.count("passages_truncated_total")
+            metadata.update(n_passages=len(passages) or 1, truncated=truncated)
+            for passage in passages or [data]:
+                texts.append(header + passage)
+                owners.append(n)
+        
+        vectors = self._embed_cached(texts)
+        owners = np.asarray(owners)
+        embedded = []
+        for n, (i, metadata, data, content_hash, body) in enumerate(records):
+            passage_vectors = vectors[owners == n]
+            for p, vector in enumerate(passage_vectors):
+                self._passage_buffer.append({
+                    "id": passage_point_id(i, p),
+                    "vector": vector,
+                    "payload": {**{k: v for k, v in metadata.items() if v is not None}, "parent_id": i, "passage": p}
+                })
+            message_vector = passage_vectors.mean(axis=0)
+            message_vector /= np.linalg.norm(message_vector) or 1.0
+            self.add_document(document_id=i, vector=message_vector, payload=metadata, content_hash=content_hash,
+                              text=embed_header(metadata) + data, stored_text=embed_header(metadata) + body)
+            embedded.append((i, message_vector))
+        return embedded
+
+    def _add_duplicates(self, duplicates: list) -> list:
+        """
+            Buffer near duplicates with their canonical message's vector. Passage search does not see them,
+            they have no passages of their own. Returns the records whose canonical vector is not known.
+        """
+        vectors = self.near_duplicates.vectors([metadata["duplicate_of"] for _, metadata, _, _, _ in duplicates])
+        missing = []
+        for record in duplicates:
+            i, metadata, data, content_hash, body = record
+            vector = vectors.get(metadata["duplicate_of"])
+            if vector is None:
+                missing.append(record)
+                continue
+            self.add_document(document_id=i, vector=vector, payload=metadata, content_hash=content_hash,
+                              text=embed_header(metadata) + data, stored_text=embed_header(metadata) + body)
+        metrics.count("embeddings_reused_total", len(duplicates) - len(missing))
+        return missing
+
+    def _embed_cached(self, texts: list):
+        if self.embedding_cache is not None:
+            # Only texts the model has never seen are embedded, e.g. after delete_collection
+            return self.embedding_cache.embed(texts, self._embed_texts)
+        return self._embed_texts(texts)
+
+    def _embed_texts(self, texts: list):
+        return mbox_util.create_vector_embeddings(texts, batch_size=self.embed_batch_size, parallel=self.embed_parallel)
+
     # -----
     # Document Add Management
     # -----
 
-    def add_document(self, document_id: int, vector: list, payload: dict = {}, skipped_count: int = 0):
+    def add_document(self, document_id: int, vector, payload: dict = {}, content_hash: str = None, text: str = None,
+                     stored_text: str = None):
         """
-            Add a document to a buffer.
+            Add a document to a buffer. `text` is added to the lexical index once the batch is stored,
+            `stored_text` (default `text`) goes to the text store for rehydrate.
         """
         assert isinstance(payload, dict), "Payload must be a dictionary"
         assert len(vector) == 384, "Vector must be of length 384"
+        if not 0 <= document_id <= MAX_DOCUMENT_ID:
+            raise ValueError(f"Document id {document_id} is out of range: its passage ids would not fit 64 bits")
         
         self._buffer.append({
             "id": document_id,
             "vector": vector,
-            "payload": {k: v for k, v in payload.items() if v is not None}
+            "payload": {k: v for k, v in payload.items() if v is not None},
+            "content_hash": content_hash,
+            "text": text,
+            "stored_text": stored_text if stored_text is not None else text
         })
         
         if len(self._buffer) >= self.batch_size:
-            self.flush(skipped_count)
+            self.flush()
 
-    def flush(self, skipped_count: int):
+    @metrics.timed("flush")
+    def flush(self):
         """
             Flush the buffer to the database.
+            The batch is recorded as pending in the ingest journal first and marked committed once stored.
+            With async_flush the batch is handed to the background writer and this only blocks
+            when the writer is already behind; call wait_for_writes() to wait for it to land.
         """
         if not self._buffer:
             return
+        
+        batch_id = self.journal.begin_batch([(doc["id"], doc["content_hash"]) for doc in self._buffer])
+        batch = (list(self._passage_buffer), list(self._buffer), batch_id)
+        self._passage_buffer.clear()
+        self._buffer.clear()
+        
+        if self._writer is not None:
+            self._writer.submit(batch)
+        else:
+            self._write_batch(batch)
 
-        csv_logging_repository.update_csv(
-            processed_increment=len(self._buffer) + self.count(),
-            skipped_increment=skipped_count
-        )
+    @metrics.timed("write_batch")
+    def _write_batch(self, batch: tuple):
+        passages, documents, batch_id = batch
+        
+        if self.thread_index is not None:
+            # Threads may have been merged since these documents were queued
+            thread_ids = {doc["id"]: self.thread_index.thread_of(doc["id"]) for doc in documents}
+            for doc in documents:
+                doc["payload"]["thread_id"] = thread_ids[doc["id"]] or doc["payload"].get("thread_id")
+            for passage in passages:
+                passage["payload"]["thread_id"] = thread_ids.get(passage["payload"]["parent_id"]) or passage["payload"].get("thread_id")
+        
+        if self.text_store is not None:
+            # Stored before the points, so a payload never points at text that is not there
+            self._store_texts(documents)
         
+        # Passages go first so a message point never exists without its passages
+        if passages:
+            self._upsert(self.passage_collection_name, passages)
+        self._upsert(self.collection_name, documents)
+        
+        if self.thread_index is not None:
+            self._update_threads(documents)
+        
+        if self.lexical_index is not None:
+            self.lexical_index.add_documents([(doc["id"], doc["text"]) for doc in documents if doc["text"]])
+        
+        # Progress is only journaled once the points are stored
+        self.journal.commit_batch(batch_id)
+        metrics.count("documents_written_total", len(documents), collection=self.collection_name)
+        # Cached results may be missing the points that were just written
+        self._result_cache.clear()
+
+    def _store_texts(self, documents: list):
+        """
+            Append the documents' texts to the text store and put their locations in the payloads.
+            Texts that are already stored are not appended again: a retried batch keeps the locations of its
+            first attempt, and a text the store has seen before (e.g. a re-ingested message) reuses its location.
+        """
+        todo = [doc for doc in documents if doc["stored_text"] and "text_offset" not in doc["payload"]]
+        if not todo:
+            return
+        
+        hashes = [text_hash(doc["stored_text"]) for doc in todo]
+        locations = self.text_store.find(list(set(hashes)))
+        new = {}
+        for doc, content_hash in zip(todo, hashes):
+            if content_hash not in locations:
+                new.setdefault(content_hash, doc["stored_text"])
+        locations.update(zip(new, self.text_store.append(list(new.values()))))
+        for doc, content_hash in zip(todo, hashes):
+            doc["payload"]["text_offset"], doc["payload"]["text_length"] = locations[content_hash]
+        metrics.count("texts_reused_total", len(todo) - len(new))
+
+    @metrics.timed("thread_update")
+    def _update_threads(self, documents: list):
+        """
+            Add the stored documents to their thread aggregates, relabel the points of merged threads
+            and rewrite the thread points that changed.
+            Merges are only acknowledged once all of that is stored, so a retried batch relabels them again.
+        """
+        touched = set()
+        for doc in documents:
+            payload = doc["payload"]
+            touched.add(self.thread_index.add_vector(doc["id"], doc["vector"], payload.get("subject"), payload.get("timestamp")))
+        
+        collections = [self.collection_name] + ([self.passage_collection_name] if self.chunk_passages else [])
+        merges = self.thread_index.peek_merges()
+        absorbed = []
+        for _, old_thread_id, new_thread_id in merges:
+            selector = Filter(must=[FieldCondition(key="thread_id", match=MatchValue(value=old_thread_id))])
+            for collection_name in collections:
+                self.client.set_payload(collection_name=collection_name, payload={"thread_id": new_thread_id}, points=selector)
+            touched.discard(old_thread_id)
+            touched.add(new_thread_id)
+            absorbed.append(thread_point_id(old_thread_id))
+        if absorbed:
+            # Only threads whose point was upserted can be deleted (the in-memory client raises for unknown ids)
+            existing = [record.id for record in self.client.retrieve(
+                collection_name=self.thread_collection_name, ids=absorbed, with_payload=False)]
+            if existing:
+                self.client.delete(collection_name=self.thread_collection_name, points_selector=existing)
+        
+        threads = [self.thread_index.thread(thread_id) for thread_id in touched if thread_id is not None]
+        threads = [thread for thread in threads if thread is not None]
+        if threads:
+            self._upsert(self.thread_collection_name, [
+                {"id": thread_point_id(thread["payload"]["thread_id"]), **thread} for thread in threads
+            ])
+        self.thread_index.ack_merges([seq for seq, _, _ in merges])
+
+    def wait_for_writes(self):
+        """
+            Block until every flushed batch is stored. Raises BatchWriteError if a batch could not be written;
+            the failed batches stay in self._writer.failed and can be retried with self._writer.retry_failed().
+        """
+        if self._writer is not None:
+            self._writer.join()
+
+    def _finish_writes(self):
+        try:
+            self.wait_for_writes()
+        except Exception as e:
+            print(f"Some batches were not written and will be re-processed on the next run: {e}")
+
+    def _discard_unwritten(self):
+        """
+            Drop buffered documents and failed batches after an error. Their messages are still pending
+            in the journal, so the next pass re-processes them.
+        """
+        try:
+            self.wait_for_writes()
+        except Exception:
+            # The batches that failed are dropped below
+            pass
+        self._buffer.clear()
+        self._passage_buffer.clear()
+        if self._writer is not None:
+            self._writer.failed.clear()
+
+    @metrics.timed("upsert")
+    def _upsert(self, collection_name: str, documents: list):
+        # One array conversion for the whole batch instead of a .tolist() per vector
+        metrics.count("points_upserted_total", len(documents), collection=collection_name)
         self.client.upsert(
-            collection_name=self.collection_name,
-            points=self._buffer
+            collection_name=collection_name,
+            points=Batch(
+                ids=[doc["id"] for doc in documents],
+                vectors=np.asarray([doc["vector"] for doc in documents], dtype=np.float32).tolist(),
+                payloads=[doc["payload"] for doc in documents]
+            )
         )
-        self._buffer.clear()
 
     # ----
     # Vector Retrieval
     # ----
 
-    def search(self, vector: list, limit: int = 5):
+    def _cached_results(self) -> TTLCache:
         """
-            Search for similar documents in the collection.
+            The result cache, emptied first when points were written since it was filled, also by another
+            process: search_service never sees the ingester's writes otherwise.
         """
-        results = self.client.search(
-            collection_name=self.collection_name,
-            query_vector=vector,
-            limit=limit
-        )
+        generation = self.journal.generation()
+        if generation != self._cache_generation:
+            self._result_cache.clear()
+            self._cache_generation = generation
+        return self._result_cache
+
+    def search(self, vector: list, limit: int = 5, query_filter: Filter = None):
+        """
+            Search for similar documents in the collection, optionally restricted by a payload filter
+            (see search_filters.build_filter).
+        """
+        key = ("search", _vector_key(vector), limit, filter_key(query_filter))
+        cache = self._cached_results()
+        results = cache.get(key)
+        if results is None:
+            results = self.client.search(
+                collection_name=self.collection_name,
+                query_vector=vector,
+                limit=limit,
+                query_filter=query_filter,
+                search_params=self.profile.search_params()
+            )
+            cache.set(key, results)
         return results
     
-    def context_search(self, text: str, limit: int = 5):
+    @metrics.timed("context_search")
+    def context_search(self, text: str, limit: int = 5, query_filter: Filter = None):
         
-        text_embedding = mbox_util.create_vector_embedding(data=text)
+        text_embedding = self.embed_query(text)
         
-        search_result = self.client.search(
-            collection_name=self.collection_name,
-            query_vector=text_embedding,
+        key = ("context", _vector_key(text_embedding), limit, self.chunk_passages, filter_key(query_filter))
+        cache = self._cached_results()
+        search_result = cache.get(key)
+        metrics.count("result_cache_total", result="miss" if search_result is None else "hit")
+        if search_result is not None:
+            return search_result
+        
+        if self.chunk_passages:
+            search_result = self._passage_search(text_embedding, limit, query_filter)
+        else:
+            search_result = self.client.search(
+                collection_name=self.collection_name,
+                query_vector=text_embedding,
+                limit=limit,
+                query_filter=query_filter,
+                with_payload=True,
+                search_params=self.profile.search_params(),
+            )
+        
+        cache.set(key, search_result)
+        return search_result
+    
+    @metrics.timed("search_batch")
+    def search_batch(self, vectors: list, limit=5, query_filter=None):
+        """
+            search() for many vectors in one request. `limit` and `query_filter` are either one value for all
+            queries or a list with one per query. Returns one hit list per vector, in input order.
+        """
+        limits = _per_query(limit, len(vectors), "limit")
+        filters = _per_query(query_filter, len(vectors), "query_filter")
+        if not len(vectors):
+            return []
+        requests = [
+            SearchRequest(vector=vector, filter=query_filter, limit=limit, with_payload=True, params=self.profile.search_params())
+            for vector, limit, query_filter in zip(np.asarray(vectors, dtype=np.float32).tolist(), limits, filters)
+        ]
+        return self.client.search_batch(collection_name=self.collection_name, requests=requests)
+    
+    @metrics.timed("context_search_batch")
+    def context_search_batch(self, texts: list, limit=5, query_filter=None):
+        """
+            context_search for many queries: one model call for the queries that are not cached and one
+            batch search request. `limit` and `query_filter` are one value or a list with one per query;
+            returns one hit list per query, in input order.
+        """
+        limits = _per_query(limit, len(texts), "limit")
+        filters = _per_query(query_filter, len(texts), "query_filter")
+        vectors = self.embed_queries(texts)
+        
+        keys = [("context", _vector_key(vector), limit, self.chunk_passages, filter_key(query_filter))
+                for vector, limit, query_filter in zip(vectors, limits, filters)]
+        cache = self._cached_results()
+        results = [cache.get(key) for key in keys]
+        todo = [n for n, result in enumerate(results) if result is None]
+        metrics.count("result_cache_total", len(texts) - len(todo), result="hit")
+        metrics.count("result_cache_total", len(todo), result="miss")
+        if not todo:
+            return results
+        
+        if self.chunk_passages:
+            # Grouped passage search has no batch form, so passage queries still go one by one
+            found = [self._passage_search(vectors[n], limits[n], filters[n]) for n in todo]
+        else:
+            found = self.search_batch([vectors[n] for n in todo], [limits[n] for n in todo], [filters[n] for n in todo])
+        for n, hits in zip(todo, found):
+            results[n] = hits
+            cache.set(keys[n], hits)
+        return results
+    
+    @metrics.timed("hybrid_search")
+    def hybrid_search(self, text: str, limit: int = 5, query_filter: Filter = None, candidates: int = None, rrf_k: int = 60):
+        """
+            Fuse dense (context_search) and lexical (BM25) rankings with reciprocal rank fusion.
+            Exact names, order numbers and addresses are found by the lexical side even when the
+            embedding does not rank them highly. Scores in the result are RRF scores.
+        """
+        if self.lexical_index is None:
+            return self.context_search(text=text, limit=limit, query_filter=query_filter)
+        
+        candidates = candidates or limit * 4
+        dense = self.context_search(text=text, limit=candidates, query_filter=query_filter)
+        lexical = self.lexical_index.search(text, limit=candidates)
+        
+        payloads = {hit.id: hit.payload for hit in dense}
+        missing = [doc_id for doc_id, _ in lexical if doc_id not in payloads]
+        if missing:
+            for record in self.client.retrieve(collection_name=self.collection_name, ids=missing, with_payload=True):
+                payloads[record.id] = record.payload
+        
+        # Lexical hits are filtered here, dense hits were already filtered by the vector search
+        lexical_ids = [
+            doc_id for doc_id, _ in lexical
+            if doc_id in payloads and (query_filter is None or matches_filter(payloads[doc_id] or {}, query_filter))
+        ]
+        fused = reciprocal_rank_fusion([[hit.id for hit in dense], lexical_ids], k=rrf_k)
+        return [
+            ScoredPoint(id=doc_id, version=0, score=score, payload=payloads.get(doc_id))
+            for doc_id, score in fused[:limit]
+        ]
+    
+    @metrics.timed("thread_search")
+    def thread_search(self, text: str, limit: int = 5, with_messages: bool = False):
+        """
+            Search whole conversations: each hit is a thread, scored by its aggregate vector, with the ids of
+            its messages in payload["document_ids"]. With `with_messages` the message payloads are fetched
+            in one call and added as payload["messages"], oldest first.
+        """
+        hits = self.client.search(
+            collection_name=self.thread_collection_name,
+            query_vector=self.embed_query(text),
+            limit=limit,
+            with_payload=True,
+            search_params=self.profile.search_params(),
+        )
+        if with_messages and hits:
+            ids = [doc_id for hit in hits for doc_id in hit.payload["document_ids"]]
+            records = {record.id: record.payload for record in self.client.retrieve(collection_name=self.collection_name, ids=ids, with_payload=True)}
+            for hit in hits:
+                messages = [records[doc_id] for doc_id in hit.payload["document_ids"] if doc_id in records]
+                hit.payload["messages"] = sorted(messages, key=lambda payload: payload.get("timestamp") or 0)
+        return hits
+    
+    def embed_query(self, text: str) -> list:
+        """
+            Embed query text, reusing the vector for repeated (normalized) queries.
+        """
+        key = normalize_query(text)
+        vector = self._query_embedding_cache.get(key)
+        if vector is None:
+            vector = mbox_util.create_vector_embedding(data=text)
+            self._query_embedding_cache.set(key, vector)
+        return vector
+    
+    def embed_queries(self, texts: list) -> list:
+        """
+            embed_query for many texts; the ones not in the query cache are embedded in one model call.
+        """
+        keys = [normalize_query(text) for text in texts]
+        vectors = [self._query_embedding_cache.get(key) for key in keys]
+        missing = {key: text for key, text, vector in zip(keys, texts, vectors) if vector is None}
+        if missing:
+            embedded = mbox_util.create_vector_embeddings(list(missing.values()), batch_size=self.embed_batch_size)
+            missing = {key: vector.tolist() for key, vector in zip(missing, embedded)}
+            for key, vector in missing.items():
+                self._query_embedding_cache.set(key, vector)
+        return [vector if vector is not None else missing[key] for key, vector in zip(keys, vectors)]
+    
+    def _passage_search(self, vector: list, limit: int, query_filter: Filter = None):
+        """
+            Search passages and aggregate the hits back to one result per message, scored by its best passage.
+        """
+        groups = self.client.search_groups(
+            collection_name=self.passage_collection_name,
+            query_vector=vector,
+            group_by="parent_id",
             limit=limit,
+            group_size=1,
+            query_filter=query_filter,
             with_payload=True,
+            search_params=self.profile.search_params(),
         )
+        return [
+            ScoredPoint(
+                id=group.id,
+                version=group.hits[0].version,
+                score=group.hits[0].score,
+                payload=group.hits[0].payload,
+            )
+            for group in groups.groups
+        ]
+    
+    def rehydrate(self, hits: list, token_budget: int = CONTEXT_TOKEN_BUDGET, max_tokens_per_message: int = None) -> list:
+        """
+            Source text for search hits (ScoredPoints, Records or ids), in the given order, for prompt context.
+            Text locations come from the hit payloads, or from one retrieve call for hits without them
+            (passage hits, bare ids); each text is then a single read from the text store.
+            Texts are cut so the total stays within `token_budget` whitespace tokens, and each one within
+            `max_tokens_per_message`; hits that no longer fit are left out.
+            Messages ingested before the text store existed are re-extracted from the mbox.
+            Returns [{"id", "score", "payload", "text", "n_tokens", "truncated"}].
+        """
+        ids = [hit if isinstance(hit, int) else hit.id for hit in hits]
+        payloads = {hit.id: hit.payload for hit in hits if not isinstance(hit, int) and hit.payload}
+        located = {i: payloads[i] for i in ids if "text_offset" in (payloads.get(i) or {})}
+        missing = [i for i in dict.fromkeys(ids) if i not in located]
+        if missing:
+            for record in self.client.retrieve(collection_name=self.collection_name, ids=missing, with_payload=True):
+                located[record.id] = record.payload or {}
+                payloads.setdefault(record.id, record.payload)
         
-        return search_result
+        context, remaining = [], token_budget
+        for hit, i in zip(hits, ids):
+            if remaining <= 0:
+                break
+            text = self._stored_text(i, located.get(i))
+            if text is None:
+                continue
+            text, n_tokens, truncated = truncate_tokens(text, min(remaining, max_tokens_per_message or remaining))
+            remaining -= n_tokens
+            context.append({"id": i, "score": getattr(hit, "score", None), "payload": payloads.get(i),
+                            "text": text, "n_tokens": n_tokens, "truncated": truncated})
+        return context
+    
+    def _stored_text(self, document_id: int, payload: dict):
+        if payload is not None and self.text_store is not None and "text_offset" in payload:
+            return self.text_store.read(payload["text_offset"], payload["text_length"])
+        if isinstance(document_id, int) and 0 <= document_id < mbox_util.get_mbox_count():
+            # The old path: parse the message again and re-run HTML / attachment extraction
+            data = mbox_util.get_message(document_id)
+            return embed_header(payload) + data if payload else data
+        return None
     
     def get_document(self, document_id: int) -> Record:
         """
@@ -211,9 +925,55 @@ class VectorDBRepository:
             with_vectors=True,
         )
         return result[0]
+
+    def canonical_id(self, document_id: int) -> int:
+        """
+            The id of the message a near duplicate was linked to, or the id itself for a canonical message.
+        """
+        if self.near_duplicates is None:
+            return document_id
+        canonical_id = self.near_duplicates.canonical_id(document_id)
+        return document_id if canonical_id is None else canonical_id
     
 
 
+def embed_header(metadata: dict) -> str:
+    """
+        Header block prepended to the text sent to the model
+    """
+    return "From: " + (metadata["from"] or "") + "\nSubject: " + metadata["subject"] + "\nDate: " + (metadata["date"] or "") + "\n\n"
+
+_WORD_RE = re.compile(r"\S+")
+
+def truncate_tokens(text: str, max_tokens: int) -> tuple:
+    """
+        (text cut after `max_tokens` whitespace tokens, tokens kept, whether it was cut). Line breaks are kept.
+    """
+    n_tokens = 0
+    for n_tokens, match in enumerate(_WORD_RE.finditer(text), start=1):
+        if n_tokens == max_tokens:
+            end = match.end()
+            return text[:end], n_tokens, bool(_WORD_RE.search(text, end))
+    return text, n_tokens, False
+
+def _per_query(value, n: int, name: str) -> list:
+    if isinstance(value, (list, tuple)):
+        if len(value) != n:
+            raise ValueError(f"{name} has {len(value)} entries for {n} queries")
+        return list(value)
+    return [value] * n
+
+def _vector_key(vector) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+# Passage ids must fit an unsigned 64-bit point id
+MAX_DOCUMENT_ID = (1 << 64) // chunking.MAX_PASSAGES - 1
+
+
+def passage_point_id(document_id: int, passage: int) -> int:
+    return document_id * chunking.MAX_PASSAGES + passage
+
+
 if __name__ == "__main__":
     vdb = VectorDBRepository("emails")
     
@@ -224,7 +984,8 @@ if __name__ == "__main__":
         print("3. Check if Collection Exists")
         print("4. Count Documents in Collection")
         print("5. Get Document by ID") 
-        print("6. Exit")
+        print("6. Follow Mailbox for New Mail")
+        print("7. Exit")
         
         choice = input("Enter your choice: ")
         print()
@@ -257,6 +1018,8 @@ if __name__ == "__main__":
                 else:
                     print("Document not found.")
             case "6":
+                vdb.follow_mailbox()
+            case "7":
                 print("Exiting...")
                 break
             case _: